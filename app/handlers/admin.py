@@ -8,9 +8,20 @@ from app.database import async_session
 from app.services.user_service import get_bot_stats, find_user_by_input, admin_change_balance
 from app.services.payment_service import confirm_purchase
 from app.handlers.start import get_main_kb
+from app.services.job_queue import generation_queue
+from app.services.ai_engine import engine_router
+from app.services.image_prep import input_preparer
+from app.services.image_pool import image_pool
+from app.services.previews import preview_cache
+from app.services.telegram_files import telegram_files
+from app.services.history_writer import history_writer
+from app.services.timings import stage_timings
 
 router = Router()
 
+# Подписи полос генерации для статистики
+LANE_TITLES = {"standard": "Standard", "pro": "PRO", "pro_4k": "PRO 4K"}
+
 
 # --- СОСТОЯНИЯ АДМИНА ---
 class AdminState(StatesGroup):
@@ -26,6 +37,7 @@ def get_admin_menu_kb():
     """Клавиатура главного меню админки"""
     builder = InlineKeyboardBuilder()
     builder.button(text="📊 Статистика", callback_data="admin_stats")
+    builder.button(text="⏱ Тайминги", callback_data="admin_timings")
     builder.button(text="🔍 Найти пользователя", callback_data="admin_find_user")
     builder.button(text="❌ Выйти", callback_data="close_admin")
     builder.adjust(1)
@@ -80,12 +92,55 @@ async def cb_stats(callback: types.CallbackQuery):
     """Показывает статистику бота"""
     async with async_session() as session:
         stats = await get_bot_stats(session)
+    lanes = generation_queue.stats()
 
     text = (
         "📊 **Статистика Бота**\n\n"
         f"👥 Людей: **{stats['users']}**\n"
         f"🎨 Генераций: **{stats['gens']}**\n"
-        f"💰 Касса: **{stats['money']}₽**"
+        f"💰 Касса: **{stats['money']}₽**\n\n"
+        "🧵 **Полосы генераций**"
+    )
+    for name, q in lanes.items():
+        text += (
+            f"\n\n*{LANE_TITLES.get(name, name)}* — в работе **{q['running']}/{q['workers']}**, "
+            f"в очереди **{q['depth']}** (премиум: {q['premium_depth']})\n"
+            f"Ожидание: ср. {q['wait_avg']:.1f}с / p95 {q['wait_p95']:.1f}с / макс {q['wait_max']:.1f}с\n"
+            f"Готово: {q['completed']} | Сбоев: {q['failed']}"
+        )
+    
+    text += "\n\n🛰 **Провайдеры**"
+    for name, p in engine_router.stats().items():
+        p95 = ", ".join(
+            f"{LANE_TITLES.get(lane, lane)} {value:.0f}с" for lane, value in p['p95'].items() if value
+        ) or "—"
+        status = "✅" if p['healthy'] else "🔌"
+        text += f"\n{status} {name}: p95 {p95}, цена {p['cost']}, ошибок {p['errors']}/{p['calls']}"
+    text += f"\nХеджей: {engine_router.hedges_started} (выиграно {engine_router.hedges_won})"
+    
+    prep = input_preparer.stats()
+    text += (
+        f"\n\n🖼 **Входные фото**: кэш {prep['hits']}/{prep['hits'] + prep['misses']}, "
+        f"сэкономлено {prep['saved_mb']:.0f} MB"
+    )
+    files = telegram_files.stats()
+    text += f"\n📎 **Ссылки Telegram**: кэш {files['hits']}/{files['hits'] + files['misses']}, в кэше {files['cached']}"
+    previews = preview_cache.stats()
+    text += (
+        f"\n📤 **Превью**: кэш {previews['hits']}/{previews['hits'] + previews['misses']}, "
+        f"в среднем {previews['ratio'] * 100:.0f}% от оригинала"
+    )
+    history = history_writer.stats()
+    text += (
+        f"\n📝 **История**: в буфере {history['pending']}, записано {history['rows']} "
+        f"пачками по {history['avg_batch']:.1f}" + (f", сбоев {history['failed']}" if history['failed'] else "")
+        + (f", отброшено {history['dead']}" if history['dead'] else "")
+        + (f", напрямую {history['direct']}" if history['direct'] else "")
+    )
+    pool = image_pool.stats()
+    text += (
+        f"\n🧮 **Пул изображений**: в работе {pool['running']}/{pool['workers']}, "
+        f"ждут {pool['waiting']}, среднее {pool['avg_ms']:.0f} мс"
     )
     
     builder = InlineKeyboardBuilder()
@@ -99,6 +154,69 @@ async def cb_stats(callback: types.CallbackQuery):
     await callback.answer()
 
 
+# =====================================================================
+# ТАЙМИНГИ ЭТАПОВ
+# =====================================================================
+def format_stage_table(group: str = "all") -> str:
+    """Таблица этапов: p50 / p95 / среднее / число замеров"""
+    rows = stage_timings.summary(group)
+    if not rows:
+        return "Пока нет замеров."
+    lines = [f"{'этап':<16}{'p50':>7}{'p95':>7}{'avg':>7}{'n':>6}"]
+    for name, st in rows.items():
+        lines.append(f"{name:<16}{st['p50']:>7.2f}{st['p95']:>7.2f}{st['avg']:>7.2f}{st['count']:>6}")
+    return "\n".join(lines)
+
+
+@router.callback_query(F.data == "admin_timings")
+async def cb_timings(callback: types.CallbackQuery):
+    """Где уходят секунды: гистограммы по этапам + последние задачи"""
+    text = "⏱ <b>Этапы генерации</b> (все задачи, сек)\n"
+    text += f"<pre>{html.quote(format_stage_table())}</pre>"
+
+    recent = stage_timings.recent(5)
+    if recent:
+        text += "\n<b>Последние задачи</b>"
+        for t in recent:
+            total = f"{t.total:.1f}с" if t.total is not None else "…"
+            text += f"\n#{t.job_id} · {html.quote(t.group)} · {t.status} · {total}"
+        text += "\n\nПодробно: <code>/trace 12</code> (номер задачи) или <code>/trace user 123456</code>"
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🔄 Обновить", callback_data="admin_timings")
+    builder.button(text="🔙 Меню", callback_data="admin_menu")
+    builder.adjust(1)
+
+    try:
+        await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+    except Exception:
+        pass  # "message is not modified" при повторном нажатии
+    await callback.answer()
+
+
+@router.message(Command("trace"))
+async def cmd_trace(message: types.Message):
+    """/trace [номер задачи | user <id>] — трасса одной генерации по этапам"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    args = message.text.split()[1:]
+    if len(args) == 2 and args[0] == "user" and args[1].isdigit():
+        traces = stage_timings.recent(3, user_id=int(args[1]))
+    elif len(args) == 1 and args[0].isdigit():
+        trace = stage_timings.get(int(args[0]))
+        traces = [trace] if trace else []
+    else:
+        traces = stage_timings.recent(1)
+
+    if not traces:
+        await message.answer("🤷 Трасса не найдена (хранятся последние задачи с момента запуска).")
+        return
+
+    text = "\n\n".join(f"<pre>{html.quote(t.format())}</pre>" for t in traces)
+    await message.answer(text, parse_mode="HTML")
+
+
 # =====================================================================
 # ВОЗВРАТ В МЕНЮ
 # =====================================================================
@@ -1,6 +1,8 @@
+import asyncio
 import json
-import io
-from PIL import Image
+import os
+import socket
+import time
 from aiogram import Router, types, F, Bot
 from aiogram.filters import StateFilter, Command
 from aiogram.fsm.context import FSMContext
@@ -13,17 +15,45 @@ from app.services.admin_logger import log_generation, log_error
 
 from app.database import async_session
 from app.services.user_service import (
-    check_and_deduct_balance, get_user_balance, is_user_premium, 
-    add_history, clear_history, get_history_message_by_id, get_dialog_context,
-    start_generation_task, finish_generation_task, admin_change_balance,
-    get_user_model_preference, set_user_model_preference
+    get_user_balance, is_user_premium, 
+    clear_history, get_history_message_by_id, get_dialog_context,
+    reserve_generation, refund_generation, finish_generation_task,
+    get_user_model_preference, set_user_model_preference,
+    attach_kie_task, claim_resumable_tasks, refund_stuck_tasks, extend_task_lease, get_user
+)
+from app.services.ai_engine import generate_image, resume_kie_task
+from app.services.blob_store import blob_store, temp_store
+from app.services.web_server import media_url, is_media_url, resign_media_url
+from app.services.telegram_files import telegram_files
+from app.services.http_client import get_http_session
+from app.services.image_prep import input_preparer
+from app.services.image_pool import image_pool
+from app.services.image_ops import build_collage
+from app.services.results import GenerationResult
+from app.services.history_writer import history_writer
+from app.services.timings import stage_timings, stage
+from app.services.resilience import ProviderBusyError
+from app.services.job_queue import generation_queue, QueueRejected, lane_for
+from app.services.coalescer import (
+    generation_coalescer, generation_key, build_generation_params, COALESCE_POLICY
 )
-from app.services.ai_engine import generate_image
 from app.utils import prompts
 from app import config
 
 router = Router()
 
+# Продолжение задач после рестарта
+STARTUP_REFUND_MINUTES = int(os.getenv("STARTUP_REFUND_MINUTES", "0"))
+# Аренда задачи инстансом (больше лимита самой долгой полосы); пока задачу ждём — продлевается
+RESUME_LEASE_MINUTES = int(os.getenv("RESUME_LEASE_MINUTES", "15"))
+# Как часто подбирать задачи упавших инстансов (аренда истекла)
+RECOVERY_INTERVAL_MINUTES = int(os.getenv("RECOVERY_INTERVAL_MINUTES", "5"))
+# Стабилен между рестартами: задачи прошлых запусков этого инстанса возвращаем/продолжаем сразу.
+# Несколько инстансов на одном хосте — задайте каждому свой WORKER_ID
+WORKER_ID = os.getenv("WORKER_ID") or socket.gethostname()
+# Метка запуска в claimed_by: прошлые запуски того же WORKER_ID отличаются от текущего без сравнения часов
+WORKER_RUN = f"{WORKER_ID}:{os.getpid()}:{int(time.time())}"
+
 # 👇 ЗАМЕНИТЬ ВЕСЬ СПИСОК IGNORED_TEXTS НА ЭТОТ:
 IGNORED_TEXTS = [
     "✨ Начать творить", "🎨 Создать изображение", "Заработать🍌",
@@ -47,31 +77,6 @@ class GenState(StatesGroup):
 # =====================================================================
 # 🛠 ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =====================================================================
-def smart_compress_image(file_bytes: bytes) -> bytes:
-    """Сжимает изображение если > 9.5 МБ"""
-    LIMIT_BYTES = 9.5 * 1024 * 1024 
-    
-    if len(file_bytes) <= LIMIT_BYTES:
-        return file_bytes 
-    
-    print(f"⚠️ Файл слишком большой ({len(file_bytes) / 1024 / 1024:.2f} MB). Сжимаю...")
-    
-    try:
-        img = Image.open(io.BytesIO(file_bytes))
-        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-            img = img.convert("RGB")
-            
-        max_dimension = 2560
-        if max(img.size) > max_dimension:
-            img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
-            
-        output_io = io.BytesIO()
-        img.save(output_io, format='JPEG', quality=85, optimize=True)
-        return output_io.getvalue()
-    except Exception as e:
-        print(f"❌ Ошибка сжатия: {e}")
-        return file_bytes
-
 def normalize_image_urls(image_urls) -> list:
     """✅ ЕДИНАЯ функция нормализации URL"""
     if not image_urls:
@@ -82,47 +87,60 @@ def normalize_image_urls(image_urls) -> list:
         return image_urls
     return []
 
-def create_collage(images: list, max_size=1024) -> Image.Image:
+def get_history_blob(history_item) -> str | None:
+    """Хэш оригинала в blob store из meta_data записи истории"""
+    try:
+        return json.loads(history_item.content).get("blob")
+    except Exception:
+        return None
+
+async def download_image(url: str) -> bytes | None:
+    """Скачивает фото через общую сессию (keep-alive к api.telegram.org, TLS проверяется)"""
+    session = get_http_session()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+        if resp.status != 200:
+            return None
+        return await resp.read()
+
+async def upload_via_telegram(bot: Bot, chat_id: int, data: bytes, filename: str) -> str:
+    """Загружает картинку в чат (без звука), берёт ссылку на файл и удаляет сообщение"""
+    temp_msg = await bot.send_photo(
+        chat_id=chat_id,
+        photo=types.BufferedInputFile(data, filename),
+        disable_notification=True  # 👈 БЕЗ ЗВУКА
+    )
+    url = await get_photo_url(bot, temp_msg.photo[-1].file_id)
+    try:
+        await temp_msg.delete()
+    except:
+        pass
+    return url
+
+async def get_photo_url(bot: Bot, file_id: str) -> str:
+    """Получает URL фото (file_path кэшируется на время жизни ссылки)"""
+    return await telegram_files.url(bot, file_id)
+
+async def refresh_input_urls(bot: Bot, urls: list, file_ids: list = None) -> list:
     """
-    Создаёт коллаж из 2-4 изображений
-    
-    2 фото: горизонтально [img1][img2]
-    3-4 фото: сетка 2x2
+    Ссылки на входные фото из истории протухают: Telegram — через час, наши /media — через MEDIA_URL_TTL.
+    Пересобираем лениво перед reroll: по file_id (через кэш) и новой подписью.
+    None на месте фото, которое уже не достать.
     """
-    count = len(images)
-    
-    if count == 2:
-        cols, rows = 2, 1
-    elif count <= 4:
-        cols, rows = 2, 2
-    else:
-        raise ValueError("Max 4 images")
-    
-    cell_w = max_size // cols
-    cell_h = max_size // rows
-    
-    canvas = Image.new('RGB', (max_size, max_size), 'white')
-    
-    for idx, img in enumerate(images):
-        img_resized = img.copy()
-        img_resized.thumbnail((cell_w, cell_h), Image.Resampling.LANCZOS)
-        
-        col = idx % cols
-        row = idx // cols
-        
-        x = col * cell_w + (cell_w - img_resized.width) // 2
-        y = row * cell_h + (cell_h - img_resized.height) // 2
-        
-        canvas.paste(img_resized, (x, y))
-    
-    return canvas
+    file_ids = file_ids or []
+
+    async def refresh(index: int, url: str) -> str | None:
+        if is_media_url(url):
+            return resign_media_url(url)
+        file_id = file_ids[index] if index < len(file_ids) else None
+        if not file_id:
+            return url  # старая запись без file_id — пробуем как есть
+        try:
+            return await telegram_files.url(bot, file_id)
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить ссылку на фото: {e}")
+            return None
 
-async def get_photo_url(bot: Bot, file_id: str) -> str:
-    """Получает URL фото"""
-    if not file_id:
-        return None
-    file_info = await bot.get_file(file_id)
-    return f"https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}"
+    return list(await asyncio.gather(*(refresh(i, url) for i, url in enumerate(urls))))
 
 # =====================================================================
 # 🎛 КЛАВИАТУРЫ
@@ -335,12 +353,9 @@ async def cb_pf_start(callback: types.CallbackQuery, state: FSMContext):
         if quality == "4k": resolution = "4K"
         elif quality == "2k": resolution = "2K"
     
-    # 2. Просто уведомляем пользователя (Toast), НЕ трогая сообщение с меню
-    await callback.answer(f"🚀 Запускаю...", show_alert=False)
-    
-    # 3. Запускаем генерацию
+    # 2. Ставим в очередь и уведомляем пользователя (Toast), НЕ трогая сообщение с меню
     # Меню останется висеть в чате, и юзер сможет поменять настройки и нажать снова
-    await process_generation(
+    toast = await enqueue_generation(
         callback.message, 
         callback.from_user.id, 
         prompt, 
@@ -350,6 +365,7 @@ async def cb_pf_start(callback: types.CallbackQuery, state: FSMContext):
         use_pro_model=use_pro, 
         resolution=resolution
     )
+    await callback.answer(toast, show_alert=False)
     
     # ⚠️ ВАЖНО: Мы НЕ делаем await state.clear()
     # Состояние остается активным, чтобы кнопки в меню продолжали работать
@@ -368,16 +384,10 @@ async def handle_album_input(message: types.Message, state: FSMContext, bot: Bot
         await message.answer("✋ **Ого, слишком много!**\nМаксимум 4 фото.", parse_mode="Markdown")
         return
     
-    image_urls = []
-    full_caption = ""
-    
-    for msg in messages:
-        if msg.photo:
-            url = await get_photo_url(bot, msg.photo[-1].file_id)
-            if url:  # ✅ Проверка
-                image_urls.append(url)
-        if msg.caption and not full_caption: 
-            full_caption = msg.caption
+    full_caption = next((msg.caption for msg in messages if msg.caption), "")
+    # Все фото альбома — одним пакетом, а не по очереди
+    resolved = await telegram_files.urls(bot, [msg.photo[-1].file_id for msg in messages if msg.photo])
+    image_urls = [url for url in resolved if url]  # ✅ Проверка
     
     if not image_urls:
         await message.answer("❌ Не удалось получить фото.")
@@ -522,8 +532,6 @@ async def handle_delayed_caption(message: types.Message, state: FSMContext):
 @router.callback_query(F.data.startswith("reroll_"))
 async def cb_reroll(callback: types.CallbackQuery, bot: Bot):
     """Перегенерация с теми же параметрами"""
-    await callback.answer("🔄 Запускаю...", show_alert=False)
-    
     try:
         db_id = int(callback.data.split("_")[1])
         
@@ -531,23 +539,30 @@ async def cb_reroll(callback: types.CallbackQuery, bot: Bot):
             history_item = await get_history_message_by_id(session, db_id)
         
         if not history_item or not history_item.content:
+            await callback.answer()
             await callback.message.answer("⚠️ Данные генерации устарели.")
             return
         
         params = json.loads(history_item.content)
+        image_urls = await refresh_input_urls(
+            bot, normalize_image_urls(params.get("image_urls")), params.get("image_file_ids")
+        )
+        if not all(image_urls):
+            await callback.answer()
+            await callback.message.answer("⚠️ Исходные фото этой генерации больше недоступны.")
+            return
         
-        await callback.message.reply("🔄 **Ещё раз!**\nГенерирую...", parse_mode="Markdown")
-        
-        await process_generation(
+        toast = await enqueue_generation(
             callback.message, 
             callback.from_user.id, 
             params.get("prompt"), 
-            params.get("image_urls"),  # ✅ Уже список
+            image_urls,
             params.get("ratio", "1:1"), 
             params.get("cost", 1), 
             params.get("pro", False), 
             params.get("resolution", "1K")
         )
+        await callback.answer(toast, show_alert=False)
     except Exception as e:
         print(f"❌ Ошибка reroll: {e}")
         await callback.answer("❌ Ошибка перегенерации", show_alert=True)
@@ -565,7 +580,16 @@ async def cb_download(callback: types.CallbackQuery, bot: Bot):
             await callback.answer("❌ Запись не найдена.", show_alert=True)
             return
 
-        if history_item.image_url:
+        # 1. Оригинал из локального blob store (без повторного скачивания)
+        result = GenerationResult.from_history(history_item)
+        if result and result.path:
+            await bot.send_document(
+                chat_id=callback.from_user.id, 
+                document=result.as_document(f"image_{db_id}.{result.ext}"), 
+                caption="💎 Исходное качество (Original)"
+            )
+
+        elif history_item.image_url:
             try:
                 # 🛡️ ДОБАВИЛИ ТАЙМАУТ: Если качает дольше 30 сек — обрываем, чтобы не вешать сервер
                 timeout = aiohttp.ClientTimeout(total=30)
@@ -640,6 +664,7 @@ async def cb_edit_result(callback: types.CallbackQuery, state: FSMContext, bot:
         
         await state.update_data(
             editing_file_id=history_item.file_id,
+            editing_blob=get_history_blob(history_item),
             edit_use_pro=use_pro,
             edit_cost=cost
         )
@@ -666,7 +691,11 @@ async def handle_edit_instruction(message: types.Message, state: FSMContext, bot
         await state.clear()
         return
     
-    img_url = await get_photo_url(bot, file_id)
+    # Оригинал без сжатия Telegram — подписанной ссылкой из blob store; иначе — файл из чата
+    original = GenerationResult(data["editing_blob"]) if data.get("editing_blob") else None
+    img_url = media_url(original.blob_hash, original.ext) if original and original.path else None
+    if not img_url:
+        img_url = await get_photo_url(bot, file_id)
     
     if not img_url:
         await message.answer("❌ Не удалось получить фото.")
@@ -776,8 +805,7 @@ async def wizard_step_3(message: types.Message, state: FSMContext, bot: Bot):
         await state.clear()
         return
     
-    base_url = await get_photo_url(bot, base_id)
-    ref_url = await get_photo_url(bot, ref_id)
+    base_url, ref_url = await telegram_files.urls(bot, [base_id, ref_id])
     
     if not base_url or not ref_url:
         await message.answer("❌ Не удалось получить фото.")
@@ -811,6 +839,63 @@ async def handle_category_input(message: types.Message, state: FSMContext, bot:
     
     await start_preflight_check(message, state, user_text, image_urls_list)
 
+# ==============================================================================
+# 🧵 ПОСТАНОВКА В ОЧЕРЕДЬ
+# ==============================================================================
+async def enqueue_generation(
+    message: types.Message, 
+    user_id: int, 
+    prompt: str, 
+    image_urls, 
+    aspect_ratio: str = "1:1", 
+    cost: int = 1, 
+    use_pro_model: bool = False, 
+    resolution: str = "1K"
+) -> str:
+    """
+    Ставит генерацию в общую очередь и сразу возвращается.
+    Возвращает текст для всплывашки (callback.answer).
+    """
+    # Склейка дублей (двойной тап, повторный reroll тех же параметров)
+    params = build_generation_params(
+        prompt, normalize_image_urls(image_urls), aspect_ratio, cost, use_pro_model, resolution
+    )
+    coalesce_key = generation_key(user_id, params)
+    # None — это дубль: под "share" он идёт дальше, но запись ведущего не снимает
+    coalesce_entry = generation_coalescer.claim(coalesce_key)
+    if coalesce_entry is None and COALESCE_POLICY == "drop":
+        return "⏳ Такая генерация уже в работе — результат придёт сюда."
+    
+    async with async_session() as session:
+        premium = await is_user_premium(session, user_id)
+    
+    # Полоса по модели/разрешению: PRO 4K не тормозит Standard
+    lane = lane_for(use_pro_model, resolution)
+    timeout = generation_queue.lanes[lane].timeout
+    enqueued_at = time.monotonic()
+    
+    try:
+        position = await generation_queue.submit(
+            lane,
+            user_id,
+            lambda: process_generation(
+                message, user_id, prompt, image_urls, 
+                aspect_ratio, cost, use_pro_model, resolution,
+                timeout=timeout, coalesce_key=coalesce_key, coalesce_entry=coalesce_entry,
+                enqueued_at=enqueued_at
+            ),
+            premium=premium
+        )
+    except QueueRejected as e:
+        generation_coalescer.release(coalesce_key, coalesce_entry)
+        if e.reason == "user_limit":
+            return "✋ У тебя уже есть генерации в работе. Дождись результата!"
+        return "😮‍💨 Сейчас большая нагрузка. Попробуй через минуту."
+    
+    if position:
+        return f"⏳ В очереди: {position}"
+    return "🚀 Запускаю..."
+
 # ==============================================================================
 # 🔥 ГЛАВНАЯ ФУНКЦИЯ ГЕНЕРАЦИИ
 # ==============================================================================
@@ -822,17 +907,40 @@ async def process_generation(
     aspect_ratio: str = "1:1", 
     cost: int = 1, 
     use_pro_model: bool = False, 
-    resolution: str = "1K"
+    resolution: str = "1K",
+    timeout: float = None,
+    coalesce_key: str = None,
+    coalesce_entry=None,
+    enqueued_at: float = None
 ):
-    """Основная функция генерации изображений"""
+    """
+    Основная функция генерации изображений.
+    timeout — лимит полосы на саму генерацию, coalesce_key — ключ склейки дублей,
+    coalesce_entry — запись склейки, если этот запрос её владелец (None у дубля),
+    enqueued_at — время постановки в очередь (для этапа queue_wait в трассе).
+    """
     bot = message.bot 
     
-    # 1. Проверка и списание баланса
-    async with async_session() as session:
-        has_balance = await check_and_deduct_balance(session, user_id, amount=cost)
-        balance_left = await get_user_balance(session, user_id)
+    # ⏱ Трасса задачи: каждый этап ниже попадает в неё и в гистограммы
+    trace = stage_timings.start(
+        user_id, "PRO" if use_pro_model else "Standard", resolution, len(normalize_image_urls(image_urls))
+    )
+    if enqueued_at:
+        trace.mark("queue_wait", time.monotonic() - enqueued_at)
+    
+    # 1. Резерв бананов: атомарное списание + запись о задаче (по ней после рестарта
+    #    либо продолжим, либо вернём бананы) — одна транзакция
+    with stage_timings.guard(trace), stage("balance"):
+        async with async_session() as session:
+            task_db_id, balance_left = await reserve_generation(
+                session, user_id, cost, chat_id=message.chat.id,
+                worker=WORKER_RUN, lease_minutes=RESUME_LEASE_MINUTES
+            )
 
-    if not has_balance:
+    if not task_db_id:
+        stage_timings.finish(trace, "no_balance")
+        if coalesce_key:
+            generation_coalescer.release(coalesce_key, coalesce_entry)
         await message.answer(
             "🙈 <b>Ой, бананы закончились!</b>\n\n"
             "Ты так увлекся творчеством, что запасы иссякли.\n"
@@ -858,106 +966,116 @@ async def process_generation(
 
     # 🔥 AUTO-COLLAGE ТОЛЬКО ДЛЯ НЕ-SWAP ЗАДАЧ
     if is_complex_standard and len(final_urls) >= 2 and not is_swap_task:
-        try:
-            print(f"🎨 Создаю коллаж из {len(final_urls)} фото...") 
-            
-            # 1. Скачиваем все изображения
-            images = []
-            timeout = aiohttp.ClientTimeout(total=30)
-            connector = aiohttp.TCPConnector(ssl=False)
-            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-                for url in final_urls:
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            img_data = await resp.read()
-                            img = Image.open(io.BytesIO(img_data))
-                            images.append(img)
-            
-            if len(images) < len(final_urls):
-                print(f"⚠️ Не все фото загрузились: {len(images)}/{len(final_urls)}")
+        with stage_timings.guard(trace), stage("collage"):
+            try:
+                print(f"🎨 Создаю коллаж из {len(final_urls)} фото...") 
             
-            if not images:
-                print("❌ Ни одно фото не загрузилось для коллажа")
-                raise Exception("No images loaded")
+                # 1. Скачиваем все изображения — параллельно, через общий пул соединений
+                downloaded = await asyncio.gather(
+                    *(download_image(url) for url in final_urls), return_exceptions=True
+                )
+                images = [data for data in downloaded if isinstance(data, bytes)]
             
-            # 2. Создаём коллаж (синхронная функция)
-            collage = create_collage(images, max_size=1024)
+                if len(images) < len(final_urls):
+                    print(f"⚠️ Не все фото загрузились: {len(images)}/{len(final_urls)}")
             
-            # 3. Конвертируем в bytes
-            collage_bytes = io.BytesIO()
-            collage.save(collage_bytes, format='PNG')
-            collage_bytes.seek(0)
+                if not images:
+                    print("❌ Ни одно фото не загрузилось для коллажа")
+                    raise Exception("No images loaded")
             
-# 4. Загружаем коллаж в Telegram (БЕЗ уведомления)
-            temp_msg = await bot.send_photo(
-                chat_id=user_id,
-                photo=types.BufferedInputFile(collage_bytes.read(), "collage.png"),
-                disable_notification=True  # 👈 БЕЗ ЗВУКА
-)
+                if len(images) < 2:
+                    raise Exception("Not enough images for collage")
             
-            # 5. Получаем URL коллажа
-            collage_url = await get_photo_url(bot, temp_msg.photo[-1].file_id)
+                # 2-3. Коллаж: уменьшенное декодирование + раскладка + JPEG — один вызов в пуле процессов
+                collage_bytes = await image_pool.run(build_collage, images, 1024)
             
-            # 6. Удаляем временное сообщение
-            try:
-                await temp_msg.delete()
-            except:
-                pass
+                # 4-6. Отдаём коллаж провайдеру подписанной ссылкой с нашего сервера
+                collage_hash = await temp_store.put(collage_bytes)
+                collage_url = media_url(collage_hash, "jpg")
+                if not collage_url:
+                    # Нет PUBLIC_BASE_URL — старый путь через Telegram (загрузить, взять ссылку, удалить)
+                    collage_url = await upload_via_telegram(bot, user_id, collage_bytes, "collage.jpg")
             
 # 7. ВАЖНО: Заменяем final_urls на коллаж
-            final_urls = [collage_url]
+                final_urls = [collage_url]
             
-            # 🔥 МОДИФИЦИРУЕМ ПРОМПТ ДЛЯ КОЛЛАЖА
+                # 🔥 МОДИФИЦИРУЕМ ПРОМПТ ДЛЯ КОЛЛАЖА
             
-            if len(images) == 2:
-                prompt = f"{prompt}. IMPORTANT: Combine both subjects into a SINGLE unified scene. They should interact naturally, standing together. Do NOT keep the collage structure - merge them into one cohesive image."
-            elif len(images) >= 3:
-                prompt = f"{prompt}. IMPORTANT: Create a SINGLE unified composition with all {len(images)} subjects together in one scene. Remove the grid layout - merge into one natural photo."
+                if len(images) == 2:
+                    prompt = f"{prompt}. IMPORTANT: Combine both subjects into a SINGLE unified scene. They should interact naturally, standing together. Do NOT keep the collage structure - merge them into one cohesive image."
+                elif len(images) >= 3:
+                    prompt = f"{prompt}. IMPORTANT: Create a SINGLE unified composition with all {len(images)} subjects together in one scene. Remove the grid layout - merge into one natural photo."
             
-            print(f"✅ Коллаж создан: {collage_url[:50]}...")
-            print(f"📝 Промпт изменён: {prompt[:150]}...")
+                print(f"✅ Коллаж создан: {collage_url[:50]}...")
+                print(f"📝 Промпт изменён: {prompt[:150]}...")
             
-        except Exception as e:
-            print(f"⚠️ Ошибка создания коллажа: {e}")
-            import traceback
-            traceback.print_exc()
-            # Продолжаем с оригинальными URL (fallback)
+            except Exception as e:
+                print(f"⚠️ Ошибка создания коллажа: {e}")
+                import traceback
+                traceback.print_exc()
+                # Продолжаем с оригинальными URL (fallback)
     
 # 2. Сообщение о старте (РАЗНОЕ для простого/сложного)
-    if is_complex_standard:
-        # 📌 СЦЕНАРИЙ Б: Сложный (Standard + много фото) - С ПРЕДУПРЕЖДЕНИЕМ
-        wait_msg = await message.answer(
-            "⏳ <b>Создаю...</b>\n\n"
-            "⚠️ <b>Вы объединяете несколько фото в модели STANDARD.</b>\n"
-            "Детали и сходство (особенно лица) могут искажаться.\n"
-            "💡 <i>Для максимальной точности рекомендуем модель PRO.</i>",
-            parse_mode="HTML"
-        )
-        should_delete_wait_msg = False  # НЕ УДАЛЯЕМ
-    else:
-        # 📌 СЦЕНАРИЙ А: Простой - ТОЛЬКО статус
-        wait_msg = await message.answer("⏳ <b>Создаю...</b>", parse_mode="HTML")
-        should_delete_wait_msg = True  # УДАЛЯЕМ
+    with stage_timings.guard(trace), stage("wait_msg"):
+        if is_complex_standard:
+            # 📌 СЦЕНАРИЙ Б: Сложный (Standard + много фото) - С ПРЕДУПРЕЖДЕНИЕМ
+            wait_msg = await message.answer(
+                "⏳ <b>Создаю...</b>\n\n"
+                "⚠️ <b>Вы объединяете несколько фото в модели STANDARD.</b>\n"
+                "Детали и сходство (особенно лица) могут искажаться.\n"
+                "💡 <i>Для максимальной точности рекомендуем модель PRO.</i>",
+                parse_mode="HTML"
+            )
+            should_delete_wait_msg = False  # НЕ УДАЛЯЕМ
+        else:
+            # 📌 СЦЕНАРИЙ А: Простой - ТОЛЬКО статус
+            wait_msg = await message.answer("⏳ <b>Создаю...</b>", parse_mode="HTML")
+            should_delete_wait_msg = True  # УДАЛЯЕМ
 
+    job_status = "crash"
+    lease = keep_task_lease(task_db_id)
     try:
         await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.UPLOAD_PHOTO)
         
         # 4. Генерация
-        result_data = await generate_image(
-            bot, prompt, final_urls, False, 
-            aspect_ratio, use_pro_model, None, resolution
-        )
-        
-        # 5. Обработка результата
-        result_file = None
-        source_url = None
+        async def remember_kie_task(kie_task_id: str, model: str):
+            # taskId Kie + всё, что нужно для доставки результата после рестарта
+            task_params = build_generation_params(
+                prompt, final_urls, aspect_ratio, cost, use_pro_model, resolution
+            )
+            task_params["kie_model"] = model
+            task_params["delete_wait"] = should_delete_wait_msg
+            async with async_session() as session:
+                await attach_kie_task(
+                    session, task_db_id, kie_task_id, json.dumps(task_params), wait_msg.message_id,
+                    worker=WORKER_RUN, lease_minutes=RESUME_LEASE_MINUTES
+                )
+
+        # EXIF, уменьшение до полезного для модели размера, локальная раздача (в истории — оригиналы)
+        with stage("prepare_inputs"):
+            engine_urls = await input_preparer.prepare_all(final_urls, use_pro_model, resolution)
+
+        def run_engine(on_task_created):
+            return generate_image(
+                bot, prompt, engine_urls, False, 
+                aspect_ratio, use_pro_model, None, resolution,
+                on_task_created=on_task_created
+            )
         
-        if result_data and isinstance(result_data, tuple):
-            result_file, source_url = result_data
-        elif result_data: 
-            result_file = result_data
+        try:
+            # Дубли с тем же ключом ждут ту же задачу Kie (и записывают её taskId в свою задачу)
+            if coalesce_key:
+                engine_call = generation_coalescer.run(coalesce_key, run_engine, on_task_created=remember_kie_task)
+            else:
+                engine_call = run_engine(remember_kie_task)
+            with stage("engine"):
+                result_data = await asyncio.wait_for(engine_call, timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⌛ Генерация не уложилась в {timeout:.0f}с")
+            result_data = None
         
-        if result_file:
+        # 5. Обработка результата
+        if result_data:
             # 🔥 УДАЛЯЕМ СООБЩЕНИЕ ТОЛЬКО ДЛЯ ПРОСТОГО СЦЕНАРИЯ
             if should_delete_wait_msg:
                 try: 
@@ -965,81 +1083,18 @@ async def process_generation(
                 except: 
                     pass
             
-            # 6. Формирование caption
-            safe_prompt = html.quote(prompt[:50])
-            caption = (
-                f"🍌 <b>Готово!</b>\n"
-                f"💬 <i>«{safe_prompt}...»</i>\n"
-                f"🔋 Осталось: <b>{balance_left}</b> 🍌\n\n"
-                f"Сгенерировано в @nan0banana_bot"
-            )
-            
-            # 7. Сжатие для превью
-            file_bytes = result_file.data
-            compressed_bytes = smart_compress_image(file_bytes)
-            preview_file = types.BufferedInputFile(compressed_bytes, filename="result.png")
-            
-            # 8. Отправка
-            try:
-                sent_msg = await message.answer_photo(
-                    preview_file, 
-                    caption=caption, 
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                print(f"⚠️ Ошибка отправки фото: {e}")
-                sent_msg = await message.answer_document(
-                    result_file, 
-                    caption=caption, 
-                    parse_mode="HTML"
-                )
-
-            # 9. Сохранение в БД
-            sent_file_id = (
-                sent_msg.photo[-1].file_id if sent_msg.photo 
-                else sent_msg.document.file_id
-            )
-
-            # 👇👇👇 🟢 1. ЛОГГЕР: УСПЕШНАЯ ГЕНЕРАЦИЯ 👇👇👇
-            await log_generation(
-                bot, 
-                message.from_user, 
-                prompt=prompt, 
-                model="PRO" if use_pro_model else "Standard", 
-                photo_file_id=sent_file_id
+            await deliver_generation_result(
+                bot, message.chat.id, message.from_user, user_id, prompt, final_urls,
+                aspect_ratio, cost, use_pro_model, resolution,
+                result_data, balance_left
             )
-            # 👆👆👆 -------------------------------------
-            
-            meta_data = json.dumps({
-                "prompt": prompt,
-                "image_urls": final_urls,
-                "ratio": aspect_ratio,
-                "cost": cost,
-                "pro": use_pro_model,
-                "resolution": resolution
-            })
-            
             async with async_session() as session:
-                await add_history(
-                    session, user_id, "user", prompt, 
-                    has_image=bool(final_urls)
-                )
-                model_msg = await add_history(
-                    session, user_id, "model", meta_data, 
-                    has_image=True, 
-                    file_id=sent_file_id, 
-                    image_url=source_url
-                )
-                db_id = model_msg.id
-            
-            # 10. Добавление кнопок
-            if db_id:
-                await sent_msg.edit_reply_markup(
-                    reply_markup=get_result_kb(db_id, use_pro_model, cost)
-                )
+                await finish_generation_task(session, task_db_id, "completed")
+            job_status = "ok"
         else:
             # ❌ NULL ОТВЕТ - ВОЗВРАТ ДЕНЕГ
             print("❌ API вернул NULL")
+            job_status = "null"
 
             # 👇👇👇 🔴 2. ЛОГГЕР: ОШИБКА API 👇👇👇
             await log_error(
@@ -1052,7 +1107,7 @@ async def process_generation(
             # 👆👆👆 ------------------------------
 
             async with async_session() as session: 
-                await admin_change_balance(session, user_id, cost)
+                await refund_generation(session, task_db_id)
             
             try: 
                 await wait_msg.edit_text(
@@ -1069,6 +1124,24 @@ async def process_generation(
                     parse_mode="HTML"
                 )
                 
+    except ProviderBusyError as e:
+        # 🔌 ПРОВАЙДЕР ПЕРЕГРУЖЕН - ВОЗВРАТ ДЕНЕГ И МГНОВЕННЫЙ ОТВЕТ
+        print(f"🔌 Провайдер занят: {e}")
+        job_status = "busy"
+        
+        async with async_session() as session: 
+            await refund_generation(session, task_db_id)
+        
+        busy_text = (
+            "😮‍💨 <b>Сервис генерации сейчас перегружен</b>\n\n"
+            "Попробуй ещё раз через пару минут.\n"
+            f"💰 {cost} 🍌 возвращены на баланс."
+        )
+        try: 
+            await wait_msg.edit_text(busy_text, parse_mode="HTML")
+        except: 
+            await message.answer(busy_text, parse_mode="HTML")
+    
     except Exception as e:
         # ❌ КРИТИЧЕСКАЯ ОШИБКА - ВОЗВРАТ ДЕНЕГ
         print(f"❌ Критическая ошибка: {e}")
@@ -1087,7 +1160,7 @@ async def process_generation(
         traceback.print_exc()
         
         async with async_session() as session: 
-            await admin_change_balance(session, user_id, cost)
+            await refund_generation(session, task_db_id)
         
         try: 
             await wait_msg.edit_text(
@@ -1102,4 +1175,230 @@ async def process_generation(
                 f"<code>{str(e)[:100]}</code>\n\n"
                 f"💰 {cost} 🍌 возвращены на баланс.",
                 parse_mode="HTML"
-            )
\ No newline at end of file
+            )
+    finally:
+        lease.cancel()
+        stage_timings.finish(trace, job_status)
+
+# ==============================================================================
+# 📬 ДОСТАВКА РЕЗУЛЬТАТА (общая для обычного пути и продолжения после рестарта)
+# ==============================================================================
+async def deliver_generation_result(
+    bot: Bot,
+    chat_id: int,
+    log_user,
+    user_id: int,
+    prompt: str,
+    final_urls: list,
+    aspect_ratio: str,
+    cost: int,
+    use_pro_model: bool,
+    resolution: str,
+    result: GenerationResult,
+    balance_left: int
+) -> int | None:
+    """
+    Отправляет результат, пишет историю и вешает кнопки.
+    log_user — объект с .username для лога (from_user или User из БД).
+    Оригинал читается с диска только при отправке; лог админам идёт по file_id, без повторной загрузки.
+    """
+    # 6. Формирование caption
+    safe_prompt = html.quote(prompt[:50])
+    caption = (
+        f"🍌 <b>Готово!</b>\n"
+        f"💬 <i>«{safe_prompt}...»</i>\n"
+        f"🔋 Осталось: <b>{balance_left}</b> 🍌\n\n"
+        f"Сгенерировано в @nan0banana_bot"
+    )
+    
+    # 7. Превью под Telegram (2560px, качество под целевой размер); кэшируется по оригиналу
+    with stage("preview"):
+        preview_file = await result.as_photo()
+    
+    # 8. Отправка
+    with stage("send"):
+        try:
+            sent_msg = await bot.send_photo(
+                chat_id, 
+                preview_file, 
+                caption=caption, 
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            print(f"⚠️ Ошибка отправки фото: {e}")
+            sent_msg = await bot.send_document(
+                chat_id, 
+                result.as_document(), 
+                caption=caption, 
+                parse_mode="HTML"
+            )
+
+    # 9. Сохранение в БД
+    sent_file_id = (
+        sent_msg.photo[-1].file_id if sent_msg.photo 
+        else sent_msg.document.file_id
+    )
+
+    # 👇👇👇 🟢 1. ЛОГГЕР: УСПЕШНАЯ ГЕНЕРАЦИЯ 👇👇👇
+    if log_user:
+        await log_generation(
+            bot, 
+            log_user, 
+            prompt=prompt, 
+            model="PRO" if use_pro_model else "Standard", 
+            photo_file_id=sent_file_id
+        )
+    # 👆👆👆 -------------------------------------
+    
+    meta = build_generation_params(
+        prompt, final_urls, aspect_ratio, cost, use_pro_model, resolution
+    )
+    # Связка записи истории с оригиналом в blob store
+    meta["blob"] = result.blob_hash
+    # file_id входных фото: по ним reroll пересоберёт протухшие ссылки Telegram
+    meta["image_file_ids"] = [telegram_files.file_id_for(url) for url in final_urls]
+    meta_data = json.dumps(meta)
+    
+    # Запись в буфер: id нужен кнопкам сразу, в БД строки уйдут пачкой (history_writer)
+    with stage("history"):
+        await history_writer.add(
+            user_id, "user", prompt, 
+            has_image=bool(final_urls)
+        )
+        db_id = await history_writer.add(
+            user_id, "model", meta_data, 
+            has_image=True, 
+            file_id=sent_file_id, 
+            image_url=result.source_url
+        )
+    
+    # 10. Добавление кнопок
+    if db_id:
+        with stage("buttons"):
+            await sent_msg.edit_reply_markup(
+                reply_markup=get_result_kb(db_id, use_pro_model, cost)
+            )
+    return db_id
+
+# ==============================================================================
+# ♻️ ПРОДОЛЖЕНИЕ ЗАДАЧ ПОСЛЕ РЕСТАРТА
+# ==============================================================================
+def keep_task_lease(task_id: int) -> asyncio.Task:
+    """Продлевает аренду задачи, пока мы её ведём: соседний инстанс не вернёт за неё бананы и не заберёт"""
+    async def renew():
+        while True:
+            await asyncio.sleep(RESUME_LEASE_MINUTES * 60 / 3)
+            try:
+                async with async_session() as session:
+                    await extend_task_lease(session, task_id, WORKER_RUN, RESUME_LEASE_MINUTES)
+            except Exception as e:
+                print(f"⚠️ Не удалось продлить аренду задачи {task_id}: {e}")
+    return asyncio.create_task(renew())
+
+async def resume_generation_tasks(bot: Bot, startup: bool = True):
+    """
+    Вызывается при старте бота (и периодически из task_recovery_loop).
+    'processing' — до Kie не дошли, возвращаем бананы сразу;
+    'submitted' — задача уже в Kie, дожидаемся её и доставляем результат.
+    Задачи под живой арендой соседнего инстанса не трогаем — их делают прямо сейчас.
+    """
+    async with async_session() as session:
+        # Задачи прошлых запусков этого инстанса (тот же WORKER_ID) уже никто не ведёт —
+        # возвращаем/забираем сразу; чужие — только с истёкшей арендой
+        refunded_count, refunded_bananas = await refund_stuck_tasks(
+            session,
+            older_than_minutes=STARTUP_REFUND_MINUTES if startup else RESUME_LEASE_MINUTES,
+            worker=WORKER_RUN, previous_runs=f"{WORKER_ID}:"
+        )
+        tasks = await claim_resumable_tasks(
+            session, WORKER_RUN, lease_minutes=RESUME_LEASE_MINUTES, previous_runs=f"{WORKER_ID}:"
+        )
+    
+    if refunded_count:
+        print(f"💸 Возвращено {refunded_bananas} 🍌 за {refunded_count} незавершённых задач")
+    if tasks:
+        print(f"♻️ Продолжаю {len(tasks)} задач Kie" + (" после рестарта" if startup else " упавших инстансов"))
+    for task in tasks:
+        asyncio.create_task(resume_with_lease(bot, task))
+
+async def task_recovery_loop(bot: Bot):
+    """Старт + периодический проход: задачи упавших инстансов подбираются, когда истекла их аренда"""
+    startup = True
+    while True:
+        try:
+            await resume_generation_tasks(bot, startup=startup)
+            startup = False
+        except Exception as e:
+            print(f"⚠️ Ошибка продолжения задач: {e}")
+        await asyncio.sleep(RECOVERY_INTERVAL_MINUTES * 60)
+
+async def resume_with_lease(bot: Bot, task):
+    lease = keep_task_lease(task.id)
+    try:
+        await resume_generation_task(bot, task)
+    finally:
+        lease.cancel()
+
+async def resume_generation_task(bot: Bot, task):
+    """Ждёт одну задачу Kie по сохранённому taskId и доводит её до пользователя"""
+    params = json.loads(task.params or "{}")
+    use_pro_model = params.get("pro", False)
+    resolution = params.get("resolution", "1K")
+    prompt = params.get("prompt", "")
+    chat_id = task.chat_id or task.user_id
+    timeout = generation_queue.lanes[lane_for(use_pro_model, resolution)].timeout
+    trace = stage_timings.start(
+        task.user_id, "PRO" if use_pro_model else "Standard", resolution, len(params.get("image_urls", []))
+    )
+    
+    try:
+        with stage("engine"):
+            result_data = await asyncio.wait_for(
+                resume_kie_task(task.kie_task_id, params.get("kie_model"), resolution),
+                timeout=timeout
+            )
+    except asyncio.TimeoutError:
+        print(f"⌛ Задача {task.kie_task_id} не завершилась за {timeout:.0f}с после рестарта")
+        result_data = None
+    
+    try:
+        if result_data:
+            if params.get("delete_wait", True) and task.message_id:
+                try:
+                    await bot.delete_message(chat_id, task.message_id)
+                except:
+                    pass
+            
+            async with async_session() as session:
+                user = await get_user(session, task.user_id)
+                balance_left = await get_user_balance(session, task.user_id)
+            
+            await deliver_generation_result(
+                bot, chat_id, user, task.user_id, prompt, params.get("image_urls", []),
+                params.get("ratio", "1:1"), task.cost, use_pro_model, resolution,
+                result_data, balance_left
+            )
+            async with async_session() as session:
+                await finish_generation_task(session, task.id, "completed")
+            stage_timings.finish(trace, "resumed")
+            return
+    except Exception as e:
+        print(f"❌ Ошибка доставки задачи {task.kie_task_id}: {e}")
+    stage_timings.finish(trace, "resume_failed")
+    
+    # ❌ Kie не отдал результат — возвращаем бананы
+    async with async_session() as session:
+        await refund_generation(session, task.id)
+    
+    fail_text = (
+        "❌ <b>Ошибка генерации</b>\n\n"
+        "API не смог создать изображение.\n"
+        f"💰 {task.cost} 🍌 возвращены на баланс."
+    )
+    try:
+        await bot.edit_message_text(fail_text, chat_id=chat_id, message_id=task.message_id, parse_mode="HTML")
+    except:
+        try:
+            await bot.send_message(chat_id, fail_text, parse_mode="HTML")
+        except Exception as e:
+            print(f"⚠️ Не удалось уведомить {chat_id}: {e}")
@@ -0,0 +1,126 @@
+from sqlalchemy import inspect, text, BigInteger, DateTime, Integer, String, Text
+
+# ==============================================================================
+# ВЕРСИОННЫЕ МИГРАЦИИ СХЕМЫ (обновляют живую bot.db на месте)
+# ==============================================================================
+# create_all создаёт только недостающие таблицы. Всё, что меняет существующие
+# (колонки, индексы), — отдельным шагом с номером. Номер применённого шага
+# пишется в schema_migrations, при старте догоняются только новые.
+# Шаги идемпотентны: на свежей базе create_all уже всё создал — шаг просто отмечается.
+
+
+def _add_columns(sync_conn, table: str, columns: dict):
+    inspector = inspect(sync_conn)
+    if not inspector.has_table(table):
+        return
+    existing = {col["name"] for col in inspector.get_columns(table)}
+    for name, col_type in columns.items():
+        if name not in existing:
+            ddl_type = col_type.compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl_type}"))
+            print(f"🛠 БД: добавлена колонка {table}.{name}")
+
+
+def _create_index(sync_conn, name: str, table: str, columns: str):
+    sync_conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def m001_generation_task_resume(sync_conn):
+    """Поля продолжения задач Kie после рестарта"""
+    _add_columns(sync_conn, "generation_tasks", {
+        "kie_task_id": String(),
+        "params": Text(),
+        "chat_id": BigInteger(),
+        "message_id": Integer(),
+        "updated_at": DateTime(),
+    })
+
+
+def m002_hot_path_indexes(sync_conn):
+    """
+    get_dialog_context — история пользователя по дате;
+    is_user_premium / профиль — оплаченные покупки пользователя;
+    refund_stuck_tasks / get_resumable_tasks — задачи по статусу и возрасту.
+    """
+    _create_index(sync_conn, "ix_message_history_user_created", "message_history", "user_id, created_at")
+    _create_index(sync_conn, "ix_purchases_user_status_created", "purchases", "user_id, status, created_at")
+    _create_index(sync_conn, "ix_generation_tasks_status_created", "generation_tasks", "status, created_at")
+
+
+def m003_generation_task_claims(sync_conn):
+    """Аренда задач при продолжении — несколько инстансов на одной базе"""
+    _add_columns(sync_conn, "generation_tasks", {
+        "claimed_by": String(),
+        "claimed_until": DateTime(),
+    })
+
+
+def m004_resumable_tasks_index(sync_conn):
+    """
+    get_resumable_tasks — задачи 'submitted' с taskId Kie: status=? AND kie_task_id IS NOT NULL
+    идут диапазоном по одному индексу (status, created_at этого не даёт).
+    """
+    _create_index(sync_conn, "ix_generation_tasks_status_kie", "generation_tasks", "status, kie_task_id")
+
+
+def m005_message_history_sequence(sync_conn):
+    """
+    SQLite: message_history с AUTOINCREMENT. history_writer резервирует id блоками через
+    sqlite_sequence, и любая другая вставка (add_history, второй процесс) получает id
+    после зарезервированных, а не MAX(id)+1 поверх ещё не записанных строк.
+    Старая таблица перестраивается: новая → копия строк с их id → удаление старой.
+    """
+    if sync_conn.dialect.name != "sqlite" or not inspect(sync_conn).has_table("message_history"):
+        return
+    ddl = sync_conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message_history'"
+    )).scalar()
+    if "AUTOINCREMENT" in ddl.upper():
+        return
+    from app.models import MessageHistory
+
+    sync_conn.execute(text("DROP INDEX IF EXISTS ix_message_history_user_created"))
+    sync_conn.execute(text("ALTER TABLE message_history RENAME TO message_history_old"))
+    MessageHistory.__table__.create(sync_conn)
+    columns = ", ".join(col.name for col in MessageHistory.__table__.columns)
+    sync_conn.execute(text(f"INSERT INTO message_history ({columns}) SELECT {columns} FROM message_history_old"))
+    sync_conn.execute(text("DROP TABLE message_history_old"))
+    # Прошлая версия выдавала id из счётчика в памяти (MAX(id)+1+1000) — id, не успевшие
+    # записаться перед остановкой, могли уйти в кнопки: начинаем после них
+    sync_conn.execute(text(
+        "UPDATE sqlite_sequence SET seq = seq + 1000 WHERE name = 'message_history'"
+    ))
+
+
+MIGRATIONS = [
+    (1, m001_generation_task_resume),
+    (2, m002_hot_path_indexes),
+    (3, m003_generation_task_claims),
+    (4, m004_resumable_tasks_index),
+    (5, m005_message_history_sequence),
+]
+
+
+def current_version(sync_conn) -> int:
+    sync_conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, "
+        "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    ))
+    return sync_conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+
+
+def run_migrations(sync_conn) -> int:
+    """Применяет шаги новее текущей версии (в транзакции init_db). Возвращает версию схемы."""
+    version = current_version(sync_conn)
+    for number, step in MIGRATIONS:
+        if number <= version:
+            continue
+        step(sync_conn)
+        sync_conn.execute(
+            text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+            {"version": number, "name": step.__name__},
+        )
+        print(f"🛠 БД: миграция {number} ({step.__name__})")
+        version = number
+    return version
@@ -1,4 +1,4 @@
-from sqlalchemy import BigInteger, String, Integer, DateTime, func, Boolean, Text
+from sqlalchemy import BigInteger, String, Integer, DateTime, func, Boolean, Text, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from app.database import Base
 from datetime import datetime
@@ -31,6 +31,8 @@ class User(Base):
 # 2. Таблица Покупок
 class Purchase(Base):
     __tablename__ = "purchases"
+    # Индексы — те же, что создаёт миграция 2 (app/migrations.py)
+    __table_args__ = (Index("ix_purchases_user_status_created", "user_id", "status", "created_at"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
@@ -42,6 +44,12 @@ class Purchase(Base):
 # 3. Таблица Истории (Контекст + Галерея)
 class MessageHistory(Base):
     __tablename__ = "message_history"
+    # SQLite: AUTOINCREMENT — счётчик в sqlite_sequence, из него history_writer резервирует id
+    # (миграция 5 перестраивает старую таблицу)
+    __table_args__ = (
+        Index("ix_message_history_user_created", "user_id", "created_at"),
+        {"sqlite_autoincrement": True},
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
@@ -60,9 +68,25 @@ class MessageHistory(Base):
 # 4. Таблица Активных Задач (Страховка от сбоев)
 class GenerationTask(Base):
     __tablename__ = "generation_tasks"
+    __table_args__ = (
+        Index("ix_generation_tasks_status_created", "status", "created_at"),
+        Index("ix_generation_tasks_status_kie", "status", "kie_task_id"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     cost: Mapped[int] = mapped_column(Integer)
+    # processing → submitted (задача ушла в Kie) → completed / refunded
     status: Mapped[str] = mapped_column(String, default="processing")
-    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
\ No newline at end of file
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+    # Для продолжения после рестарта
+    kie_task_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    params: Mapped[str | None] = mapped_column(Text, nullable=True)          # JSON параметров генерации
+    chat_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)   # Куда отвечать
+    message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)   # Сообщение "⏳ Создаю..."
+    updated_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, onupdate=func.now())
+
+    # Аренда задачи инстансом бота при продолжении (claim_resumable_tasks)
+    claimed_by: Mapped[str | None] = mapped_column(String, nullable=True)
+    claimed_until: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
\ No newline at end of file
@@ -2,10 +2,6 @@ import os
 import asyncio
 import io
 import base64
-import requests
-import json
-import time
-from PIL import Image
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
@@ -13,6 +9,15 @@ from aiogram.types import BufferedInputFile
 from aiogram import Bot
 from pathlib import Path
 from app import config
+from app.services.kie_client import kie_client, parse_result_url
+from app.services.kie_poller import kie_poller
+from app.services.web_server import kie_callback_url
+from app.services.blob_store import blob_store
+from app.services.results import GenerationResult
+from app.services.resilience import ProviderBusyError
+from app.services.http_client import get_http_session
+from app.services.providers import ImageProvider, ProviderRouter, GenerationRequest
+from app.services.timings import stage
 
 # 1. Загрузка ключей
 env_path = Path(__file__).parent.parent.parent / '.env'
@@ -26,18 +31,61 @@ KIE_MODEL_EDIT = "google/nano-banana-edit"
 KIE_MODEL_GEN = "google/nano-banana"
 KIE_MODEL_PRO = "nano-banana-pro"
 
+# Настройки Google (тот же путь, что в google_nanana.py)
+GOOGLE_KEY = os.getenv("GOOGLE_API_KEY")
+GOOGLE_MODEL = "gemini-2.5-flash-image"
+_google_client = genai.Client(api_key=GOOGLE_KEY) if GOOGLE_KEY else None
+
 # ==============================================================================
-# 1. ДВИЖОК GOOGLE (ЗАГЛУШКА)
+# 1. ДВИЖОК GOOGLE (РЕЗЕРВНЫЙ)
 # ==============================================================================
 async def _run_google_async(bot: Bot, prompt: str, image_urls=None, aspect_ratio: str = "1:1", history: list = None):
-    print("⚠️ Запрос в Google пропущен (режим Kie Only).")
+    if not _google_client:
+        print("⚠️ Запрос в Google пропущен (нет GOOGLE_API_KEY).")
+        return None
+
+    parts = []
+    if image_urls:
+        if isinstance(image_urls, str): image_urls = [image_urls]
+        session = get_http_session()
+        for url in image_urls:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                mime = resp.headers.get("Content-Type", "image/jpeg").split(";")[0]
+                parts.append(types.Part.from_bytes(data=await resp.read(), mime_type=mime))
+    parts.append(prompt)
+
+    print(f"💎 [GOOGLE] Model: {GOOGLE_MODEL} | Ratio: {aspect_ratio} | Imgs: {len(parts) - 1}")
+    with stage("google_generate"):
+        response = await _google_client.aio.models.generate_content(
+            model=GOOGLE_MODEL,
+            contents=parts,
+            config=types.GenerateContentConfig(
+                response_modalities=["IMAGE"],
+                image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+            )
+        )
+
+    if response and response.candidates:
+        for part in response.candidates[0].content.parts:
+            if getattr(part, "inline_data", None) and part.inline_data.data:
+                image_data = part.inline_data.data
+                image_bytes = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+                blob_hash = await blob_store.put(image_bytes)
+                print("✨ Google: Успех!")
+                # Ссылки на оригинал у Google нет — дальше всё читается из blob store
+                return GenerationResult(blob_hash, None, "google_result.png")
+            if getattr(part, "text", None):
+                print(f"📄 Текст от модели: {part.text}")
+
+    print("❌ Google: изображение не найдено в ответе")
     return None
 
 # ==============================================================================
 # 2. ДВИЖОК KIE.AI (ОСНОВНОЙ)
 # ==============================================================================
 # 👇 ДОБАВИЛ АРГУМЕНТ resolution
-def _run_kie(prompt: str, image_urls=None, aspect_ratio: str = "1:1", use_pro: bool = False, history: list = None, resolution: str = "1K"):
+async def _run_kie(prompt: str, image_urls=None, aspect_ratio: str = "1:1", use_pro: bool = False, history: list = None, resolution: str = "1K", on_task_created=None):
     if not config.KIE_API_KEY:
         print("❌ KIE ключ не настроен")
         return None
@@ -93,47 +141,100 @@ def _run_kie(prompt: str, image_urls=None, aspect_ratio: str = "1:1", use_pro: b
         else:
             input_data["image_size"] = aspect_ratio
 
-    headers = {"Authorization": f"Bearer {config.KIE_API_KEY}", "Content-Type": "application/json"}
-    
     try:
-        resp = requests.post(f"{config.KIE_URL}/createTask", headers=headers, json={"model": model, "input": input_data})
-        if resp.status_code != 200:
-            print(f"❌ Kie Error: {resp.text}")
+        # Слот AIMD-лимитера — только на createTask: лимитер меряет его латентность,
+        # а ожидание результата (до 10 минут) держат воркеры полос, не слоты
+        async with kie_client.limiter.slot():
+            with stage("kie_create"):
+                task_id = await kie_client.create_task(model, input_data, callback_url=kie_callback_url())
+        if not task_id:
             return None
+        if on_task_created:
+            # Фиксируем taskId в БД до ожидания — после рестарта задачу можно подхватить
+            await on_task_created(task_id, model)
         
-        resp_json = resp.json()
-        if resp_json.get("code") != 200:
-             print(f"❌ Kie Logic Error: {resp_json.get('msg')}")
-             return None
-
-        task_id = resp_json["data"]["taskId"]
+        # Ждем колбэк от Kie (или результат страховочного поллера, до 10 минут)
+        with stage("kie_wait"):
+            data = await kie_poller.wait(task_id, model, resolution)
         
-        # Ждем до 10 минут
-        for _ in range(300): 
-            r = requests.get(f"{config.KIE_URL}/recordInfo", headers=headers, params={"taskId": task_id})
-            data = r.json()["data"]
-            
-            if data and data.get("state") == "success":
-                result_obj = json.loads(data["resultJson"])
-                url = result_obj.get("resultUrls", [])[0]
-                print(f"✨ Kie: Успех! (Task {task_id})")
-                
-                img_resp = requests.get(url)
-                # Возвращаем (файл, ссылка)
-                return BufferedInputFile(img_resp.content, filename=f"kie_{model}.png"), url
-            
-            elif data and data.get("state") == "fail":
-                print(f"❌ Kie Failed: {data.get('failMsg')}")
-                return None
-            time.sleep(2)
+        return await _collect_kie_result(task_id, model, data)
             
+    except ProviderBusyError:
+        # Пробрасываем наверх: пользователю — мгновенный ответ "занято"
+        raise
     except Exception as e:
         print(f"❌ Kie Exception: {e}")
     return None
 
+async def _collect_kie_result(task_id: str, model: str, data: dict | None):
+    """Ответ recordInfo → GenerationResult (оригинал в blob store) или None"""
+    if data and data.get("state") == "success":
+        url = parse_result_url(data)
+        print(f"✨ Kie: Успех! (Task {task_id})")
+        
+        # Стримим результат сразу на диск (один раз) — дальше download/edit/превью берут его оттуда
+        with stage("kie_download"):
+            blob_hash = await kie_client.download_to_store(url)
+        return GenerationResult(blob_hash, url, f"kie_{model}.png")
+    
+    elif data and data.get("state") == "fail":
+        print(f"❌ Kie Failed: {data.get('failMsg')}")
+    return None
+
+async def resume_kie_task(task_id: str, model: str, resolution: str = "1K"):
+    """
+    Дожидается задачи, созданной до рестарта: taskId уже есть,
+    повторно в Kie не отправляем — только поллер/колбэк и скачивание.
+    """
+    try:
+        with stage("kie_wait"):
+            data = await kie_poller.wait(task_id, model, resolution)
+        return await _collect_kie_result(task_id, model, data)
+    except Exception as e:
+        print(f"❌ Kie Resume Exception ({task_id}): {e}")
+    return None
+
 # ==============================================================================
-# 3. ГЛАВНЫЙ РОУТЕР
+# 3. ПРОВАЙДЕРЫ + ГЛАВНЫЙ РОУТЕР
 # ==============================================================================
+class KieProvider(ImageProvider):
+    name = "kie"
+
+    def supports(self, req: GenerationRequest) -> bool:
+        return bool(config.KIE_API_KEY)
+
+    async def _generate(self, req: GenerationRequest):
+        return await _run_kie(req.prompt, req.image_urls, req.aspect_ratio, req.use_pro, req.history, req.resolution,
+                             on_task_created=req.on_task_created)
+
+
+class GoogleProvider(ImageProvider):
+    name = "google"
+
+    def supports(self, req: GenerationRequest) -> bool:
+        # gemini-2.5-flash-image не умеет PRO-разрешения — только Standard
+        return _google_client is not None and not req.use_pro
+
+    async def _generate(self, req: GenerationRequest):
+        return await _run_google_async(None, req.prompt, req.image_urls, req.aspect_ratio, req.history)
+
+
+engine_router = ProviderRouter([
+    # Один breaker на Kie: тот же, что гейтит createTask в клиенте
+    KieProvider(cost=float(os.getenv("KIE_COST", "1.0")), breaker=kie_client.breaker),
+    GoogleProvider(cost=float(os.getenv("GOOGLE_COST", "1.5"))),
+])
+
 # 👇 ДОБАВИЛ resolution В АРГУМЕНТЫ
-async def generate_image(bot: Bot, prompt: str, image_urls: list = None, is_premium: bool = False, aspect_ratio: str = "1:1", use_pro_model: bool = False, history: list = None, resolution: str = "1K"):
-    return await asyncio.to_thread(_run_kie, prompt, image_urls, aspect_ratio, use_pro_model, history, resolution)
\ No newline at end of file
+async def generate_image(bot: Bot, prompt: str, image_urls: list = None, is_premium: bool = False, aspect_ratio: str = "1:1", use_pro_model: bool = False, history: list = None, resolution: str = "1K", on_task_created=None):
+    # Роутер выбирает провайдера по здоровью, p95 и цене; при медленном ответе — хедж во второй
+    req = GenerationRequest(
+        prompt=prompt,
+        image_urls=image_urls or [],
+        aspect_ratio=aspect_ratio,
+        use_pro=use_pro_model,
+        resolution=resolution,
+        history=history,
+        on_task_created=on_task_created,
+    )
+    return await engine_router.generate(req)
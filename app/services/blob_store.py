@@ -0,0 +1,198 @@
+import os
+import asyncio
+import hashlib
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator
+import aiofiles
+
+# ==============================================================================
+# ЛОКАЛЬНОЕ ХРАНИЛИЩЕ РЕЗУЛЬТАТОВ (ключ — sha256 содержимого, LRU по байтам)
+# ==============================================================================
+BLOB_STORE_DIR = Path(os.getenv("BLOB_STORE_DIR", "./media/blobs"))
+BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", str(2 * 1024 ** 3)))  # 2 ГБ
+# Временные файлы для провайдеров (коллажи, подготовленные фото): живут TTL с последнего обращения
+TEMP_STORE_DIR = Path(os.getenv("TEMP_STORE_DIR", "./media/tmp"))
+TEMP_STORE_MAX_BYTES = int(os.getenv("TEMP_STORE_MAX_BYTES", str(512 * 1024 ** 2)))  # 512 МБ
+TEMP_STORE_TTL = int(os.getenv("TEMP_STORE_TTL", str(24 * 3600)))
+TEMP_CLEANUP_INTERVAL = int(os.getenv("TEMP_CLEANUP_INTERVAL", "600"))
+
+
+class BlobStore:
+    """
+    Каждый результат пишется на диск один раз: media/blobs/ab/abcdef...
+    Порядок LRU хранится в памяти и восстанавливается по atime при старте.
+    """
+
+    def __init__(self, root: Path = BLOB_STORE_DIR, max_bytes: int = BLOB_STORE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+        self._loaded = False
+
+    # --- ИНДЕКС ---
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        for path in self._incoming.glob("*.tmp"):
+            path.unlink(missing_ok=True)  # недокачанные потоки после сбоя
+        entries = []
+        for path in self.root.glob("??/*"):
+            if path.name.endswith(".tmp"):
+                path.unlink(missing_ok=True)  # недописанный файл после сбоя
+                continue
+            st = path.stat()
+            entries.append((st.st_atime, path.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total += size
+        self._loaded = True
+
+    def _path(self, blob_hash: str) -> Path:
+        return self.root / blob_hash[:2] / blob_hash
+
+    @property
+    def _incoming(self) -> Path:
+        return self.root / "incoming"
+
+    def _touch(self, blob_hash: str):
+        self._index.move_to_end(blob_hash)
+        try:
+            os.utime(self._path(blob_hash))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._index) > 1:
+            old_hash, size = self._index.popitem(last=False)
+            self._total -= size
+            self._path(old_hash).unlink(missing_ok=True)
+            print(f"🧹 Blob store: вытеснен {old_hash[:12]} ({size / 1024 / 1024:.1f} MB)")
+
+    # --- ЗАПИСЬ / ЧТЕНИЕ ---
+    def _write_sync(self, data: bytes) -> str:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self._path(blob_hash)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._incoming.mkdir(parents=True, exist_ok=True)
+            # Свой временный файл на каждый вызов: два put() одного содержимого не пишут в один tmp
+            tmp = self._incoming / f"{uuid.uuid4().hex}.tmp"
+            try:
+                tmp.write_bytes(data)
+                os.replace(tmp, path)
+            finally:
+                tmp.unlink(missing_ok=True)
+        return blob_hash
+
+    async def put(self, data: bytes) -> str:
+        """Сохраняет байты (если такого содержимого ещё нет), возвращает хэш"""
+        self._ensure_loaded()
+        blob_hash = await asyncio.to_thread(self._write_sync, data)
+        if blob_hash in self._index:
+            self._touch(blob_hash)
+        else:
+            self._index[blob_hash] = len(data)
+            self._total += len(data)
+            self._evict()
+        return blob_hash
+
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> str:
+        """
+        Пишет поток чанков прямо на диск, считая хэш на лету.
+        В памяти одновременно лежит только один чанк, а не весь файл.
+        """
+        self._ensure_loaded()
+        self._incoming.mkdir(parents=True, exist_ok=True)
+        tmp = self._incoming / f"{uuid.uuid4().hex}.tmp"
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(tmp, "wb") as f:
+                async for chunk in chunks:
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+        blob_hash = hasher.hexdigest()
+        path = self._path(blob_hash)
+        if blob_hash in self._index and path.exists():
+            tmp.unlink(missing_ok=True)
+            self._touch(blob_hash)
+            return blob_hash
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, path)
+        self._index[blob_hash] = size
+        self._total += size
+        self._evict()
+        return blob_hash
+
+    def path(self, blob_hash: str | None) -> Path | None:
+        """Путь к файлу на диске (None, если вытеснен или не было)"""
+        if not blob_hash:
+            return None
+        self._ensure_loaded()
+        if blob_hash not in self._index:
+            return None
+        path = self._path(blob_hash)
+        if not path.exists():
+            self._total -= self._index.pop(blob_hash)
+            return None
+        self._touch(blob_hash)
+        return path
+
+    def delete(self, blob_hash: str):
+        self._ensure_loaded()
+        if blob_hash in self._index:
+            self._total -= self._index.pop(blob_hash)
+        self._path(blob_hash).unlink(missing_ok=True)
+
+    def purge_older_than(self, max_age: float) -> int:
+        """Удаляет файлы, к которым не обращались max_age секунд (mtime обновляет _touch)"""
+        self._ensure_loaded()
+        cutoff = time.time() - max_age
+        removed = 0
+        for blob_hash in list(self._index):
+            try:
+                if self._path(blob_hash).stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                pass
+            self.delete(blob_hash)
+            removed += 1
+        return removed
+
+    async def get(self, blob_hash: str | None) -> bytes | None:
+        path = self.path(blob_hash)
+        if not path:
+            return None
+        return await asyncio.to_thread(path.read_bytes)
+
+    def stats(self) -> dict:
+        self._ensure_loaded()
+        return {"count": len(self._index), "bytes": self._total, "max_bytes": self.max_bytes}
+
+
+blob_store = BlobStore()
+temp_store = BlobStore(root=TEMP_STORE_DIR, max_bytes=TEMP_STORE_MAX_BYTES)
+
+
+async def temp_cleanup_loop(ttl: int = TEMP_STORE_TTL, interval: int = TEMP_CLEANUP_INTERVAL):
+    """Фоновая чистка временных файлов по TTL"""
+    while True:
+        try:
+            # Прямо в loop: индекс store не потокобезопасен, а stat() сотни файлов — миллисекунды
+            removed = temp_store.purge_older_than(ttl)
+            if removed:
+                print(f"🧹 Временные файлы: удалено {removed} (старше {ttl // 3600} ч)")
+        except Exception as e:
+            print(f"⚠️ Ошибка чистки временных файлов: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,146 @@
+import os
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+# ==============================================================================
+# СКЛЕЙКА ОДИНАКОВЫХ ГЕНЕРАЦИЙ (двойные нажатия pf_start / reroll_)
+# ==============================================================================
+# Склеиваются только запросы, пока такой же в очереди или в работе: готовый результат
+# уже у пользователя, повторный reroll после него — осознанная новая генерация.
+# Политика для дублей:
+#   "drop"  — дубль не списывается и не доставляется (юзер получает тост "уже в работе",
+#             картинку доставит ведущий запрос в тот же чат)
+#   "share" — дубль списывается как обычная генерация и получает ту же картинку (одна задача Kie,
+#             taskId которой записывается и в задачу дубля — после рестарта её тоже продолжат)
+COALESCE_POLICY = os.getenv("COALESCE_POLICY", "drop")
+# Сколько держим запись, если задача так и не стартовала (застряла в очереди)
+COALESCE_MAX_PENDING_SEC = 900.0
+
+
+def build_generation_params(prompt: str, image_urls, aspect_ratio: str, cost: int, use_pro_model: bool, resolution: str) -> dict:
+    """Параметры генерации — те же, что сохраняются в meta_data истории"""
+    return {
+        "prompt": prompt,
+        "image_urls": image_urls,
+        "ratio": aspect_ratio,
+        "cost": cost,
+        "pro": use_pro_model,
+        "resolution": resolution
+    }
+
+
+def generation_key(user_id: int, params: dict) -> str:
+    """
+    Ключ склейки: промпт + картинки + формат + разрешение + модель.
+    user_id входит в ключ — склеиваем только повторные нажатия одного человека.
+    """
+    material = {k: params.get(k) for k in ("prompt", "image_urls", "ratio", "resolution", "pro")}
+    material["user_id"] = user_id
+    raw = json.dumps(material, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+@dataclass
+class _Entry:
+    created: float
+    future: asyncio.Future | None = None
+    task: tuple | None = None                           # (taskId Kie, модель) ведущего
+    listeners: list = field(default_factory=list)       # on_task_created дублей, ждущих taskId
+
+
+class RequestCoalescer:
+    def __init__(self):
+        self._entries: dict[str, _Entry] = {}
+        self.coalesced = 0
+
+    def _alive(self, entry: _Entry, now: float) -> bool:
+        if entry.future is None:
+            return now - entry.created < COALESCE_MAX_PENDING_SEC   # ещё в очереди
+        return not entry.future.done()                               # в работе
+
+    def _cleanup(self):
+        now = time.monotonic()
+        self._entries = {k: e for k, e in self._entries.items() if self._alive(e, now)}
+
+    def claim(self, key: str) -> _Entry | None:
+        """
+        Регистрирует запрос и возвращает запись-владение.
+        None — такой же уже в очереди или в работе, вызывающий — дубль.
+        """
+        self._cleanup()
+        if key in self._entries:
+            self.coalesced += 1
+            return None
+        entry = self._entries[key] = _Entry(created=time.monotonic())
+        return entry
+
+    def release(self, key: str, entry: _Entry | None):
+        """
+        Снимает запись (задача не запустилась: нет баланса, очередь отказала и т.п.).
+        Снимает только владелец: release дубля (entry=None) запись ведущего не трогает.
+        """
+        if entry is not None and entry.future is None:
+            self._drop(key, entry)
+
+    def _drop(self, key: str, entry: _Entry):
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+
+    @staticmethod
+    async def _notify(listener: Callable[..., Awaitable], task: tuple):
+        try:
+            await listener(*task)
+        except Exception as e:
+            # Ошибка записи у дубля не должна ронять генерацию ведущего
+            print(f"⚠️ Склейка: не удалось передать задачу {task[0]} дублю: {e}")
+
+    async def run(self, key: str, factory: Callable[[Callable], Awaitable], on_task_created=None):
+        """
+        Выполняет генерацию один раз на ключ; дубли ждут тот же результат.
+        factory получает колбэк on_task_created: taskId задачи ведущего уходит и его
+        on_task_created, и on_task_created каждого дубля (их задачи продолжатся после рестарта).
+        """
+        entry = self._entries.get(key)
+        if entry and entry.future is not None:
+            if on_task_created:
+                if entry.task:
+                    await self._notify(on_task_created, entry.task)
+                else:
+                    entry.listeners.append(on_task_created)
+            try:
+                return await asyncio.shield(entry.future)
+            finally:
+                # Дубль ушёл по таймауту — его задачу уже закрыли, taskId ей не нужен
+                if on_task_created in entry.listeners:
+                    entry.listeners.remove(on_task_created)
+
+        if entry is None:
+            entry = self._entries[key] = _Entry(created=time.monotonic())
+        entry.future = asyncio.get_running_loop().create_future()
+
+        async def task_created(*task):
+            entry.task = task
+            if on_task_created:
+                await on_task_created(*task)
+            listeners, entry.listeners = entry.listeners, []
+            for listener in listeners:
+                await self._notify(listener, task)
+
+        try:
+            result = await factory(task_created)
+        except BaseException:
+            # Ведущий упал/отменён — дубли получают None (обычный путь с возвратом)
+            entry.future.set_result(None)
+            self._drop(key, entry)
+            raise
+        # Готово — следующий такой же запрос уже новая генерация
+        entry.future.set_result(result)
+        self._drop(key, entry)
+        return result
+
+
+generation_coalescer = RequestCoalescer()
@@ -0,0 +1,193 @@
+import os
+import asyncio
+from collections import OrderedDict
+from sqlalchemy import insert, text
+from sqlalchemy.exc import IntegrityError
+from app.database import async_session, engine
+from app.models import MessageHistory
+
+# ==============================================================================
+# ОТЛОЖЕННАЯ ЗАПИСЬ ИСТОРИИ (write-behind: пачками по размеру или по таймеру)
+# ==============================================================================
+HISTORY_FLUSH_ROWS = int(os.getenv("HISTORY_FLUSH_ROWS", "200"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+# Потолок буфера: БД не успевает или лежит — add() сначала ждёт запись, потом пишет строку сам
+HISTORY_MAX_PENDING = int(os.getenv("HISTORY_MAX_PENDING", "5000"))
+# Сколько id резервируется за один запрос к БД
+HISTORY_ID_BLOCK = int(os.getenv("HISTORY_ID_BLOCK", "100"))
+
+
+class HistoryWriter:
+    """
+    add() сразу отдаёт id записи (он нужен для кнопок результата), а сама строка
+    ложится в буфер и уходит в БД многострочным INSERT вместе с соседними.
+    id резервируются блоками в самой БД: PostgreSQL — nextval из sequence таблицы,
+    SQLite — сдвиг счётчика AUTOINCREMENT в sqlite_sequence (миграция 5). Любая другая
+    вставка (add_history, второй процесс) получает id после зарезервированных.
+    Пока строка в буфере, её видят get_history_message_by_id и get_dialog_context.
+    Пачку с "битой" строкой (IntegrityError) пишем построчно, битые строки — в dead letter (лог).
+    """
+
+    def __init__(self, flush_rows: int = HISTORY_FLUSH_ROWS, flush_interval: float = HISTORY_FLUSH_INTERVAL,
+                 max_pending: int = HISTORY_MAX_PENDING):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, flush_rows)
+        self._pending: OrderedDict[int, dict] = OrderedDict()  # id → строка
+        self._free_ids: list[int] = []
+        self._id_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.rows_written = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.dead_letters = 0
+        self.direct_writes = 0
+
+    async def _reserve_ids(self, count: int) -> list[int]:
+        async with async_session() as session:
+            if engine.dialect.name == "postgresql":
+                result = await session.execute(
+                    text("SELECT nextval(pg_get_serial_sequence('message_history', 'id')) FROM generate_series(1, :n)"),
+                    {"n": count},
+                )
+                return [row[0] for row in result]
+            # Строки счётчика нет, пока в таблицу ничего не вставляли
+            await session.execute(text(
+                "INSERT INTO sqlite_sequence (name, seq) "
+                "SELECT 'message_history', COALESCE(MAX(id), 0) FROM message_history "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'message_history')"
+            ))
+            # Запись держит блокировку до коммита — второй процесс получит следующий блок
+            await session.execute(
+                text("UPDATE sqlite_sequence SET seq = seq + :n WHERE name = 'message_history'"),
+                {"n": count},
+            )
+            last = await session.scalar(text("SELECT seq FROM sqlite_sequence WHERE name = 'message_history'"))
+            await session.commit()
+        return list(range(last - count + 1, last + 1))
+
+    async def _next_id(self) -> int:
+        async with self._id_lock:
+            if not self._free_ids:
+                self._free_ids = await self._reserve_ids(HISTORY_ID_BLOCK)
+            return self._free_ids.pop(0)
+
+    async def add(self, user_id: int, role: str, content: str, has_image: bool = False,
+                  file_id: str = None, image_url: str = None) -> int:
+        """
+        Ставит запись в буфер и возвращает её id (как add_history(...).id).
+        Буфер полон — ждём запись пачки; не помогло (БД лежит) — пишем строку напрямую,
+        ошибка уходит вызывающему, как было до буфера.
+        """
+        msg_id = await self._next_id()
+        row = {
+            "id": msg_id, "user_id": user_id, "role": role, "content": content,
+            "has_image": has_image, "file_id": file_id, "image_url": image_url,
+        }
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+            if len(self._pending) >= self.max_pending:
+                await self._insert([row])
+                self.direct_writes += 1
+                return msg_id
+        self._pending[msg_id] = row
+        if len(self._pending) >= self.flush_rows:
+            self._wake.set()
+        return msg_id
+
+    def get(self, msg_id: int) -> MessageHistory | None:
+        """Запись из буфера (ещё не в БД) — несохранённый объект с теми же полями"""
+        row = self._pending.get(msg_id)
+        return MessageHistory(**row) if row else None
+
+    def for_user(self, user_id: int) -> list[MessageHistory]:
+        """Записи пользователя из буфера, от старых к новым"""
+        return [MessageHistory(**row) for row in self._pending.values() if row["user_id"] == user_id]
+
+    @staticmethod
+    async def _insert(rows: list[dict]):
+        async with async_session() as session:
+            # Список словарей → многострочные INSERT (insertmanyvalues), один коммит
+            await session.execute(insert(MessageHistory), rows)
+            await session.commit()
+
+    async def flush(self):
+        """
+        Пишет всё из буфера одной транзакцией. Сбой связи/БД — строки остаются до следующей попытки;
+        IntegrityError — пачка пишется построчно, чтобы одна битая строка не держала остальные.
+        """
+        async with self._flush_lock:
+            rows = list(self._pending.values())
+            if not rows:
+                return
+            try:
+                await self._insert(rows)
+            except IntegrityError as e:
+                self.failed_batches += 1
+                print(f"⚠️ История: пачка из {len(rows)} строк отклонена ({e.orig}), пишу построчно")
+                await self._flush_one_by_one(rows)
+                return
+            except Exception as e:
+                self.failed_batches += 1
+                print(f"⚠️ История: не удалось записать {len(rows)} строк, повторю: {e}")
+                return
+            for row in rows:
+                self._pending.pop(row["id"], None)
+            self.rows_written += len(rows)
+            self.batches += 1
+
+    async def _flush_one_by_one(self, rows: list[dict]):
+        """Построчно: битые строки — в dead letter (лог) и из буфера; сбой связи — остаток ждёт следующей попытки"""
+        for row in rows:
+            try:
+                await self._insert([row])
+            except IntegrityError as e:
+                self.dead_letters += 1
+                print(f"☠️ История: строка {row['id']} (user {row['user_id']}, {row['role']}) отброшена: {e.orig}")
+            except Exception as e:
+                print(f"⚠️ История: построчная запись прервана, повторю: {e}")
+                return
+            else:
+                self.rows_written += 1
+            self._pending.pop(row["id"], None)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            # shield: stop() не оборвёт запись посреди коммита
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает таймер и дописывает остаток буфера"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "rows": self.rows_written,
+            "batches": self.batches,
+            "failed": self.failed_batches,
+            "dead": self.dead_letters,
+            "direct": self.direct_writes,
+            "avg_batch": self.rows_written / self.batches if self.batches else 0.0,
+        }
+
+
+history_writer = HistoryWriter()
@@ -0,0 +1,35 @@
+import os
+import aiohttp
+
+# ==============================================================================
+# ОБЩИЙ HTTP-ПУЛ (keep-alive + лимиты на хост)
+# ==============================================================================
+# Одна сессия на весь процесс: соединения переиспользуются между генерациями,
+# а не открываются заново на каждый запрос.
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "200"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "50"))
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "30"))
+
+_session: aiohttp.ClientSession | None = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую aiohttp-сессию (создаёт при первом вызове)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_SEC,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_http_session():
+    """Закрывает пул (вызывается при остановке бота)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,147 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+# ==============================================================================
+# ОПЕРАЦИИ PILLOW (выполняются в процессах image_pool — модуль без aiogram/БД)
+# ==============================================================================
+# Функции верхнего уровня (их можно передать в процесс), на входе — пути и байты, не объекты aiogram.
+
+# Telegram всё равно пережимает фото в JPEG до 2560px по большей стороне — больше слать незачем
+PREVIEW_MAX_SIDE = 2560
+PREVIEW_TARGET_BYTES = 1536 * 1024
+PREVIEW_MAX_QUALITY = 90
+PREVIEW_MIN_QUALITY = 60
+
+
+def _encode(img: Image.Image, fmt: str, quality: int) -> bytes:
+    output = io.BytesIO()
+    if fmt == "webp":
+        img.save(output, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def encode_preview(
+    file_path,
+    max_side: int = PREVIEW_MAX_SIDE,
+    target_bytes: int = PREVIEW_TARGET_BYTES,
+    fmt: str = "jpg",
+) -> bytes:
+    """
+    Превью результата для send_photo: не больше max_side, JPEG/WebP,
+    качество — максимальное, при котором файл укладывается в target_bytes.
+    Картинка декодируется и уменьшается один раз, перебирается только кодирование.
+    """
+    with Image.open(file_path) as img:
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            # Прозрачность — на белый фон, как её покажет Telegram
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba)
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        smallest = _encode(img, fmt, PREVIEW_MAX_QUALITY)
+        if len(smallest) <= target_bytes:
+            return smallest
+
+        # Бинарный поиск по качеству: 3-4 кодирования вместо перебора
+        best = None
+        low, high = PREVIEW_MIN_QUALITY, PREVIEW_MAX_QUALITY - 1
+        while low <= high:
+            quality = (low + high) // 2
+            data = _encode(img, fmt, quality)
+            if len(data) <= target_bytes:
+                best, low = data, quality + 1
+            else:
+                high = quality - 1
+            if len(data) < len(smallest):
+                smallest = data
+        # Даже на минимальном качестве не влезли — отдаём самый маленький вариант
+        return best or smallest
+
+
+COLLAGE_QUALITY = 92
+
+
+def collage_grid(count: int) -> tuple[int, int]:
+    """
+    2 фото: горизонтально [img1][img2]
+    3-4 фото: сетка 2x2
+    """
+    if count == 2:
+        return 2, 1
+    if 2 < count <= 4:
+        return 2, 2
+    raise ValueError("Collage needs 2-4 images")
+
+
+def _load_for_cell(data: bytes, cell_w: int, cell_h: int) -> Image.Image:
+    """Открывает фото сразу в масштабе ячейки: draft для JPEG, reduce для остального"""
+    img = Image.open(io.BytesIO(data))
+    # JPEG-декодер сам отдаёт 1/2..1/8 — 12MP фото не раскрывается в полный размер.
+    # Квадрат по большей стороне: после поворота по EXIF ширина и высота могут поменяться.
+    side = max(cell_w, cell_h)
+    img.draft("RGB", (side, side))
+    img = ImageOps.exif_transpose(img)
+    factor = min(img.width // cell_w, img.height // cell_h)
+    if factor >= 2:
+        img = img.reduce(factor)
+    img.thumbnail((cell_w, cell_h), Image.Resampling.LANCZOS)
+    return img
+
+
+def build_collage(images_data: list[bytes], max_size: int = 1024, quality: int = COLLAGE_QUALITY) -> bytes:
+    """
+    Коллаж за один проход: каждое фото декодируется уже уменьшенным,
+    сразу ложится на холст, холст один раз кодируется в JPEG.
+    """
+    cols, rows = collage_grid(len(images_data))
+    cell_w = max_size // cols
+    cell_h = max_size // rows
+
+    canvas = Image.new('RGB', (max_size, max_size), 'white')
+
+    for idx, data in enumerate(images_data):
+        img = _load_for_cell(data, cell_w, cell_h)
+
+        col = idx % cols
+        row = idx // cols
+        x = col * cell_w + (cell_w - img.width) // 2
+        y = row * cell_h + (cell_h - img.height) // 2
+
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            rgba = img.convert("RGBA")
+            canvas.paste(rgba.convert("RGB"), (x, y), rgba)
+        else:
+            canvas.paste(img.convert("RGB") if img.mode != "RGB" else img, (x, y))
+        img.close()
+
+    output = io.BytesIO()
+    canvas.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def prepare_image(data: bytes | str, max_side: int, fmt: str = "jpg", quality: int = 90) -> bytes:
+    """Поворот по EXIF, уменьшение до max_side, JPEG/WebP без метаданных (data — байты или путь к файлу)"""
+    with Image.open(io.BytesIO(data) if isinstance(data, bytes) else data) as img:
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8) — в разы быстрее
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        return _encode(img, fmt, quality)
+
+
+def ping() -> int:
+    """Пустая задача — прогрев процессов пула при старте"""
+    return os.getpid()
@@ -0,0 +1,112 @@
+import os
+import asyncio
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.services import image_ops
+
+# ==============================================================================
+# ПУЛ ПРОЦЕССОВ ДЛЯ PILLOW (превью, коллажи, подготовка фото — не на event loop)
+# ==============================================================================
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", str(min(4, os.cpu_count() or 2))))
+# Сколько задач может быть в пуле (в работе + в ожидании); остальные ждут слот в asyncio
+IMAGE_POOL_MAX_PENDING = int(os.getenv("IMAGE_POOL_MAX_PENDING", "32"))
+IMAGE_POOL_TIMEOUT = float(os.getenv("IMAGE_POOL_TIMEOUT", "60"))
+# Перезапуск воркера после N задач — страховка от роста памяти в Pillow
+IMAGE_POOL_TASKS_PER_CHILD = int(os.getenv("IMAGE_POOL_TASKS_PER_CHILD", "500"))
+
+
+class ImagePool:
+    """
+    Ограниченная очередь поверх ProcessPoolExecutor.
+    Воркеры стартуют через spawn (fork посреди asyncio и потоков aiosqlite небезопасен),
+    задачи — функции из image_ops, которые не трогают aiogram и БД.
+    Большие файлы передаём путём на диске, а не байтами — между процессами ничего не копируется.
+    workers=0 — выполнять в потоке (для отладки и сравнения в бенчмарке).
+    """
+
+    def __init__(self, workers: int = IMAGE_POOL_WORKERS, max_pending: int = IMAGE_POOL_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._busy_total = 0.0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=IMAGE_POOL_TASKS_PER_CHILD,
+            )
+        return self._executor
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    async def start(self):
+        """Поднимает процессы заранее, чтобы первая генерация не ждала spawn"""
+        if self.workers <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        await asyncio.gather(*(loop.run_in_executor(pool, image_ops.ping) for _ in range(self.workers)))
+        print(f"🖼 Пул изображений: {self.workers} процессов")
+
+    async def run(self, fn, *args):
+        """Выполняет fn(*args) в пуле; fn — функция верхнего уровня из image_ops"""
+        self.waiting += 1
+        try:
+            await self._semaphore().acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                call = asyncio.to_thread(fn, *args)
+            else:
+                call = asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+            result = await asyncio.wait_for(call, IMAGE_POOL_TIMEOUT)
+            self.completed += 1
+            return result
+        except BrokenProcessPool:
+            # Воркер упал (OOM на огромной картинке) — пересоздаём пул для следующих задач
+            print("💥 Пул изображений сломан, пересоздаю")
+            self._executor = None
+            self.failed += 1
+            raise
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self._busy_total += time.perf_counter() - started
+            self._semaphore().release()
+
+    def stats(self) -> dict:
+        done = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_ms": self._busy_total / done * 1000 if done else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+image_pool = ImagePool()
@@ -0,0 +1,136 @@
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from app.services.http_client import get_http_session
+from app.services.image_pool import image_pool
+from app.services.image_ops import prepare_image
+from app.services.blob_store import blob_store, temp_store
+from app.services.web_server import media_url, parse_media_url, PUBLIC_BASE_URL
+
+# ==============================================================================
+# ПОДГОТОВКА ВХОДНЫХ ФОТО ДЛЯ KIE (EXIF → уменьшение → перекодирование → кэш)
+# ==============================================================================
+# Больше этого модель всё равно не использует — лишние пиксели только грузятся и считаются
+INPUT_MAX_SIDE = {
+    "standard": int(os.getenv("PREP_MAX_SIDE_STANDARD", "1536")),
+    "1K": int(os.getenv("PREP_MAX_SIDE_1K", "1536")),
+    "2K": int(os.getenv("PREP_MAX_SIDE_2K", "2048")),
+    "4K": int(os.getenv("PREP_MAX_SIDE_4K", "3072")),
+}
+PREP_FORMAT = os.getenv("PREP_FORMAT", "jpg")  # jpg | webp
+PREP_QUALITY = int(os.getenv("PREP_QUALITY", "90"))
+PREP_CACHE_SIZE = int(os.getenv("PREP_CACHE_SIZE", "2000"))
+PREP_MAX_INPUT_BYTES = 20 * 1024 * 1024  # Telegram Bot API больше не отдаёт
+
+
+def max_side_for(use_pro: bool, resolution: str) -> int:
+    if not use_pro:
+        return INPUT_MAX_SIDE["standard"]
+    return INPUT_MAX_SIDE.get(resolution, INPUT_MAX_SIDE["1K"])
+
+
+class InputPreparer:
+    """
+    Пул процессов + кэш: одно и то же фото (reroll, повторный запуск)
+    готовится один раз; параллельные запросы на одно фото ждут одну задачу.
+    """
+
+    def __init__(self, cache_size: int = PREP_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, str] = OrderedDict()  # ключ → хэш в blob store
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @staticmethod
+    def _key(source: str, max_side: int) -> str:
+        # file_path Telegram уникален для файла — ссылка годится как ключ (для оригиналов — хэш blob)
+        return hashlib.sha256(f"{source}|{max_side}|{PREP_FORMAT}|{PREP_QUALITY}".encode()).hexdigest()
+
+    async def _download(self, url: str) -> bytes:
+        session = get_http_session()
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.content.read(PREP_MAX_INPUT_BYTES + 1)
+        if len(data) > PREP_MAX_INPUT_BYTES:
+            raise ValueError("input too large")
+        return data
+
+    async def _prepare_one(self, url: str, max_side: int, local_path: Path = None) -> str:
+        if local_path:
+            # Оригинал уже на диске — воркер пула читает файл сам, без скачивания и пересылки байтов
+            source, size = str(local_path), local_path.stat().st_size
+        else:
+            source = await self._download(url)
+            size = len(source)
+        prepared = await image_pool.run(prepare_image, source, max_side, PREP_FORMAT, PREP_QUALITY)
+        self.bytes_in += size
+        self.bytes_out += len(prepared)
+        return await temp_store.put(prepared)
+
+    async def prepare(self, url: str, max_side: int, local_path: Path = None, cache_id: str = None) -> str | None:
+        """
+        Локальная ссылка на подготовленное фото; None — отдаём Kie оригинал.
+        local_path — файл уже у нас (оригинал результата), cache_id — ключ кэша вместо ссылки.
+        """
+        key = self._key(cache_id or url, max_side)
+        blob_hash = self._cache.get(key)
+        if blob_hash and temp_store.path(blob_hash):
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return media_url(blob_hash, PREP_FORMAT)
+
+        future = self._in_flight.get(key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self._prepare_one(url, max_side, local_path))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        try:
+            blob_hash = await asyncio.shield(future)
+        except Exception as e:
+            print(f"⚠️ Подготовка фото не удалась, шлём оригинал: {e}")
+            return None
+
+        self._cache[key] = blob_hash
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return media_url(blob_hash, PREP_FORMAT)
+
+    async def prepare_all(self, urls: list, use_pro: bool, resolution: str) -> list:
+        """Готовит все фото параллельно; при любой ошибке конкретное фото остаётся как было"""
+        if not urls or not PUBLIC_BASE_URL:
+            # Без публичного адреса Kie до нас не достучится — остаёмся на ссылках Telegram
+            return list(urls or [])
+        max_side = max_side_for(use_pro, resolution)
+        prepared = await asyncio.gather(*(self._prepare_any(url, max_side) for url in urls))
+        return [local or url for local, url in zip(prepared, urls)]
+
+    async def _prepare_any(self, url: str, max_side: int) -> str | None:
+        media = parse_media_url(url)
+        if media is None:
+            return await self.prepare(url, max_side)
+        blob_hash = media[0]
+        if temp_store.path(blob_hash):
+            # Коллаж или уже подготовленное фото — в нужном виде
+            return None
+        original = blob_store.path(blob_hash)
+        if original:
+            # Оригинал результата (правка): 4K PNG без потерь → уменьшенная копия во временном хранилище
+            return await self.prepare(url, max_side, local_path=original, cache_id=f"blob:{blob_hash}")
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "in_flight": len(self._in_flight),
+            "saved_mb": (self.bytes_in - self.bytes_out) / 1024 / 1024,
+        }
+
+
+input_preparer = InputPreparer()
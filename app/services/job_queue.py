@@ -0,0 +1,223 @@
+import os
+import asyncio
+import itertools
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+# ==============================================================================
+# ОЧЕРЕДЬ ГЕНЕРАЦИЙ (пул воркеров + честность между пользователями)
+# ==============================================================================
+QUEUE_MAX_DEPTH = int(os.getenv("GEN_QUEUE_MAX_DEPTH", "200"))
+QUEUE_MAX_PER_USER = int(os.getenv("GEN_QUEUE_MAX_PER_USER", "3"))
+# Приоритет для платящих: из PREMIUM_WEIGHT выдач подряд одна всё равно уходит обычным
+PREMIUM_PRIORITY = os.getenv("GEN_QUEUE_PREMIUM_PRIORITY", "1") == "1"
+PREMIUM_WEIGHT = int(os.getenv("GEN_QUEUE_PREMIUM_WEIGHT", "3"))
+
+
+class QueueRejected(Exception):
+    """Задачу не приняли: reason = 'user_limit' или 'full'"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@dataclass
+class GenerationJob:
+    user_id: int
+    run: Callable[[], Awaitable]
+    premium: bool = False
+    job_id: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class FairQueue:
+    """
+    Round-robin по пользователям: у каждого своя очередь,
+    выдаём по одной задаче от каждого по кругу.
+    """
+
+    def __init__(self):
+        self._users: OrderedDict[int, deque] = OrderedDict()
+        self.size = 0
+
+    def put(self, job: GenerationJob):
+        self._users.setdefault(job.user_id, deque()).append(job)
+        self.size += 1
+
+    def pop(self) -> GenerationJob:
+        user_id, jobs = next(iter(self._users.items()))
+        job = jobs.popleft()
+        # Пользователь уходит в конец круга (или выбывает, если задач больше нет)
+        del self._users[user_id]
+        if jobs:
+            self._users[user_id] = jobs
+        self.size -= 1
+        return job
+
+    def count_for(self, user_id: int) -> int:
+        jobs = self._users.get(user_id)
+        return len(jobs) if jobs else 0
+
+
+# Полосы исполнения: (воркеров = лимит параллельности, таймаут генерации в секундах)
+# PRO 4K идёт минутами — держим его отдельно, чтобы Standard не ждал за ним
+LANES = {
+    "standard": (int(os.getenv("GEN_LANE_STANDARD_WORKERS", "8")), float(os.getenv("GEN_LANE_STANDARD_TIMEOUT", "180"))),
+    "pro": (int(os.getenv("GEN_LANE_PRO_WORKERS", "4")), float(os.getenv("GEN_LANE_PRO_TIMEOUT", "420"))),
+    "pro_4k": (int(os.getenv("GEN_LANE_PRO_4K_WORKERS", "2")), float(os.getenv("GEN_LANE_PRO_4K_TIMEOUT", "600"))),
+}
+
+
+def lane_for(use_pro_model: bool, resolution: str = "1K") -> str:
+    """Полоса по модели и разрешению"""
+    if not use_pro_model:
+        return "standard"
+    return "pro_4k" if resolution == "4K" else "pro"
+
+
+class GenerationQueue:
+    def __init__(self, workers: int, timeout: float = None, max_depth: int = QUEUE_MAX_DEPTH, name: str = "main"):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.max_depth = max_depth
+        self._premium = FairQueue()
+        self._normal = FairQueue()
+        self._premium_streak = 0
+        self._cond: asyncio.Condition | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._ids = itertools.count(1)
+        # Кто сейчас выполняется (для лимита на пользователя)
+        self._running: dict[int, int] = {}
+        # Наблюдаемость
+        self.completed = 0
+        self.failed = 0
+        self._waits = deque(maxlen=500)
+
+    # --- ЖИЗНЕННЫЙ ЦИКЛ ---
+    def start(self):
+        if self._tasks:
+            return
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"🧵 Полоса '{self.name}': {self.workers} воркеров, таймаут {self.timeout:.0f}с")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # --- ПОСТАНОВКА ---
+    @property
+    def depth(self) -> int:
+        return self._premium.size + self._normal.size
+
+    def user_load(self, user_id: int) -> int:
+        return self._premium.count_for(user_id) + self._normal.count_for(user_id) + self._running.get(user_id, 0)
+
+    async def submit(self, user_id: int, run: Callable[[], Awaitable], premium: bool = False) -> int:
+        """Ставит задачу в очередь. Возвращает позицию (0 — уйдёт в работу сразу)"""
+        if self.depth >= self.max_depth:
+            raise QueueRejected("full")
+
+        job = GenerationJob(user_id=user_id, run=run, premium=premium and PREMIUM_PRIORITY, job_id=next(self._ids))
+        async with self._cond:
+            (self._premium if job.premium else self._normal).put(job)
+            position = max(0, self.depth - self.idle_workers)
+            self._cond.notify()
+        return position
+
+    # --- ВОРКЕРЫ ---
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    @property
+    def idle_workers(self) -> int:
+        return max(0, self.workers - self.running)
+
+    def _next_job(self) -> GenerationJob:
+        take_premium = self._premium.size and (not self._normal.size or self._premium_streak < PREMIUM_WEIGHT)
+        if take_premium:
+            self._premium_streak += 1
+            return self._premium.pop()
+        self._premium_streak = 0
+        return self._normal.pop()
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                while not self.depth:
+                    await self._cond.wait()
+                job = self._next_job()
+                self._running[job.user_id] = self._running.get(job.user_id, 0) + 1
+
+            self._waits.append(time.monotonic() - job.enqueued_at)
+            try:
+                await job.run()
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ошибка задачи #{job.job_id} (user {job.user_id}): {e}")
+            finally:
+                left = self._running.get(job.user_id, 1) - 1
+                if left:
+                    self._running[job.user_id] = left
+                else:
+                    self._running.pop(job.user_id, None)
+
+    # --- СТАТИСТИКА ---
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        return {
+            "timeout": self.timeout,
+            "depth": self.depth,
+            "premium_depth": self._premium.size,
+            "running": self.running,
+            "workers": self.workers,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95": p95,
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+
+class LaneScheduler:
+    """Набор полос: у каждой свой пул воркеров, своя очередь и свой таймаут"""
+
+    def __init__(self, lanes: dict = LANES):
+        self.lanes = {
+            name: GenerationQueue(workers=workers, timeout=timeout, name=name)
+            for name, (workers, timeout) in lanes.items()
+        }
+
+    def start(self):
+        for lane in self.lanes.values():
+            lane.start()
+
+    async def stop(self):
+        await asyncio.gather(*(lane.stop() for lane in self.lanes.values()))
+
+    def user_load(self, user_id: int) -> int:
+        return sum(lane.user_load(user_id) for lane in self.lanes.values())
+
+    async def submit(self, lane: str, user_id: int, run: Callable[[], Awaitable], premium: bool = False) -> int:
+        # Лимит на пользователя общий для всех полос
+        if self.user_load(user_id) >= QUEUE_MAX_PER_USER:
+            raise QueueRejected("user_limit")
+        return await self.lanes[lane].submit(user_id, run, premium=premium)
+
+    def stats(self) -> dict:
+        """Заполненность по полосам (для мониторинга)"""
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+generation_queue = LaneScheduler()
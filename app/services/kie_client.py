@@ -0,0 +1,142 @@
+import os
+import asyncio
+import json
+import time
+import aiohttp
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential, retry_if_exception_type
+from app import config
+from app.services.http_client import get_http_session
+from app.services.blob_store import blob_store
+from app.services.resilience import AdaptiveLimiter, CircuitBreaker, ProviderBusyError
+
+# Таймауты для API и для скачивания результата
+API_TIMEOUT = aiohttp.ClientTimeout(total=30)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=120)
+DOWNLOAD_CHUNK = 256 * 1024
+
+# Повторы для временных ошибок (сеть, 429, 5xx): ограниченные, с джиттером
+KIE_RETRY_ATTEMPTS = int(os.getenv("KIE_RETRY_ATTEMPTS", "3"))
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+class KieTransientError(Exception):
+    """Временная ошибка Kie — имеет смысл повторить"""
+
+
+class KieClient:
+    """
+    Асинхронный клиент Kie.ai поверх общего пула соединений.
+    createTask идёт через AIMD-лимитер и circuit breaker: если Kie лежит,
+    бросаем ProviderBusyError сразу, а не ждём весь бюджет опроса.
+    """
+
+    def __init__(self, base_url: str = None, api_key: str = None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.limiter = AdaptiveLimiter("Kie", initial=int(os.getenv("KIE_LIMIT_INITIAL", "16")))
+        self.breaker = CircuitBreaker("Kie")
+
+    @property
+    def _url(self) -> str:
+        return self.base_url or config.KIE_URL
+
+    @property
+    def _headers(self) -> dict:
+        key = self.api_key or config.KIE_API_KEY
+        return {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
+
+    def _retrying(self) -> AsyncRetrying:
+        return AsyncRetrying(
+            stop=stop_after_attempt(KIE_RETRY_ATTEMPTS),
+            wait=wait_random_exponential(multiplier=0.5, max=4),
+            retry=retry_if_exception_type((KieTransientError, aiohttp.ClientConnectionError, asyncio.TimeoutError)),
+            reraise=True,
+        )
+
+    async def _create_task_once(self, payload: dict) -> str | None:
+        session = get_http_session()
+        async with session.post(f"{self._url}/createTask", headers=self._headers, json=payload, timeout=API_TIMEOUT) as resp:
+            if resp.status in TRANSIENT_STATUSES:
+                raise KieTransientError(f"HTTP {resp.status}")
+            if resp.status != 200:
+                print(f"❌ Kie Error: {await resp.text()}")
+                return None
+            resp_json = await resp.json(content_type=None)
+
+        if resp_json.get("code") in TRANSIENT_STATUSES:
+            raise KieTransientError(f"code {resp_json.get('code')}: {resp_json.get('msg')}")
+        if resp_json.get("code") != 200:
+            print(f"❌ Kie Logic Error: {resp_json.get('msg')}")
+            return None
+        return resp_json["data"]["taskId"]
+
+    async def create_task(self, model: str, input_data: dict, callback_url: str = None) -> str | None:
+        """POST /createTask → taskId (callback_url — куда Kie пришлёт уведомление о завершении)"""
+        if not self.breaker.allow():
+            raise ProviderBusyError("Kie: circuit open")
+
+        payload = {"model": model, "input": input_data}
+        if callback_url:
+            payload["callBackUrl"] = callback_url
+
+        started = time.monotonic()
+        ok = None
+        try:
+            async for attempt in self._retrying():
+                with attempt:
+                    task_id = await self._create_task_once(payload)
+            # Логическая ошибка (валидация/модерация) — не признак падения провайдера
+            ok = True
+        except (KieTransientError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"❌ Kie недоступен после {KIE_RETRY_ATTEMPTS} попыток: {e}")
+            ok = False
+            return None
+        except Exception:
+            # Ответ не той формы (нет data/taskId и т.п.) — тоже сбой провайдера
+            ok = False
+            raise
+        finally:
+            if ok is None:
+                # Отмена (таймаут полосы, хедж, остановка): исход неизвестен,
+                # но проба half-open не должна остаться занятой навсегда
+                self.breaker.release_probe()
+            else:
+                if ok:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                self.limiter.record(time.monotonic() - started, ok=ok)
+        return task_id
+
+    async def record_info(self, task_id: str) -> dict | None:
+        """GET /recordInfo → data (state, resultJson, failMsg)"""
+        session = get_http_session()
+        async with session.get(f"{self._url}/recordInfo", headers=self._headers, params={"taskId": task_id}, timeout=API_TIMEOUT) as resp:
+            if resp.status in TRANSIENT_STATUSES:
+                raise KieTransientError(f"HTTP {resp.status}")
+            resp_json = await resp.json(content_type=None)
+        return resp_json.get("data")
+
+    async def download(self, url: str) -> bytes:
+        """Скачивает готовую картинку (сертификат хоста проверяется)"""
+        session = get_http_session()
+        async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def download_to_store(self, url: str) -> str:
+        """Стримит результат чанками прямо в blob store, возвращает хэш (без буфера на весь файл)"""
+        session = get_http_session()
+        async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as resp:
+            resp.raise_for_status()
+            return await blob_store.put_stream(resp.content.iter_chunked(DOWNLOAD_CHUNK))
+
+
+def parse_result_url(data: dict) -> str | None:
+    """Достаёт первую ссылку из resultJson"""
+    result_obj = json.loads(data.get("resultJson") or "{}")
+    urls = result_obj.get("resultUrls") or []
+    return urls[0] if urls else None
+
+
+kie_client = KieClient()
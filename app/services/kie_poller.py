@@ -0,0 +1,256 @@
+import os
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from dataclasses import dataclass, field
+from app.services.kie_client import KieClient, kie_client
+
+# ==============================================================================
+# ЦЕНТРАЛЬНЫЙ ПОЛЛЕР KIE (один цикл на все taskId)
+# ==============================================================================
+POLL_TICK_SEC = float(os.getenv("KIE_POLL_TICK_SEC", "0.5"))          # шаг "колеса"
+POLL_MIN_INTERVAL = float(os.getenv("KIE_POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("KIE_POLL_MAX_INTERVAL", "15"))
+POLL_BACKOFF = float(os.getenv("KIE_POLL_BACKOFF", "1.5"))
+POLL_DEADLINE_SEC = float(os.getenv("KIE_POLL_DEADLINE_SEC", "600"))  # те же 10 минут
+POLL_CONCURRENCY = int(os.getenv("KIE_POLL_CONCURRENCY", "20"))
+# Режим страховки: когда Kie присылает колбэки, опрос нужен только для потерянных уведомлений
+SAFETY_FIRST_DELAY = float(os.getenv("KIE_SAFETY_FIRST_DELAY", "60"))
+SAFETY_INTERVAL = float(os.getenv("KIE_SAFETY_INTERVAL", "30"))
+EARLY_RESULT_TTL = 120.0
+# Столько ошибок recordInfo подряд — и задача считается проваленной (не ждём все 10 минут)
+POLL_MAX_ERRORS = int(os.getenv("KIE_POLL_MAX_ERRORS", "5"))
+
+# Типичная длительность (сек) по модели/разрешению — первая проверка делается ближе к ней
+TYPICAL_DURATION = {
+    ("pro", "4K"): 90.0,
+    ("pro", "2K"): 50.0,
+    ("pro", "1K"): 35.0,
+    ("edit", None): 15.0,
+    ("gen", None): 12.0,
+}
+
+
+def duration_key(model: str, resolution: str = None) -> tuple:
+    """Ключ таблицы длительностей: PRO различаем по разрешению, остальные — по типу"""
+    model = (model or "").lower()
+    if "pro" in model:
+        return ("pro", resolution or "1K")
+    if "edit" in model:
+        return ("edit", None)
+    return ("gen", None)
+
+
+@dataclass
+class _Job:
+    task_id: str
+    key: tuple
+    future: asyncio.Future
+    started: float
+    interval: float = POLL_MIN_INTERVAL
+    checks: int = 0
+    errors: int = 0
+    in_flight: bool = False
+    waiters: int = 0  # сколько wait() ждут этот taskId (хедж, резюм, дубли)
+
+
+@dataclass(order=True)
+class _Slot:
+    due: float
+    seq: int
+    task_id: str = field(compare=False)
+
+
+class KiePoller:
+    """
+    Владеет всеми незавершёнными taskId.
+    Проверки раскладываются по слотам общего таймера (шаг POLL_TICK_SEC),
+    все задачи одного слота проверяются одной пачкой.
+    """
+
+    def __init__(self, client: KieClient = kie_client):
+        self.client = client
+        self._jobs: dict[str, _Job] = {}
+        self._heap: list[_Slot] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._runner: asyncio.Task | None = None
+        self._sem: asyncio.Semaphore | None = None
+        # Скользящая оценка длительности (учимся на реальных задачах)
+        self.typical = dict(TYPICAL_DURATION)
+        self.requests_sent = 0
+        # Включается веб-сервером, если колбэки Kie настроены
+        self.callbacks_enabled = False
+        # Колбэки, пришедшие раньше, чем задача встала на наблюдение
+        self._early: dict[str, tuple[float, dict]] = {}
+
+    # --- ПУБЛИЧНОЕ API ---
+    def watch(self, task_id: str, model: str, resolution: str = None) -> asyncio.Future:
+        """Ставит taskId на наблюдение, возвращает future с data из recordInfo"""
+        self._ensure_running()
+        if task_id in self._jobs:
+            return self._jobs[task_id].future
+
+        key = duration_key(model, resolution)
+        job = _Job(task_id, key, asyncio.get_running_loop().create_future(), time.monotonic())
+        self._jobs[task_id] = job
+
+        early = self._early.pop(task_id, None)
+        if early:
+            self.resolve(task_id, early[1])
+            return job.future
+
+        typical = self.typical.get(key, 15.0)
+        if self.callbacks_enabled:
+            # Опрос — только страховка на случай потерянного колбэка
+            job.interval = SAFETY_INTERVAL
+            first_delay = typical * 2 + SAFETY_FIRST_DELAY
+        else:
+            # Первая проверка — примерно на 70% типичного времени
+            first_delay = max(POLL_MIN_INTERVAL, typical * 0.7)
+        self._schedule(job, first_delay)
+        return job.future
+
+    async def wait(self, task_id: str, model: str, resolution: str = None) -> dict | None:
+        """Ждёт финального состояния задачи (success/fail) или None по дедлайну"""
+        future = self.watch(task_id, model, resolution)
+        job = self._jobs.get(task_id)
+        if job:
+            job.waiters += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if job:
+                job.waiters -= 1
+                # Снимаем с наблюдения, только когда ушёл последний ожидающий —
+                # отмена одного не должна обрывать ожидание остальным
+                if job.waiters == 0 and not future.done():
+                    self.forget(task_id)
+
+    def resolve(self, task_id: str, data: dict | None):
+        """Завершает ожидание задачи (из поллера или извне)"""
+        job = self._jobs.pop(task_id, None)
+        if not job or job.future.done():
+            return
+        if data and data.get("state") == "success":
+            elapsed = time.monotonic() - job.started
+            old = self.typical.get(job.key, elapsed)
+            self.typical[job.key] = old * 0.8 + elapsed * 0.2
+        job.future.set_result(data)
+
+    def notify(self, task_id: str, data: dict):
+        """Уведомление от Kie (колбэк): завершает задачу сразу, без ожидания опроса"""
+        if data.get("state") not in ("success", "fail"):
+            return
+        if task_id in self._jobs:
+            self.resolve(task_id, data)
+            return
+        # Задача ещё не зарегистрирована (колбэк обогнал ответ createTask)
+        now = time.monotonic()
+        self._early = {k: v for k, v in self._early.items() if now - v[0] < EARLY_RESULT_TTL}
+        self._early[task_id] = (now, data)
+
+    def forget(self, task_id: str):
+        """Снимает задачу с наблюдения без результата"""
+        job = self._jobs.pop(task_id, None)
+        if job and not job.future.done():
+            job.future.cancel()
+
+    @property
+    def pending(self) -> int:
+        return len(self._jobs)
+
+    async def stop(self):
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    # --- ВНУТРЕННЕЕ ---
+    def _ensure_running(self):
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._sem = asyncio.Semaphore(POLL_CONCURRENCY)
+            self._runner = asyncio.create_task(self._run())
+
+    def _schedule(self, job: _Job, delay: float):
+        # Округляем до слота, чтобы близкие проверки сливались в одну пачку
+        due = math.ceil((time.monotonic() + delay) / POLL_TICK_SEC) * POLL_TICK_SEC
+        heapq.heappush(self._heap, _Slot(due, next(self._seq), job.task_id))
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0].due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Забираем весь созревший слот
+            now = time.monotonic()
+            batch = []
+            while self._heap and self._heap[0].due <= now:
+                slot = heapq.heappop(self._heap)
+                job = self._jobs.get(slot.task_id)
+                if job and not job.in_flight:
+                    job.in_flight = True
+                    batch.append(job)
+
+            for job in batch:
+                asyncio.create_task(self._check(job))
+
+    async def _check(self, job: _Job):
+        data = None
+        failed = False
+        try:
+            async with self._sem:
+                self.requests_sent += 1
+                data = await self.client.record_info(job.task_id)
+        except Exception as e:
+            failed = True
+            print(f"⚠️ Kie poll error ({job.task_id}): {e}")
+        finally:
+            job.in_flight = False
+
+        if job.task_id not in self._jobs:
+            return  # уже завершена (например, колбэком)
+
+        job.errors = job.errors + 1 if failed else 0
+        if job.errors >= POLL_MAX_ERRORS:
+            print(f"🔌 Kie: {job.errors} ошибок опроса подряд, задача {job.task_id} снята")
+            self.resolve(job.task_id, None)
+            return
+
+        state = data.get("state") if data else None
+        if state in ("success", "fail"):
+            self.resolve(job.task_id, data)
+            return
+
+        if time.monotonic() - job.started > POLL_DEADLINE_SEC:
+            print(f"⌛ Kie: задача {job.task_id} не завершилась за {POLL_DEADLINE_SEC:.0f}с")
+            self.resolve(job.task_id, None)
+            return
+
+        # Первые проверки частые, дальше — бэкофф (в режиме страховки — редкий фиксированный шаг)
+        job.checks += 1
+        self._schedule(job, job.interval)
+        if not self.callbacks_enabled:
+            job.interval = min(POLL_MAX_INTERVAL, job.interval * POLL_BACKOFF)
+
+
+kie_poller = KiePoller()
@@ -0,0 +1,85 @@
+import os
+import asyncio
+from collections import OrderedDict
+from pathlib import Path
+from app.services.image_pool import image_pool
+from app.services import image_ops
+from app.services.image_ops import encode_preview
+from app.services.blob_store import blob_store, temp_store
+
+# ==============================================================================
+# ПРЕВЬЮ РЕЗУЛЬТАТОВ ДЛЯ TELEGRAM (кодируются всегда, один раз на результат)
+# ==============================================================================
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "jpg")  # jpg | webp
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", str(image_ops.PREVIEW_MAX_SIDE)))
+PREVIEW_TARGET_BYTES = int(os.getenv("PREVIEW_TARGET_KB", str(image_ops.PREVIEW_TARGET_BYTES // 1024))) * 1024
+PREVIEW_CACHE_SIZE = int(os.getenv("PREVIEW_CACHE_SIZE", "2000"))
+
+
+class PreviewCache:
+    """
+    Хэш оригинала в blob store → хэш превью во временном хранилище.
+    Оригинал остаётся без потерь (его отдаёт download_), превью кодируется один раз;
+    параллельные запросы превью одного результата ждут одну задачу пула.
+    """
+
+    def __init__(self, cache_size: int = PREVIEW_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def _encode_one(self, blob_hash: str) -> str:
+        source = blob_store.path(blob_hash)
+        if not source:
+            raise FileNotFoundError(blob_hash)
+        # В пул уходит путь — байты оригинала между процессами не гоняем
+        data = await image_pool.run(
+            encode_preview, str(source), PREVIEW_MAX_SIDE, PREVIEW_TARGET_BYTES, PREVIEW_FORMAT
+        )
+        self.bytes_in += source.stat().st_size
+        self.bytes_out += len(data)
+        return await temp_store.put(data)
+
+    async def get(self, blob_hash: str | None) -> Path | None:
+        """Путь к превью; None — оригинала нет или кодирование упало (шлём оригинал)"""
+        if not blob_hash:
+            return None
+        preview_hash = self._cache.get(blob_hash)
+        path = temp_store.path(preview_hash)
+        if path:
+            self._cache.move_to_end(blob_hash)
+            self.hits += 1
+            return path
+
+        future = self._in_flight.get(blob_hash)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self._encode_one(blob_hash))
+            self._in_flight[blob_hash] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(blob_hash, None))
+        try:
+            preview_hash = await asyncio.shield(future)
+        except Exception as e:
+            print(f"⚠️ Превью не получилось, шлём оригинал: {e}")
+            return None
+
+        self._cache[blob_hash] = preview_hash
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return temp_store.path(preview_hash)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "in_flight": len(self._in_flight),
+            "saved_mb": (self.bytes_in - self.bytes_out) / 1024 / 1024,
+            "ratio": self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+        }
+
+
+preview_cache = PreviewCache()
@@ -0,0 +1,187 @@
+import os
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from app.services.resilience import CircuitBreaker, ProviderBusyError
+from app.services.job_queue import lane_for
+
+# ==============================================================================
+# ПРОВАЙДЕРЫ ГЕНЕРАЦИИ И РОУТЕР (здоровье → p95 → цена, с хеджированием)
+# ==============================================================================
+ENGINE_HEDGING = os.getenv("ENGINE_HEDGING", "1") == "1"
+HEDGE_MIN_SEC = float(os.getenv("ENGINE_HEDGE_MIN_SEC", "20"))
+HEDGE_DEFAULT_SEC = float(os.getenv("ENGINE_HEDGE_DEFAULT_SEC", "45"))
+# Сколько секунд латентности "стоит" единица цены при выборе провайдера
+COST_WEIGHT_SEC = float(os.getenv("ENGINE_COST_WEIGHT_SEC", "10"))
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    image_urls: list = field(default_factory=list)
+    aspect_ratio: str = "1:1"
+    use_pro: bool = False
+    resolution: str = "1K"
+    history: list = None
+    # async (task_id, model) — вызывается, как только провайдер принял задачу (для resume после рестарта)
+    on_task_created: object = None
+
+    @property
+    def lane(self) -> str:
+        """Полоса запроса (standard / pro / pro_4k) — латентности считаются по ней"""
+        return lane_for(self.use_pro, self.resolution)
+
+
+class ImageProvider:
+    """
+    Базовый провайдер. Наследник реализует _generate() и возвращает
+    GenerationResult (оригинал в blob store) либо None.
+    Латентности — отдельно по полосам: 90-секундные 4K не должны
+    двигать p95 и дедлайн хеджа для Standard.
+    breaker — общий с клиентом провайдера, если тот уже ведёт свой (исход и allow() — в клиенте).
+    """
+    name = "base"
+
+    def __init__(self, cost: float = 1.0, breaker: CircuitBreaker = None):
+        self.cost = cost
+        self._records_breaker = breaker is None
+        self.breaker = breaker or CircuitBreaker(self.name)
+        self._latencies: dict[str, deque] = {}
+
+    def supports(self, req: GenerationRequest) -> bool:
+        return True
+
+    @property
+    def healthy(self) -> bool:
+        # Открытый breaker, у которого вышло open_seconds, снова кандидат — на пробу
+        return self.breaker.available
+
+    def p95(self, lane: str, default: float = None) -> float | None:
+        latencies = self._latencies.get(lane)
+        if not latencies or len(latencies) < 5:
+            return default
+        values = sorted(latencies)
+        return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+    async def _generate(self, req: GenerationRequest):
+        raise NotImplementedError
+
+    async def run(self, req: GenerationRequest):
+        if self._records_breaker and not self.breaker.allow():
+            raise ProviderBusyError(f"{self.name}: circuit {self.breaker.state}")
+        started = time.monotonic()
+        ok = None
+        try:
+            result = await self._generate(req)
+            if result:
+                ok = True
+                self._latencies.setdefault(req.lane, deque(maxlen=100)).append(time.monotonic() - started)
+            return result
+        except (ProviderBusyError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            print(f"❌ {self.name}: {e}")
+            ok = False
+            return None
+        finally:
+            if self._records_breaker:
+                if ok is None:
+                    # Исхода нет (пустой ответ, отмена, занято) — проба half-open не должна зависнуть
+                    self.breaker.release_probe()
+                elif ok:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+
+    def stats(self) -> dict:
+        p95 = {lane: self.p95(lane) for lane in self._latencies}
+        return {"healthy": self.healthy, "p95": p95, "cost": self.cost, **self.breaker.stats()}
+
+
+class ProviderRouter:
+    def __init__(self, providers: list[ImageProvider], hedging: bool = ENGINE_HEDGING):
+        self.providers = providers
+        self.hedging = hedging
+        self.hedges_started = 0
+        self.hedges_won = 0
+
+    def rank(self, req: GenerationRequest) -> list[ImageProvider]:
+        """Кандидаты по порядку: сначала живые, внутри — по p95 полосы запроса + цене"""
+        candidates = [p for p in self.providers if p.supports(req)]
+        return sorted(
+            candidates,
+            key=lambda p: (not p.healthy, p.p95(req.lane, HEDGE_DEFAULT_SEC) + p.cost * COST_WEIGHT_SEC)
+        )
+
+    async def generate(self, req: GenerationRequest):
+        ranked = [p for p in self.rank(req) if p.healthy] or self.rank(req)[:1]
+        if not ranked:
+            return None
+
+        primary = ranked[0]
+        secondary = ranked[1] if len(ranked) > 1 else None
+        if not secondary or not self.hedging:
+            return await self._run_chain(req, ranked)
+
+        deadline = max(HEDGE_MIN_SEC, primary.p95(req.lane, HEDGE_DEFAULT_SEC))
+        return await self._hedged(req, primary, secondary, deadline)
+
+    async def _run_chain(self, req: GenerationRequest, ranked: list[ImageProvider]):
+        """Без хеджа: по очереди до первого успеха"""
+        busy = None
+        for provider in ranked:
+            try:
+                result = await provider.run(req)
+            except ProviderBusyError as e:
+                busy = e
+                continue
+            if result:
+                return result
+        if busy:
+            raise busy
+        return None
+
+    async def _hedged(self, req: GenerationRequest, primary: ImageProvider, secondary: ImageProvider, deadline: float):
+        """Основной запрос; если не успел к дедлайну (или упал) — параллельно второй, берём первый успех"""
+        tasks = {asyncio.create_task(primary.run(req)): primary}
+        hedge_started = False
+        busy = None
+        try:
+            while tasks:
+                timeout = None if hedge_started else deadline
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Основной провайдер не уложился в дедлайн — запускаем хедж
+                    print(f"🪁 Хедж: {primary.name} > {deadline:.0f}с, запускаю {secondary.name}")
+                    self.hedges_started += 1
+                    hedge_started = True
+                    tasks[asyncio.create_task(secondary.run(req))] = secondary
+                    continue
+
+                for task in done:
+                    provider = tasks.pop(task)
+                    try:
+                        result = task.result()
+                    except ProviderBusyError as e:
+                        busy, result = e, None
+                    if result:
+                        if provider is secondary:
+                            self.hedges_won += 1
+                        return result
+
+                if not hedge_started:
+                    # Основной упал быстро — второй уже не хедж, а фолбэк
+                    hedge_started = True
+                    tasks[asyncio.create_task(secondary.run(req))] = secondary
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if busy:
+            raise busy
+        return None
+
+    def stats(self) -> dict:
+        return {p.name: p.stats() for p in self.providers}
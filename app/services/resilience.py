@@ -0,0 +1,138 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# ==============================================================================
+# ЗАЩИТА ОТ ДЕГРАДАЦИИ ПРОВАЙДЕРА (AIMD-лимитер + circuit breaker)
+# ==============================================================================
+
+
+class ProviderBusyError(Exception):
+    """Провайдер перегружен или лежит — отвечаем пользователю сразу, а не через 10 минут"""
+
+
+class AdaptiveLimiter:
+    """
+    AIMD-лимит параллельных задач у провайдера:
+    быстрый успешный ответ → лимит растёт на 1 за "окно" (additive increase),
+    ошибка или ответ дольше latency_target → лимит умножается на decrease.
+    """
+
+    def __init__(self, name: str, initial: int = 16, min_limit: int = 2, max_limit: int = 64,
+                 latency_target: float = 5.0, decrease: float = 0.7, max_wait: float = 5.0):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._cond: asyncio.Condition | None = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @asynccontextmanager
+    async def slot(self):
+        """Занимает слот; если за max_wait не освободился — ProviderBusyError"""
+        cond = self._condition()
+        async with cond:
+            try:
+                await asyncio.wait_for(
+                    cond.wait_for(lambda: self.in_flight < int(self.limit)),
+                    timeout=self.max_wait
+                )
+            except asyncio.TimeoutError:
+                raise ProviderBusyError(f"{self.name}: лимит {int(self.limit)} занят")
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with cond:
+                self.in_flight -= 1
+                cond.notify_all()
+
+    def record(self, latency: float, ok: bool):
+        """Сигнал для AIMD: латентность и успех запроса к провайдеру"""
+        if ok and latency <= self.latency_target:
+            self.limit = min(self.max_limit, self.limit + 1 / max(self.limit, 1))
+        else:
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+
+
+class CircuitBreaker:
+    """
+    closed → (доля ошибок в окне ≥ error_rate) → open на open_seconds →
+    half_open (пропускаем одну пробу) → closed при успехе / снова open при ошибке.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5,
+                 error_rate: float = 0.5, open_seconds: float = 30.0):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._results = deque(maxlen=window)
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    @property
+    def available(self) -> bool:
+        """Пропустит ли allow() запрос — без смены состояния (для выбора провайдера)"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self._opened_at >= self.open_seconds
+        return not self._probe_in_flight
+
+    def release_probe(self):
+        """Проба отменена без результата — следующий allow() пропустит новую"""
+        if self.state == "half_open":
+            self._probe_in_flight = False
+
+    def record_success(self):
+        self._results.append(True)
+        if self.state != "closed":
+            print(f"✅ {self.name}: провайдер ожил, circuit closed")
+            self.state = "closed"
+            self._results.clear()
+
+    def record_failure(self):
+        self._results.append(False)
+        if self.state == "half_open":
+            self._open()
+            return
+        failures = self._results.count(False)
+        if len(self._results) >= self.min_calls and failures / len(self._results) >= self.error_rate:
+            self._open()
+
+    def _open(self):
+        if self.state != "open":
+            print(f"🔌 {self.name}: circuit open на {self.open_seconds:.0f}с")
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "errors": self._results.count(False),
+            "calls": len(self._results),
+        }
@@ -0,0 +1,69 @@
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from aiogram.types import FSInputFile
+from app.services.blob_store import blob_store
+from app.services.previews import preview_cache, PREVIEW_FORMAT
+
+# ==============================================================================
+# РЕЗУЛЬТАТ ГЕНЕРАЦИИ (одна копия на диске — для отправки, лога и download_)
+# ==============================================================================
+
+
+@dataclass
+class GenerationResult:
+    """
+    Оригинал лежит в blob store один раз; всё остальное — ссылки на него.
+    Отправка читает файл чанками (FSInputFile), превью кодируется в пуле
+    по пути к файлу и кэшируется; байты целиком в памяти бота не держим.
+    """
+    blob_hash: str
+    source_url: str | None = None
+    filename: str = "result.png"
+    _preview: Path | None = field(default=None, init=False, repr=False)
+
+    @classmethod
+    def from_history(cls, history_item) -> "GenerationResult | None":
+        """Результат по записи истории (meta_data["blob"]); None — оригинала не сохраняли"""
+        try:
+            blob_hash = json.loads(history_item.content).get("blob")
+        except Exception:
+            blob_hash = None
+        if not blob_hash:
+            return None
+        return cls(blob_hash, history_item.image_url)
+
+    @property
+    def path(self) -> Path | None:
+        """None — оригинал вытеснен из blob store"""
+        return blob_store.path(self.blob_hash)
+
+    def as_document(self, filename: str = None) -> FSInputFile:
+        return FSInputFile(self.path, filename=filename or self.filename)
+
+    async def preview(self) -> Path | None:
+        """Превью под Telegram — кодируется при первом обращении, дальше из кэша"""
+        if self._preview is None or not self._preview.exists():
+            self._preview = await preview_cache.get(self.blob_hash)
+        return self._preview
+
+    async def as_photo(self) -> FSInputFile:
+        """Превью для send_photo; если не вышло — оригинал"""
+        preview_path = await self.preview()
+        if preview_path:
+            return FSInputFile(preview_path, filename=f"result.{PREVIEW_FORMAT}")
+        return self.as_document()
+
+    @property
+    def ext(self) -> str:
+        """Расширение по сигнатуре файла: Kie отдаёт и PNG, и JPEG, и WebP"""
+        # Нужны 12 байт заголовка — читаем их, а не отображаем файл (пустой файл не падает)
+        with open(self.path, "rb") as f:
+            head = f.read(12)
+        if head.startswith(b"\x89PNG"):
+            return "png"
+        if head.startswith(b"\xff\xd8"):
+            return "jpg"
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "webp"
+        return "png"
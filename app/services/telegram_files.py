@@ -0,0 +1,89 @@
+import os
+import asyncio
+from cachetools import TTLCache, LRUCache
+from aiogram import Bot
+
+# ==============================================================================
+# ССЫЛКИ НА ФАЙЛЫ TELEGRAM (file_id → file_path с TTL, пакетное разрешение)
+# ==============================================================================
+# Telegram гарантирует, что ссылка на файл живёт не меньше часа — берём с запасом
+FILE_PATH_TTL = int(os.getenv("TG_FILE_PATH_TTL", str(50 * 60)))
+FILE_PATH_CACHE_SIZE = int(os.getenv("TG_FILE_PATH_CACHE_SIZE", "10000"))
+FILE_URL_PREFIX = "https://api.telegram.org/file/bot"
+
+
+class TelegramFiles:
+    """
+    get_file — отдельный запрос к Bot API на каждое фото; повторные запросы
+    того же file_id (reroll, правка, альбом из пересланных фото) берутся из кэша.
+    Обратная карта file_path → file_id нужна, чтобы сохранить file_id в истории
+    и пересобрать протухшую ссылку, когда старую генерацию перезапускают.
+    """
+
+    def __init__(self, ttl: int = FILE_PATH_TTL, cache_size: int = FILE_PATH_CACHE_SIZE):
+        self._paths: TTLCache = TTLCache(maxsize=cache_size, ttl=ttl)  # file_id → file_path
+        self._ids: LRUCache = LRUCache(maxsize=cache_size)  # file_path → file_id
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _url(bot: Bot, file_path: str) -> str:
+        return f"{FILE_URL_PREFIX}{bot.token}/{file_path}"
+
+    @staticmethod
+    def _path_of(url: str) -> str | None:
+        """file_path из ссылки Telegram (без токена); None — ссылка не на файл Telegram"""
+        if not url or not url.startswith(FILE_URL_PREFIX):
+            return None
+        parts = url[len(FILE_URL_PREFIX):].split("/", 1)
+        return parts[1] if len(parts) == 2 else None
+
+    async def _resolve(self, bot: Bot, file_id: str) -> str:
+        file_info = await bot.get_file(file_id)
+        return file_info.file_path
+
+    async def url(self, bot: Bot, file_id: str) -> str | None:
+        """Ссылка на файл; одинаковые file_id, запрошенные одновременно, ждут один get_file"""
+        if not file_id:
+            return None
+        file_path = self._paths.get(file_id)
+        if file_path:
+            self.hits += 1
+            return self._url(bot, file_path)
+
+        future = self._in_flight.get(file_id)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self._resolve(bot, file_id))
+            self._in_flight[file_id] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(file_id, None))
+        file_path = await asyncio.shield(future)
+
+        self._paths[file_id] = file_path
+        self._ids[file_path] = file_id
+        return self._url(bot, file_path)
+
+    async def urls(self, bot: Bot, file_ids: list) -> list:
+        """Ссылки для пачки (альбом) — параллельно; не разрешившиеся — None"""
+        results = await asyncio.gather(*(self.url(bot, file_id) for file_id in file_ids), return_exceptions=True)
+        for file_id, result in zip(file_ids, results):
+            if isinstance(result, Exception):
+                print(f"⚠️ get_file {file_id[:16]}...: {result}")
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    def file_id_for(self, url: str) -> str | None:
+        """file_id, из которого получена ссылка (если она разрешалась в этом процессе)"""
+        file_path = self._path_of(url)
+        return self._ids.get(file_path) if file_path else None
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached": len(self._paths),
+            "in_flight": len(self._in_flight),
+        }
+
+
+telegram_files = TelegramFiles()
@@ -0,0 +1,179 @@
+import os
+import time
+import itertools
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# ==============================================================================
+# ТАЙМИНГИ ЭТАПОВ ГЕНЕРАЦИИ (трасса на задачу + гистограммы по этапам)
+# ==============================================================================
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "300"))
+# Границы корзин гистограммы, сек (последняя — всё, что дольше)
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+_current: ContextVar["JobTrace | None"] = ContextVar("generation_trace", default=None)
+_job_ids = itertools.count(1)
+
+
+class Histogram:
+    """Счётчики по корзинам + последние значения для точных p50/p95"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._recent = deque(maxlen=500)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self._recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self._recent:
+            return 0.0
+        values = sorted(self._recent)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "buckets": dict(zip([*map(str, BUCKETS), "inf"], self.counts)),
+        }
+
+
+class JobTrace:
+    """Все этапы одной генерации: имя, смещение от старта, длительность, успех"""
+
+    def __init__(self, user_id: int, model: str, resolution: str, images: int):
+        self.job_id = next(_job_ids)
+        self.user_id = user_id
+        self.tags = {"model": model, "resolution": resolution, "images": images}
+        self.started_wall = time.time()
+        self.started = time.perf_counter()
+        self.stages: list[dict] = []
+        self.status = "running"
+        self.total = None
+        self._token = None
+
+    @property
+    def group(self) -> str:
+        images = self.tags["images"]
+        return f"{self.tags['model']} {self.tags['resolution']} {images if images < 2 else '2+'}img"
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.stages.append({
+                "name": name,
+                "at": started - self.started,
+                "duration": time.perf_counter() - started,
+                "ok": ok,
+            })
+
+    def mark(self, name: str, duration: float):
+        """Этап, измеренный снаружи (например, ожидание в очереди до старта трассы)"""
+        self.stages.append({"name": name, "at": -duration, "duration": duration, "ok": True})
+
+    def format(self) -> str:
+        lines = [
+            f"job #{self.job_id} | user {self.user_id} | {self.group} | {self.status}"
+            + (f" | {self.total:.2f}s" if self.total is not None else "")
+        ]
+        for s in sorted(self.stages, key=lambda s: s["at"]):
+            flag = "" if s["ok"] else " ✗"
+            lines.append(f"{s['at']:>7.2f}s  {s['name']:<16} {s['duration']:>7.2f}s{flag}")
+        return "\n".join(lines)
+
+
+class StageTimings:
+    """Гистограммы по (этап, группа) + последние трассы для админки"""
+
+    def __init__(self, keep: int = TRACE_KEEP):
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.traces: OrderedDict[int, JobTrace] = OrderedDict()
+        self.keep = keep
+
+    def start(self, user_id: int, model: str, resolution: str, images: int) -> JobTrace:
+        """Создаёт трассу и делает её текущей для этой корутины (и задач, созданных из неё)"""
+        trace = JobTrace(user_id, model, resolution, images)
+        trace._token = _current.set(trace)
+        self.traces[trace.job_id] = trace
+        while len(self.traces) > self.keep:
+            self.traces.popitem(last=False)
+        return trace
+
+    def finish(self, trace: JobTrace, status: str):
+        trace.status = status
+        trace.total = time.perf_counter() - trace.started
+        if trace._token is not None:
+            # Воркер очереди выполняет задачи подряд — следующая не должна писать в эту трассу
+            try:
+                _current.reset(trace._token)
+            except ValueError:
+                _current.set(None)
+            trace._token = None
+        for s in trace.stages:
+            self._observe(s["name"], trace.group, s["duration"])
+        self._observe("total", trace.group, trace.total)
+        summary = " | ".join(f"{s['name']} {s['duration']:.2f}" for s in trace.stages)
+        print(f"⏱ job #{trace.job_id} {status} за {trace.total:.2f}с: {summary}")
+
+    @contextmanager
+    def guard(self, trace: JobTrace):
+        """Этапы до основного try генерации: если упали — трасса закрывается как crash"""
+        try:
+            yield
+        except BaseException:
+            self.finish(trace, "crash")
+            raise
+
+    def _observe(self, stage_name: str, group: str, value: float):
+        for key in ((stage_name, group), (stage_name, "all")):
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def get(self, job_id: int) -> JobTrace | None:
+        return self.traces.get(job_id)
+
+    def recent(self, limit: int = 10, user_id: int = None) -> list[JobTrace]:
+        traces = [t for t in reversed(self.traces.values()) if user_id is None or t.user_id == user_id]
+        return traces[:limit]
+
+    def summary(self, group: str = "all") -> dict:
+        """{этап: stats} для одной группы, этапы — по среднему вкладу"""
+        rows = {name: h.stats() for (name, g), h in self.histograms.items() if g == group}
+        return dict(sorted(rows.items(), key=lambda kv: -kv[1]["avg"]))
+
+
+@contextmanager
+def stage(name: str):
+    """Замер этапа в текущей трассе; без трассы (скрипты, resume без задачи) — ничего не делает"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
+
+
+def current_trace() -> JobTrace | None:
+    return _current.get()
+
+
+stage_timings = StageTimings()
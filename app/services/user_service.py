@@ -1,9 +1,10 @@
-from sqlalchemy import select, func, desc, or_
+from sqlalchemy import select, update, case, func, desc, or_, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import User, Purchase
 from datetime import datetime, timedelta
 from app.config import START_BALANCE
 from app.models import MessageHistory, GenerationTask
+from app.services.history_writer import history_writer
 
 async def get_or_create_user(session: AsyncSession, telegram_id: int, username: str | None, full_name: str | None):
     query = select(User).where(User.telegram_id == telegram_id)
@@ -23,26 +24,33 @@ async def get_or_create_user(session: AsyncSession, telegram_id: int, username:
     await session.commit()
     return new_user, True
 
+async def reserve_balance(session: AsyncSession, telegram_id: int, amount: int = 1) -> int | None:
+    """
+    Атомарное списание одним запросом: UPDATE ... WHERE баланс >= amount RETURNING баланс.
+    Проверка и списание — в самой БД, два параллельных нажатия не пройдут оба.
+    Возвращает остаток или None, если не хватило. Коммит — за вызывающим.
+    """
+    stmt = (
+        update(User)
+        .where(User.telegram_id == telegram_id, User.generations_balance >= amount)
+        .values(
+            generations_balance=User.generations_balance - amount,
+            total_generations_used=User.total_generations_used + 1,
+        )
+        .returning(User.generations_balance)
+        .execution_options(synchronize_session=False)
+    )
+    result = await session.execute(stmt)
+    return result.scalar_one_or_none()
+
 async def check_and_deduct_balance(session: AsyncSession, telegram_id: int, amount: int = 1) -> bool:
     """
     Списывает указанное количество генераций (amount).
     Возвращает True, если баланса хватило.
     """
-    query = select(User).where(User.telegram_id == telegram_id)
-    result = await session.execute(query)
-    user = result.scalar_one_or_none()
-
-    if not user:
-        return False
-    
-    # Проверяем, хватает ли баланса на эту операцию
-    if user.generations_balance >= amount:
-        user.generations_balance -= amount
-        user.total_generations_used += 1
-        await session.commit()
-        return True
-    else:
-        return False
+    balance_left = await reserve_balance(session, telegram_id, amount)
+    await session.commit()
+    return balance_left is not None
 
 async def get_user_balance(session: AsyncSession, telegram_id: int) -> int:
     query = select(User).where(User.telegram_id == telegram_id)
@@ -141,19 +149,21 @@ async def find_user_by_input(session: AsyncSession, user_input: str):
 async def admin_change_balance(session: AsyncSession, user_id: int, amount: int):
     """
     Меняет баланс пользователя (может быть отрицательным числом).
+    Одним UPDATE — не затирает параллельные списания генераций.
     """
-    query = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(query)
-    user = result.scalar_one_or_none()
-    
-    if user:
-        user.generations_balance += amount
+    new_balance = User.generations_balance + amount
+    stmt = (
+        update(User)
+        .where(User.telegram_id == user_id)
         # Защита от ухода в минус
-        if user.generations_balance < 0:
-            user.generations_balance = 0
-        await session.commit()
-        return user.generations_balance
-    return None
+        .values(generations_balance=case((new_balance < 0, 0), else_=new_balance))
+        .returning(User.generations_balance)
+        .execution_options(synchronize_session=False)
+    )
+    result = await session.execute(stmt)
+    balance = result.scalar_one_or_none()
+    await session.commit()
+    return balance
 
 
 # Замени функцию add_history
@@ -178,72 +188,223 @@ async def get_dialog_context(session: AsyncSession, user_id: int, limit: int = 6
     )
     result = await session.execute(query)
     # Переворачиваем, чтобы старые были в начале (для контекста)
-    return result.scalars().all()[::-1]
+    stored = result.scalars().all()[::-1]
+    # Плюс записи, которые history_writer ещё не сбросил в БД (они новее сохранённых)
+    stored_ids = {msg.id for msg in stored}
+    pending = [msg for msg in history_writer.for_user(user_id) if msg.id not in stored_ids]
+    return (stored + pending)[-limit:]
 
 async def clear_history(session: AsyncSession, user_id: int):
     """Очистить контекст (кнопка 'Забыть' или 'Новый диалог')"""
     # В sqlite проще удалить, или можно ставить флаг is_archived
     # Для MVP просто удаляем
     from sqlalchemy import delete
+    # Сначала дописываем буфер: иначе строки из него лягут в БД уже после удаления
+    await history_writer.flush()
     stmt = delete(MessageHistory).where(MessageHistory.user_id == user_id)
     await session.execute(stmt)
     await session.commit()
 
 async def get_history_message_by_id(session: AsyncSession, msg_id: int):
-    """Возвращает запись из истории по её ID (primary key)"""
+    """Возвращает запись из истории по её ID (primary key); сначала — буфер history_writer"""
+    pending = history_writer.get(msg_id)
+    if pending:
+        return pending
     query = select(MessageHistory).where(MessageHistory.id == msg_id)
     result = await session.execute(query)
     return result.scalar_one_or_none()    
 
-async def start_generation_task(session: AsyncSession, user_id: int, cost: int):
+async def start_generation_task(session: AsyncSession, user_id: int, cost: int, chat_id: int = None):
     """Создает запись о начале генерации"""
-    task = GenerationTask(user_id=user_id, cost=cost, status="processing")
+    task = GenerationTask(user_id=user_id, cost=cost, status="processing", chat_id=chat_id)
     session.add(task)
     await session.commit()
     return task.id
 
-async def finish_generation_task(session: AsyncSession, task_id: int, status: str = "completed"):
-    """Помечает задачу как завершенную"""
-    query = select(GenerationTask).where(GenerationTask.id == task_id)
-    result = await session.execute(query)
-    task = result.scalar_one_or_none()
+def _lease(worker: str | None, lease_minutes: int) -> dict:
+    """Поля аренды задачи инстансом (без worker — задача ничья, как до аренды)"""
+    if not worker:
+        return {}
+    return {"claimed_by": worker, "claimed_until": datetime.now() + timedelta(minutes=lease_minutes)}
+
+async def reserve_generation(session: AsyncSession, user_id: int, cost: int, chat_id: int = None,
+                             worker: str = None, lease_minutes: int = 15) -> tuple[int | None, int]:
+    """
+    Резерв бананов под генерацию: атомарное списание + запись задачи в одной транзакции.
+    Запись 'processing' — квитанция резерва: дальше её либо закрывают (completed),
+    либо по ней возвращают бананы (refund_generation / refund_stuck_tasks).
+    worker — инстанс, который ведёт задачу: пока его аренда не истекла, другие её не трогают.
+    Возвращает (id задачи, остаток) или (None, 0), если бананов не хватило.
+    """
+    balance_left = await reserve_balance(session, user_id, cost)
+    if balance_left is None:
+        await session.rollback()
+        return None, 0
+    task = GenerationTask(user_id=user_id, cost=cost, status="processing", chat_id=chat_id,
+                          **_lease(worker, lease_minutes))
+    session.add(task)
+    await session.commit()
+    return task.id, balance_left
+
+async def refund_generation(session: AsyncSession, task_id: int) -> int:
+    """
+    Возврат по записи задачи. Статус меняется условным UPDATE — повторный
+    или параллельный возврат (таймаут + рестарт) ничего не начислит второй раз.
+    Возвращает число возвращённых бананов (0 — задача уже закрыта).
+    """
+    stmt = (
+        update(GenerationTask)
+        .where(GenerationTask.id == task_id, GenerationTask.status.in_(("processing", "submitted")))
+        .values(status="refunded")
+        .returning(GenerationTask.user_id, GenerationTask.cost)
+        .execution_options(synchronize_session=False)
+    )
+    row = (await session.execute(stmt)).first()
+    if not row:
+        await session.commit()
+        return 0
+    await session.execute(
+        update(User)
+        .where(User.telegram_id == row.user_id)
+        .values(generations_balance=User.generations_balance + row.cost)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return row.cost
+
+async def attach_kie_task(session: AsyncSession, task_id: int, kie_task_id: str, params: str, message_id: int = None,
+                          worker: str = None, lease_minutes: int = 15):
+    """
+    Запоминает taskId Kie и параметры: после рестарта задачу можно
+    не возвращать, а дождаться и доставить результат.
+    Аренда за worker — соседний инстанс не заберёт живую задачу в claim_resumable_tasks.
+    """
+    task = await session.get(GenerationTask, task_id)
     if task:
-        task.status = status
+        task.kie_task_id = kie_task_id
+        task.params = params
+        task.message_id = message_id
+        task.status = "submitted"
+        for field, value in _lease(worker, lease_minutes).items():
+            setattr(task, field, value)
         await session.commit()
 
-async def refund_stuck_tasks(session: AsyncSession):
+async def extend_task_lease(session: AsyncSession, task_id: int, worker: str, lease_minutes: int = 15) -> bool:
+    """Продлевает аренду, пока задачу ждём (только свою и только открытую)"""
+    result = await session.execute(
+        update(GenerationTask)
+        .where(
+            GenerationTask.id == task_id,
+            GenerationTask.claimed_by == worker,
+            GenerationTask.status.in_(("processing", "submitted")),
+        )
+        .values(claimed_until=datetime.now() + timedelta(minutes=lease_minutes))
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount > 0
+
+async def finish_generation_task(session: AsyncSession, task_id: int, status: str = "completed"):
+    """Помечает задачу как завершенную (закрытую задачу не трогает)"""
+    await session.execute(
+        update(GenerationTask)
+        .where(GenerationTask.id == task_id, GenerationTask.status.in_(("processing", "submitted")))
+        .values(status=status)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+
+async def get_resumable_tasks(session: AsyncSession):
+    """Задачи, которые уже ушли в Kie, но результат ещё не доставлен"""
+    query = select(GenerationTask).where(
+        GenerationTask.status == "submitted",
+        GenerationTask.kie_task_id.is_not(None)
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
+
+async def claim_resumable_tasks(session: AsyncSession, worker: str, lease_minutes: int = 15, limit: int = 100,
+                                previous_runs: str = None):
+    """
+    Забирает задачи для продолжения так, чтобы несколько инстансов бота не взяли одну и ту же.
+    PostgreSQL: SELECT ... FOR UPDATE SKIP LOCKED — занятые другим инстансом строки пропускаются,
+    а аренда (claimed_until) держит задачу за нами и после коммита. Упал инстанс —
+    аренда истекает, задачу заберёт следующий. SQLite FOR UPDATE не знает — там процесс один.
+    previous_runs — при старте: префикс claimed_by прошлых запусков этого инстанса,
+    их задачи уже никто не ведёт — ждать аренду незачем.
+    """
+    now = datetime.now()
+    free = _free_tasks(now, worker, previous_runs)
+    query = (
+        select(GenerationTask)
+        .where(
+            GenerationTask.status == "submitted",
+            GenerationTask.kie_task_id.is_not(None),
+            or_(*free),
+        )
+        .order_by(GenerationTask.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    tasks = (await session.execute(query)).scalars().all()
+    for task in tasks:
+        task.claimed_by = worker
+        task.claimed_until = now + timedelta(minutes=lease_minutes)
+    await session.commit()
+    return tasks
+
+def _free_tasks(now: datetime, worker: str = None, previous_runs: str = None) -> list:
+    """Условия "задача ничья": аренды нет, она истекла или это задача прошлого запуска этого инстанса"""
+    free = [GenerationTask.claimed_until.is_(None), GenerationTask.claimed_until < now]
+    if previous_runs:
+        free.append(and_(GenerationTask.claimed_by.startswith(previous_runs, autoescape=True),
+                         GenerationTask.claimed_by != worker))
+    return free
+
+async def refund_stuck_tasks(session: AsyncSession, older_than_minutes: int = 5,
+                             worker: str = None, previous_runs: str = None):
     """
     Находит все задачи, которые висят в 'processing' дольше 5 минут,
     возвращает бананы пользователям и помечает задачи как 'refunded'.
+    Задачи в 'submitted' (уже в Kie) сюда не попадают — их продолжает resume.
+    Задачи под живой арендой другого инстанса не трогаем: их прямо сейчас делают.
+    previous_runs — префикс claimed_by прошлых запусков этого инстанса (кроме текущего worker):
+    их задачи возвращаем, не дожидаясь аренды.
     """
+    now = datetime.now()
     # Время отсечки (сейчас минус 5 минут)
-    cutoff_time = datetime.now() - timedelta(minutes=5)
+    cutoff_time = now - timedelta(minutes=older_than_minutes)
+    free = _free_tasks(now, worker, previous_runs)
     
-    # Ищем зависшие задачи
-    query = select(GenerationTask).where(
-        GenerationTask.status == "processing",
-        GenerationTask.created_at < cutoff_time
+    # Зависшие задачи закрываем сразу — RETURNING отдаёт, кому и сколько вернуть
+    stmt = (
+        update(GenerationTask)
+        .where(
+            GenerationTask.status == "processing",
+            GenerationTask.created_at < cutoff_time,
+            or_(*free),
+        )
+        .values(status="refunded")
+        .returning(GenerationTask.user_id, GenerationTask.cost)
+        .execution_options(synchronize_session=False)
     )
-    result = await session.execute(query)
-    stuck_tasks = result.scalars().all()
-    
-    refunded_count = 0
-    refunded_bananas = 0
+    stuck_tasks = (await session.execute(stmt)).all()
     
+    per_user: dict[int, int] = {}
     for task in stuck_tasks:
+        per_user[task.user_id] = per_user.get(task.user_id, 0) + task.cost
+    
+    for user_id, bananas in per_user.items():
         # Возвращаем бананы юзеру
-        user_query = select(User).where(User.telegram_id == task.user_id)
-        user_res = await session.execute(user_query)
-        user = user_res.scalar_one_or_none()
-        
-        if user:
-            user.generations_balance += task.cost
-            task.status = "refunded"
-            refunded_count += 1
-            refunded_bananas += task.cost
+        await session.execute(
+            update(User)
+            .where(User.telegram_id == user_id)
+            .values(generations_balance=User.generations_balance + bananas)
+            .execution_options(synchronize_session=False)
+        )
             
     await session.commit()
-    return refunded_count, refunded_bananas
+    return len(stuck_tasks), sum(per_user.values())
 
 async def get_user_model_preference(session: AsyncSession, user_id: int) -> str:
     """Возвращает 'standard' или 'pro'"""
@@ -0,0 +1,160 @@
+import os
+import re
+import hmac
+import time
+import hashlib
+from aiohttp import web
+from app import config
+from app.services.kie_poller import kie_poller
+from app.services.blob_store import blob_store, temp_store
+
+# ==============================================================================
+# ВСТРОЕННЫЙ HTTP-СЕРВЕР (колбэки Kie + медиа по подписанным ссылкам)
+# ==============================================================================
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+# Внешний адрес сервера, который видит Kie (например https://bot.example.com)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+KIE_CALLBACK_PATH = "/kie/callback"
+# Секрет в query-параметре: чужой POST не сможет "завершить" нашу задачу
+KIE_CALLBACK_SECRET = os.getenv("KIE_CALLBACK_SECRET", "")
+
+
+MEDIA_PATH = "/media"
+MEDIA_TYPES = {"jpg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+_MEDIA_NAME = re.compile(r"^([0-9a-f]{64})\.(jpg|webp|png)$")
+# Срок жизни ссылки: провайдер успевает скачать, а утёкшая ссылка быстро протухает
+MEDIA_URL_TTL = int(os.getenv("MEDIA_URL_TTL", str(6 * 3600)))
+# Отдельный ключ: токен колбэка уходит в Kie в каждом callBackUrl — им подписывать нельзя
+MEDIA_URL_SECRET = os.getenv("MEDIA_URL_SECRET", "")
+if MEDIA_URL_SECRET and MEDIA_URL_SECRET == KIE_CALLBACK_SECRET:
+    print("⚠️ MEDIA_URL_SECRET совпадает с KIE_CALLBACK_SECRET — игнорирую, нужен отдельный ключ")
+    MEDIA_URL_SECRET = ""
+if not MEDIA_URL_SECRET and config.BOT_TOKEN:
+    # Ключ из токена бота: один и тот же после рестарта и у всех инстансов (resume, повторные
+    # ссылки), а сам токен никуда не уходит — по подписи его не восстановить
+    MEDIA_URL_SECRET = hmac.new(config.BOT_TOKEN.encode(), b"media-url", hashlib.sha256).hexdigest()
+if not MEDIA_URL_SECRET:
+    print("⚠️ MEDIA_URL_SECRET не задан — ссылки /media выключены, фото уходят ссылками Telegram")
+
+
+def _media_signature(name: str, expires: int) -> str:
+    return hmac.new(MEDIA_URL_SECRET.encode(), f"{name}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def media_url(blob_hash: str, ext: str, ttl: int = MEDIA_URL_TTL) -> str | None:
+    """
+    Подписанная ссылка на файл из blob store / временного хранилища.
+    None — сервер снаружи не виден, вызывающий идёт старым путём (ссылки Telegram).
+    """
+    if not PUBLIC_BASE_URL or not MEDIA_URL_SECRET or not blob_hash:
+        return None
+    name = f"{blob_hash}.{ext}"
+    expires = int(time.time()) + ttl
+    return f"{PUBLIC_BASE_URL}{MEDIA_PATH}/{name}?exp={expires}&sig={_media_signature(name, expires)}"
+
+
+def is_media_url(url: str) -> bool:
+    return bool(PUBLIC_BASE_URL and url and url.startswith(f"{PUBLIC_BASE_URL}{MEDIA_PATH}/"))
+
+
+def parse_media_url(url: str) -> tuple[str, str] | None:
+    """(хэш, расширение) из нашей ссылки /media; None — ссылка не наша"""
+    if not is_media_url(url):
+        return None
+    name = url[len(PUBLIC_BASE_URL) + len(MEDIA_PATH) + 1:].split("?", 1)[0]
+    match = _MEDIA_NAME.match(name)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def resign_media_url(url: str) -> str | None:
+    """
+    Новая подпись для нашей ссылки /media из истории (старая могла протухнуть).
+    None — ссылка не наша или файла уже нет в хранилищах.
+    """
+    media = parse_media_url(url)
+    if not media or not (temp_store.path(media[0]) or blob_store.path(media[0])):
+        return None
+    return media_url(*media)
+
+
+def kie_callback_url() -> str | None:
+    """Адрес для callBackUrl в createTask (None — колбэки выключены)"""
+    if not PUBLIC_BASE_URL or not KIE_CALLBACK_SECRET:
+        return None
+    return f"{PUBLIC_BASE_URL}{KIE_CALLBACK_PATH}?token={KIE_CALLBACK_SECRET}"
+
+
+async def handle_kie_callback(request: web.Request) -> web.Response:
+    """Kie сообщает о завершении задачи → сразу завершаем ожидающую генерацию"""
+    token = request.query.get("token", "")
+    if not KIE_CALLBACK_SECRET or not hmac.compare_digest(token, KIE_CALLBACK_SECRET):
+        return web.Response(status=403)
+
+    try:
+        body = await request.json()
+    except Exception:
+        return web.Response(status=400)
+
+    # Ждём объект; data, если есть, — тоже объект (иначе 400, а не 500 на .get)
+    if not isinstance(body, dict):
+        return web.Response(status=400)
+    data = body.get("data") or body
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    task_id = data.get("taskId")
+    if not task_id or not isinstance(task_id, str):
+        return web.Response(status=400)
+
+    print(f"📬 Kie callback: {task_id} → {data.get('state')}")
+    kie_poller.notify(task_id, data)
+    return web.json_response({"ok": True})
+
+
+async def handle_media(request: web.Request) -> web.StreamResponse:
+    """Провайдеры скачивают отсюда коллажи, подготовленные фото и оригиналы"""
+    name = request.match_info["name"]
+    match = _MEDIA_NAME.match(name)
+    try:
+        expires = int(request.query.get("exp", ""))
+    except ValueError:
+        return web.Response(status=403)
+    signature = request.query.get("sig", "")
+    if (not MEDIA_URL_SECRET or not match or expires < time.time()
+            or not hmac.compare_digest(signature, _media_signature(name, expires))):
+        return web.Response(status=403)
+
+    blob_hash = match.group(1)
+    path = temp_store.path(blob_hash) or blob_store.path(blob_hash)
+    if not path:
+        return web.Response(status=404)
+    return web.FileResponse(path, headers={
+        "Content-Type": MEDIA_TYPES[match.group(2)],
+        "Cache-Control": f"private, max-age={max(0, expires - int(time.time()))}",
+    })
+
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(KIE_CALLBACK_PATH, handle_kie_callback)
+    app.router.add_get(f"{MEDIA_PATH}/{{name}}", handle_media)
+    return app
+
+
+async def start_web_server() -> web.AppRunner | None:
+    """Поднимает сервер (колбэки + медиа), если задан PUBLIC_BASE_URL"""
+    if not PUBLIC_BASE_URL:
+        print("ℹ️ Нет PUBLIC_BASE_URL — колбэки Kie выключены (работаем через опрос), фото идут ссылками Telegram.")
+        return None
+
+    runner = web.AppRunner(build_web_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_HOST, WEB_PORT)
+    await site.start()
+    if kie_callback_url():
+        kie_poller.callbacks_enabled = True
+        print(f"🌐 Сервер колбэков: {WEB_HOST}:{WEB_PORT}{KIE_CALLBACK_PATH}")
+    else:
+        print("ℹ️ Колбэки Kie выключены (нет KIE_CALLBACK_SECRET) — работаем через опрос.")
+    print(f"🖼 Медиа по подписанным ссылкам: {PUBLIC_BASE_URL}{MEDIA_PATH}/ (TTL {MEDIA_URL_TTL // 60} мин)")
+    return runner
@@ -1,18 +1,25 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from app.database import engine, Base
+from app.database import init_db
 from app.handlers import start, generation, payment, menu_actions, admin
 from app.middlewares.album import AlbumMiddleware # <--- ИМПОРТ
 from app.middlewares.admin_spy import AdminSpyMiddleware
+from app.services.http_client import close_http_session
+from app.services.kie_poller import kie_poller
+from app.services.web_server import start_web_server
+from app.services.job_queue import generation_queue
+from app.services.image_pool import image_pool
+from app.services.blob_store import temp_cleanup_loop
+from app.services.history_writer import history_writer
 
 from app import config
 
 async def main():
     logging.basicConfig(level=logging.INFO)
     
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Таблицы + миграции схемы существующей bot.db
+    await init_db()
 
     bot = Bot(token=config.BOT_TOKEN)
     dp = Dispatcher()
@@ -28,8 +35,34 @@ async def main():
     dp.include_router(menu_actions.router)
     dp.include_router(generation.router)
 
+    # Сервер колбэков Kie и подписанных ссылок /media (если настроен внешний адрес)
+    web_runner = await start_web_server()
+    # Воркеры очереди генераций
+    generation_queue.start()
+    # Процессы Pillow (превью, коллажи, подготовка фото)
+    await image_pool.start()
+    # Чистка временных файлов (коллажи, подготовленные фото) по TTL
+    cleanup_task = asyncio.create_task(temp_cleanup_loop())
+    # Отложенная запись истории пачками
+    history_writer.start()
+    # Задачи, ушедшие в Kie до рестарта (и задачи упавших инстансов): дожидаемся и доставляем
+    # (или возвращаем бананы)
+    recovery_task = asyncio.create_task(generation.task_recovery_loop(bot))
+
     print("✅ Бот запущен!")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        cleanup_task.cancel()
+        recovery_task.cancel()
+        await generation_queue.stop()
+        # После очереди: последние генерации успевают положить историю в буфер
+        await history_writer.stop()
+        if web_runner:
+            await web_runner.cleanup()
+        await kie_poller.stop()
+        image_pool.shutdown()
+        await close_http_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
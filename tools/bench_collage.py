@@ -0,0 +1,74 @@
+"""
+Бенчмарк коллажа: 4 фото по 12 Мп (4000x3000 JPEG, как с телефона).
+
+Запуск:
+    python tools/bench_collage.py
+    python tools/bench_collage.py --count 2 --repeat 10
+
+old — прежний путь: полное декодирование, copy() + LANCZOS thumbnail, PNG.
+new — image_ops.build_collage: draft/reduce при декодировании, раскладка и JPEG за один проход.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image  # noqa: E402
+from app.services.image_ops import build_collage  # noqa: E402
+
+
+def make_photo(width: int = 4000, height: int = 3000) -> bytes:
+    """Фото-подобный JPEG: градиент + немного шума (чистый шум нереалистично тяжёл для JPEG)"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.frombytes("L", (width // 8, height // 8), os.urandom(width // 8 * height // 8)).resize((width, height))
+    img = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def old_collage(images_data: list[bytes], max_size: int = 1024) -> bytes:
+    images = [Image.open(io.BytesIO(data)) for data in images_data]
+    cols, rows = (2, 1) if len(images) == 2 else (2, 2)
+    cell_w, cell_h = max_size // cols, max_size // rows
+    canvas = Image.new('RGB', (max_size, max_size), 'white')
+    for idx, img in enumerate(images):
+        img_resized = img.copy()
+        img_resized.thumbnail((cell_w, cell_h), Image.Resampling.LANCZOS)
+        x = idx % cols * cell_w + (cell_w - img_resized.width) // 2
+        y = idx // cols * cell_h + (cell_h - img_resized.height) // 2
+        canvas.paste(img_resized, (x, y))
+    out = io.BytesIO()
+    canvas.save(out, format='PNG')
+    return out.getvalue()
+
+
+def bench(name: str, fn, photos: list[bytes], repeat: int):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(photos)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    print(f"{name:>4}: медиана {times[len(times) // 2] * 1000:.0f} мс, max {times[-1] * 1000:.0f} мс, "
+          f"результат {len(result) / 1024:.0f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=4, choices=[2, 3, 4])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    photos = [make_photo() for _ in range(args.count)]
+    print(f"{args.count} фото 4000x3000, {sum(map(len, photos)) / 1024 / 1024:.1f} MB JPEG")
+    bench("old", old_collage, photos, args.repeat)
+    bench("new", build_collage, photos, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
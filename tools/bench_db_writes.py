@@ -0,0 +1,150 @@
+"""
+Бенчмарк записи в bot.db под конкурентной нагрузкой: старый профиль SQLite vs продовый.
+
+Запуск:
+    python tools/bench_db_writes.py                      # оба профиля
+    python tools/bench_db_writes.py -n 2000 -c 50 --profile production
+    python tools/bench_db_writes.py --history buffered   # история через history_writer
+
+Нагрузка — как у генерации: резерв бананов (reserve_generation), две записи истории
+(add_history), закрытие задачи, плюс чтение контекста диалога (get_dialog_context).
+legacy     — как было: echo=True, journal_mode=DELETE, synchronous=FULL, без mmap, кэш 2 МБ.
+production — профиль app/database.py по умолчанию: WAL, synchronous=NORMAL, mmap, кэш, пул.
+--history direct — add_history с коммитом на каждую строку; buffered — history_writer
+(строки в буфер, в БД многострочным INSERT пачками).
+Каждый профиль — в отдельном процессе (настройки движка читаются из env при импорте),
+база — во временной папке.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PROFILES = {
+    "legacy": {
+        "DB_ECHO": "1",
+        "SQLITE_JOURNAL_MODE": "DELETE",
+        "SQLITE_SYNCHRONOUS": "FULL",
+        "SQLITE_MMAP_MB": "0",
+        "SQLITE_CACHE_MB": "2",
+        "DB_POOL_SIZE": "5",
+    },
+    "production": {
+        "DB_ECHO": "0",
+    },
+}
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def worker_main(jobs: int, concurrency: int, users: int, history: str) -> dict:
+    sys.path.insert(0, str(ROOT))
+    from app.database import async_session, init_db, engine
+    from app.services.user_service import (
+        create_user, admin_change_balance, reserve_generation,
+        add_history, finish_generation_task, get_dialog_context,
+    )
+    from app.services.history_writer import history_writer
+
+    await init_db()
+    async with async_session() as session:
+        for i in range(users):
+            await create_user(session, 1000 + i, f"bench{i}", f"Bench {i}")
+            await admin_change_balance(session, 1000 + i, jobs)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        user_id = 1000 + i % users
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with async_session() as session:
+                    task_id, _ = await reserve_generation(session, user_id, 1)
+                    await get_dialog_context(session, user_id)
+                    if history == "buffered":
+                        await history_writer.add(user_id, "user", f"prompt {i}")
+                        await history_writer.add(user_id, "model", "{}", has_image=True, file_id="stub")
+                    else:
+                        await add_history(session, user_id, "user", f"prompt {i}")
+                        await add_history(session, user_id, "model", "{}", has_image=True, file_id="stub")
+                    await finish_generation_task(session, task_id, "completed")
+            except Exception as e:
+                errors += 1
+                print(f"❌ {e}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    history_writer.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(jobs)))
+    # Буфер дописывается внутри замера — честное сравнение с direct
+    await history_writer.stop()
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+
+    # 4 записи на генерацию: резерв (баланс + задача — один коммит), 2 истории, закрытие задачи
+    return {
+        "jobs": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "gens_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "commits_per_sec": len(latencies) * 4 / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_profile(name: str, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix=f"nanana-db-{name}-") as tmp:
+        out = Path(tmp) / "result.json"
+        env = {**os.environ, **PROFILES[name], "DATABASE_URL": f"sqlite+aiosqlite:///{tmp}/bot.db"}
+        cmd = [
+            sys.executable, __file__, "--worker", str(out),
+            "-n", str(args.jobs), "-c", str(args.concurrency), "--users", str(args.users),
+            "--history", args.history,
+        ]
+        # echo legacy-профиля пишет в stdout — глушим, но время на него остаётся в замере
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+        return json.loads(out.read_text())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", choices=["legacy", "production", "both"], default="both")
+    parser.add_argument("-n", "--jobs", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--history", choices=["direct", "buffered"], default="direct")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = asyncio.run(worker_main(args.jobs, args.concurrency, args.users, args.history))
+        Path(args.worker).write_text(json.dumps(result))
+        return
+
+    profiles = ["legacy", "production"] if args.profile == "both" else [args.profile]
+    print(f"{args.jobs} генераций, {args.concurrency} параллельно, {args.users} пользователей, история: {args.history}")
+    for name in profiles:
+        r = run_profile(name, args)
+        print(
+            f"{name:>10}: {r['commits_per_sec']:.0f} коммитов/с ({r['gens_per_sec']:.0f} ген/с) | "
+            f"p50 {r['p50_ms']:.1f} мс, p99 {r['p99_ms']:.1f} мс | ошибок {r['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
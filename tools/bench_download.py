@@ -0,0 +1,98 @@
+"""
+Бенчмарк памяти: 50 одновременных "4K" результатов, буфер в памяти vs стрим на диск.
+
+Запуск:
+    python tools/bench_download.py                 # оба режима, каждый в отдельном процессе
+    python tools/bench_download.py --jobs 50 --size-mb 24
+
+buffered — старый путь: resp.read() → BufferedInputFile → копия на сжатие.
+streamed — новый путь: чанки сразу в blob store, наружу только путь к файлу.
+Пиковый RSS меряется через ru_maxrss, поэтому каждый режим — в своём процессе.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiohttp import web, ClientSession  # noqa: E402
+
+
+async def start_server(payload: bytes, port: int) -> web.AppRunner:
+    async def handler(request):
+        resp = web.StreamResponse(headers={"Content-Type": "image/png", "Content-Length": str(len(payload))})
+        await resp.prepare(request)
+        view = memoryview(payload)
+        for i in range(0, len(payload), 256 * 1024):
+            await resp.write(view[i:i + 256 * 1024])
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/result.png", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+async def run_mode(mode: str, jobs: int, size_mb: int, port: int):
+    payload = os.urandom(size_mb * 1024 * 1024)
+    runner = await start_server(payload, port)
+    del payload
+    url = f"http://127.0.0.1:{port}/result.png"
+    baseline = peak_rss_mb()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        from app.services.blob_store import BlobStore
+        store = BlobStore(root=Path(tmp), max_bytes=10 * 1024 ** 3)
+        results = []
+
+        async with ClientSession() as session:
+            async def one():
+                async with session.get(url) as resp:
+                    if mode == "buffered":
+                        data = await resp.read()
+                        results.append(data)
+                        results.append(bytearray(data))  # вторая копия — как на пути к smart_compress_image
+                    else:
+                        results.append(await store.put_stream(resp.content.iter_chunked(256 * 1024)))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(jobs)))
+            elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    print(f"{mode:>9}: {jobs} x {size_mb} MB за {elapsed:.2f}с | пиковый RSS {peak_rss_mb():.0f} MB (база {baseline:.0f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["buffered", "streamed", "both"], default="both")
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument("--size-mb", type=int, default=24, help="размер одного результата (PRO 4K PNG ≈ 20-30 MB)")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    if args.mode == "both":
+        for mode in ("buffered", "streamed"):
+            subprocess.run([sys.executable, __file__, "--mode", mode, "--jobs", str(args.jobs),
+                            "--size-mb", str(args.size_mb), "--port", str(args.port)], check=True)
+        return
+
+    asyncio.run(run_mode(args.mode, args.jobs, args.size_mb, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Бенчмарк задержки event loop: Pillow прямо в корутине vs в пуле процессов.
+
+Запуск:
+    python tools/bench_loop_lag.py                       # оба режима
+    python tools/bench_loop_lag.py --mode pool --jobs 40 --side 4096
+
+Смешанная нагрузка: N превью 4K-результатов (encode_preview) + коллажи из 3 фото
++ "лёгкие апдейты" — тикер раз в 10 мс, как обработка сообщений других пользователей.
+Лаг = насколько позже тикер проснулся, чем должен был. Ниже — лучше.
+
+inline — старый путь: функции вызываются прямо на event loop.
+pool   — новый путь: через app.services.image_pool (ProcessPoolExecutor).
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image  # noqa: E402
+from app.services.image_ops import encode_preview, build_collage  # noqa: E402
+from app.services.image_pool import ImagePool  # noqa: E402
+
+TICK = 0.01
+
+
+def make_noise_png(path: Path, side: int):
+    """Шумный PNG — худший случай для превью: подбор качества делает несколько проходов"""
+    img = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    img.save(path, format="PNG", compress_level=1)
+
+
+def make_jpeg(side: int) -> bytes:
+    img = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def run_mode(mode: str, jobs: int, result_path: Path, photos: list[bytes], workers: int):
+    pool = ImagePool(workers=workers) if mode == "pool" else None
+    if pool:
+        await pool.start()
+
+    async def preview():
+        if pool:
+            return await pool.run(encode_preview, str(result_path))
+        return encode_preview(str(result_path))
+
+    async def collage():
+        if pool:
+            return await pool.run(build_collage, photos, 1024)
+        return build_collage(photos, 1024)
+
+    lags, stop = [], asyncio.Event()
+    tick_task = asyncio.create_task(ticker(lags, stop))
+    await asyncio.sleep(0.2)  # базовая линия тикера
+
+    started = time.perf_counter()
+    await asyncio.gather(*(preview() if i % 3 else collage() for i in range(jobs)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await tick_task
+    if pool:
+        pool.shutdown()
+
+    print(
+        f"{mode:>6}: {jobs} задач за {elapsed:.2f}с ({jobs / elapsed:.1f}/с) | "
+        f"лаг loop p50 {percentile(lags, 0.5) * 1000:.1f} мс, p99 {percentile(lags, 0.99) * 1000:.1f} мс, "
+        f"max {max(lags) * 1000:.0f} мс"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["inline", "pool", "both"], default="both")
+    parser.add_argument("--jobs", type=int, default=24)
+    parser.add_argument("--side", type=int, default=4096, help="сторона 'результата' для превью, px")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 2))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = Path(tmp) / "result.png"
+        make_noise_png(result_path, args.side)
+        photos = [make_jpeg(2048) for _ in range(3)]
+        print(f"Результат: {result_path.stat().st_size / 1024 / 1024:.1f} MB, фото для коллажа: 3 x 2048px")
+
+        modes = ["inline", "pool"] if args.mode == "both" else [args.mode]
+        for mode in modes:
+            asyncio.run(run_mode(mode, args.jobs, result_path, photos, args.workers))
+
+
+if __name__ == "__main__":
+    main()
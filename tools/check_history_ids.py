@@ -0,0 +1,104 @@
+"""
+Проверка резерва id истории (history_writer) против других вставок в message_history.
+
+Запуск:
+    python tools/check_history_ids.py
+
+Что проверяется (SQLite во временной папке):
+- апгрейд старой базы: message_history без AUTOINCREMENT перестраивается миграцией 5,
+  строки и их id на месте, счётчик — после них с отступом;
+- id, зарезервированный буфером и уже отданный кнопкам, не достаётся add_history
+  (вставка без id между резервом и записью пачки);
+- второй процесс (отдельный HistoryWriter) получает другой блок id;
+- после записи пачек ни одной строки в dead letter, по id кнопки — своя запись.
+Код выхода 1 — хоть одна проверка не прошла.
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def report(name: str, ok: bool, details: str) -> bool:
+    print(f"{'✅' if ok else '❌'} {name}: {details}")
+    return ok
+
+
+def create_old_history(path: str):
+    """message_history как её создавали до миграции 5 (id без AUTOINCREMENT)"""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE message_history (id INTEGER NOT NULL PRIMARY KEY, user_id BIGINT NOT NULL, "
+        "role VARCHAR NOT NULL, content TEXT NOT NULL, has_image BOOLEAN NOT NULL, "
+        "file_id VARCHAR, image_url VARCHAR, created_at DATETIME DEFAULT (CURRENT_TIMESTAMP))"
+    )
+    conn.executemany(
+        "INSERT INTO message_history (id, user_id, role, content, has_image) VALUES (?, 1, 'user', ?, 0)",
+        [(i, f"old {i}") for i in (1, 2, 3)],
+    )
+    conn.commit()
+    conn.close()
+
+
+async def run() -> bool:
+    from sqlalchemy import text
+    from app.database import async_session, engine, init_db
+    from app.services import user_service as us
+    from app.services.history_writer import HistoryWriter
+
+    checks = []
+    await init_db()
+    async with engine.connect() as conn:
+        ddl = (await conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message_history'"
+        ))).scalar()
+        old_ids = [row[0] for row in await conn.execute(text("SELECT id FROM message_history ORDER BY id"))]
+        seq = (await conn.execute(text(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'message_history'"
+        ))).scalar()
+    checks.append(report("апгрейд старой таблицы", "AUTOINCREMENT" in ddl.upper() and old_ids == [1, 2, 3]
+                         and seq == 1003, f"id {old_ids}, счётчик {seq}"))
+
+    # Процесс A: id уже в кнопке, строка ещё в буфере
+    writer_a = HistoryWriter(flush_rows=1000)
+    button_id = await writer_a.add(7, "model", "mine", has_image=True)
+    # Тем временем — обычная вставка без id (add_history) и второй процесс
+    async with async_session() as session:
+        direct = await us.add_history(session, 8, "user", "someone else")
+    writer_b = HistoryWriter(flush_rows=1000)
+    other_id = await writer_b.add(9, "user", "other process")
+    checks.append(report("add_history не берёт зарезервированный id", direct.id > button_id
+                         and direct.id not in writer_a._free_ids,
+                         f"кнопка {button_id}, add_history {direct.id}"))
+    checks.append(report("второй процесс — свой блок", other_id > direct.id and other_id not in writer_a._free_ids,
+                         f"A {button_id}.., B {other_id}"))
+
+    await writer_a.flush()
+    await writer_b.flush()
+    async with async_session() as session:
+        row = await us.get_history_message_by_id(session, button_id)
+    dead = writer_a.dead_letters + writer_b.dead_letters
+    checks.append(report("пачки записаны без dead letter", dead == 0 and row is not None and row.content == "mine",
+                         f"dead {dead}, по кнопке: {row.content if row else None}"))
+
+    await engine.dispose()
+    return all(checks)
+
+
+def main():
+    with tempfile.TemporaryDirectory(prefix="nanana-history-") as tmp:
+        # SQLite bot.db во временной папке, со старой таблицей истории
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tmp)
+        create_old_history(os.path.join(tmp, "bot.db"))
+        ok = asyncio.run(run())
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Проверка планов запросов горячего пути (EXPLAIN QUERY PLAN, SQLite).
+
+Запуск:
+    python tools/check_query_plans.py
+    python tools/check_query_plans.py -v      # показать планы целиком
+
+Во временной папке создаётся bot.db через init_db (create_all + миграции),
+затем реальные функции user_service выполняются с перехватом SQL:
+каждый запрос прогоняется через EXPLAIN QUERY PLAN с теми же параметрами.
+Для каждой функции — ожидаемый индекс; полный просмотр таблицы (SCAN) — ошибка.
+Отдельно проверяется апгрейд "старой" базы: без индексов и schema_migrations.
+Код выхода 1 — хоть один план не такой, как ожидалось.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# функция → индекс, которым она обязана пользоваться
+EXPECTED = {
+    "get_dialog_context": "ix_message_history_user_created",
+    "is_user_premium": "ix_purchases_user_status_created",
+    "get_user_profile_data": "ix_purchases_user_status_created",
+    "get_resumable_tasks": "ix_generation_tasks_status_kie",
+    # ORDER BY created_at LIMIT — индекс по статусу и дате отдаёт строки уже по порядку
+    "claim_resumable_tasks": "ix_generation_tasks_status_created",
+    "refund_stuck_tasks": "ix_generation_tasks_status_created",
+}
+
+
+class StatementRecorder:
+    """Собирает SQL, который уходит в драйвер, пока recording=True"""
+
+    def __init__(self):
+        self.recording = False
+        self.statements: list[tuple[str, tuple]] = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.recording and not executemany:
+            self.statements.append((statement, parameters))
+
+
+async def explain(engine, statement: str, parameters) -> list[str]:
+    async with engine.connect() as conn:
+        rows = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[-1] for row in rows]
+
+
+async def check_function(engine, recorder, name: str, call, verbose: bool) -> bool:
+    recorder.statements.clear()
+    recorder.recording = True
+    try:
+        await call()
+    finally:
+        recorder.recording = False
+
+    expected = EXPECTED[name]
+    ok, seen = True, False
+    for statement, parameters in recorder.statements:
+        if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            continue
+        plan = await explain(engine, statement, parameters)
+        uses_expected = any(expected in line for line in plan)
+        # SCAN без индекса по таблицам, которые растут (users ищется по unique telegram_id)
+        full_scans = [line for line in plan if line.startswith("SCAN") and "INDEX" not in line]
+        seen = seen or uses_expected
+        if full_scans:
+            ok = False
+        if verbose or full_scans:
+            print(f"   {statement.split()[0]} … {' | '.join(plan)}")
+    ok = ok and seen
+    print(f"{'✅' if ok else '❌'} {name}: {'индекс ' + expected if seen else 'ожидался ' + expected}")
+    return ok
+
+
+async def run(verbose: bool) -> bool:
+    from sqlalchemy import event, text
+    from sqlalchemy.schema import CreateTable
+    from app.database import Base, engine, async_session, init_db
+    from app import models  # noqa: F401 — регистрирует таблицы в Base.metadata
+    from app.migrations import MIGRATIONS
+    from app.services import user_service
+
+    # "Старая" база: таблицы без индексов и без учёта миграций — как живая bot.db до этого шага
+    async with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            # CreateTable — только таблица, без индексов из __table_args__
+            await conn.execute(CreateTable(table, if_not_exists=True))
+    await init_db()
+    async with engine.connect() as conn:
+        version = (await conn.execute(text("SELECT MAX(version) FROM schema_migrations"))).scalar()
+    upgraded = version == MIGRATIONS[-1][0]
+    print(f"{'✅' if upgraded else '❌'} апгрейд старой базы: версия схемы {version}")
+
+    # Немного данных, чтобы планировщику было что выбирать: как в живой базе,
+    # почти все задачи завершены, несколько висят в Kie, пара только что стартовала
+    async with async_session() as session:
+        for i in range(50):
+            await user_service.create_user(session, 1000 + i, f"user{i}", f"User {i}")
+            await user_service.add_history(session, 1000 + i, "user", "hello")
+            for j in range(10):
+                task_id = await user_service.start_generation_task(session, 1000 + i, 1)
+                if j < 9 or i % 10:
+                    await user_service.attach_kie_task(session, task_id, f"kie-{i}-{j}", "{}")
+                if j < 9:
+                    await user_service.finish_generation_task(session, task_id, "completed")
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql("ANALYZE")
+
+    recorder = StatementRecorder()
+    event.listen(engine.sync_engine, "before_cursor_execute", recorder)
+
+    async def with_session(fn, *args, **kwargs):
+        async with async_session() as session:
+            return await fn(session, *args, **kwargs)
+
+    checks = {
+        "get_dialog_context": lambda: with_session(user_service.get_dialog_context, 1001),
+        "is_user_premium": lambda: with_session(user_service.is_user_premium, 1001),
+        "get_user_profile_data": lambda: with_session(user_service.get_user_profile_data, 1001),
+        "get_resumable_tasks": lambda: with_session(user_service.get_resumable_tasks),
+        "claim_resumable_tasks": lambda: with_session(user_service.claim_resumable_tasks, "check:1:1", previous_runs="check:"),
+        "refund_stuck_tasks": lambda: with_session(user_service.refund_stuck_tasks, older_than_minutes=60,
+                                                   worker="check:1:1", previous_runs="check:"),
+    }
+    results = [await check_function(engine, recorder, name, call, verbose) for name, call in checks.items()]
+    await engine.dispose()
+    return upgraded and all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="nanana-plans-") as tmp:
+        # bot.db по относительному пути — во временной папке
+        os.chdir(tmp)
+        ok = asyncio.run(run(args.verbose))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
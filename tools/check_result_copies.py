@@ -0,0 +1,134 @@
+"""
+Проверка: сколько копий результата держит бот в памяти на одну генерацию (tracemalloc).
+
+Запуск:
+    python tools/check_result_copies.py
+    python tools/check_result_copies.py --side 4096 --max-copies 0.25
+
+Результат "скачивается" в blob store чанками, дальше — deliver_generation_result целиком:
+превью (в пуле процессов), send_photo, лог, история. Фейковый бот читает отправляемые
+файлы так же, как aiogram при загрузке — чанками через InputFile.read().
+Пик аллокаций Python сравнивается с размером оригинала: одна копия в памяти = 1.0.
+Превью кодируется в другом процессе, а пиксели Pillow живут вне кучи Python — их tracemalloc не видит.
+Код выхода 1 — пик выше --max-copies.
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+CHUNK = 256 * 1024
+
+
+def make_result_png(side: int) -> bytes:
+    """Шумный PNG — как 4K-результат Kie по размеру (десятки MB)"""
+    from PIL import Image
+    img = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    out = io.BytesIO()
+    img.save(out, format="PNG", compress_level=1)
+    return out.getvalue()
+
+
+class ReadingBot:
+    """Вычитывает каждый отправленный файл чанками и ничего не хранит"""
+
+    def __init__(self):
+        self.uploaded = 0
+
+    async def _consume(self, file):
+        async for chunk in file.read(self):
+            self.uploaded += len(chunk)
+
+    async def send_photo(self, chat_id=None, photo=None, **kwargs):
+        await self._consume(photo)
+        return SimpleNamespace(
+            photo=[SimpleNamespace(file_id="stub-photo")], document=None,
+            edit_reply_markup=self._noop,
+        )
+
+    async def send_document(self, chat_id=None, document=None, **kwargs):
+        await self._consume(document)
+        return SimpleNamespace(
+            photo=None, document=SimpleNamespace(file_id="stub-document"),
+            edit_reply_markup=self._noop,
+        )
+
+    async def _noop(self, **kwargs):
+        return True
+
+
+async def run(args) -> bool:
+    from app import config
+    config.ADMIN_CHANNEL_ID = 0
+
+    from app.database import init_db
+    from app.services.blob_store import blob_store
+    from app.services.image_pool import image_pool
+    from app.services.results import GenerationResult
+    from app.handlers.generation import deliver_generation_result
+
+    await init_db()
+    await image_pool.start()
+
+    png = make_result_png(args.side)
+    size = len(png)
+    path = Path("result.png")
+    path.write_bytes(png)
+    del png
+    print(f"Результат: {args.side}x{args.side} PNG, {size / 1024 / 1024:.1f} MB")
+
+    async def chunks():
+        # Как kie_client.download_to_store: чанки из сети сразу на диск
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK):
+                yield chunk
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        blob_hash = await blob_store.put_stream(chunks())
+        result = GenerationResult(blob_hash, None, "result.png")
+        bot = ReadingBot()
+        await deliver_generation_result(
+            bot, 1, SimpleNamespace(username="check"), 1, "copy check", [],
+            "1:1", 1, True, "4K", result, 0
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        image_pool.shutdown()
+
+    copies = peak / size
+    print(f"Отправлено в фейковый Telegram: {bot.uploaded / 1024 / 1024:.1f} MB")
+    print(f"Пик аллокаций Python: {peak / 1024 / 1024:.1f} MB = {copies:.2f} копии оригинала "
+          f"(порог {args.max_copies})")
+    return copies <= args.max_copies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--side", type=int, default=4096, help="сторона результата, px")
+    parser.add_argument("--max-copies", type=float, default=0.5,
+                        help="допустимый пик в долях размера оригинала (1.0 — целая копия)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="nanana-copies-") as tmp:
+        os.environ["BLOB_STORE_DIR"] = str(Path(tmp) / "media" / "blobs")
+        os.environ["TEMP_STORE_DIR"] = str(Path(tmp) / "media" / "tmp")
+        os.environ["GOOGLE_API_KEY"] = ""
+        # bot.db по относительному пути — во временной папке
+        os.chdir(tmp)
+        ok = asyncio.run(run(args))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Проверка роутера провайдеров на фейковых провайдерах (без Kie, Google и сети).
+
+Запуск:
+    python tools/check_router.py
+
+Что проверяется:
+- p95 считается по полосам: медленные 4K у дешёвого провайдера не уводят Standard к дорогому;
+- дедлайн хеджа — по p95 полосы запроса: медленный Standard хеджится, второй побеждает;
+- провайдер с открытым breaker'ом пропускается, а по истечении open_seconds получает пробу и возвращается;
+- быстрый отказ основного — сразу фолбэк во второй (не ждём дедлайн);
+- ProviderBusyError у всех — пробрасывается наверх.
+Дедлайны уменьшены через ENGINE_HEDGE_* — проверка идёт доли секунды.
+Код выхода 1 — хоть одна проверка не прошла.
+"""
+import asyncio
+import os
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Масштаб: 1 "секунда" продакшена = 10 мс здесь
+os.environ.setdefault("ENGINE_HEDGE_MIN_SEC", "0.05")
+os.environ.setdefault("ENGINE_HEDGE_DEFAULT_SEC", "0.45")
+os.environ.setdefault("ENGINE_COST_WEIGHT_SEC", "0.1")
+
+from app.services.providers import ImageProvider, ProviderRouter, GenerationRequest  # noqa: E402
+from app.services.resilience import ProviderBusyError  # noqa: E402
+
+
+class FakeProvider(ImageProvider):
+    """Отвечает через delay секунд строкой со своим именем (или None/исключением)"""
+
+    def __init__(self, name: str, cost: float, delay: float = 0.0, result=True, error: Exception = None):
+        self.name = name
+        super().__init__(cost=cost)
+        self.delay = delay
+        self.result = result
+        self.error = error
+        self.calls = 0
+
+    async def _generate(self, req: GenerationRequest):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return f"{self.name}:{req.lane}" if self.result else None
+
+    def seed(self, lane: str, latency: float, count: int = 20):
+        """Подкладывает историю латентностей полосы (как после реального трафика)"""
+        self._latencies[lane] = deque([latency] * count, maxlen=100)
+
+
+def report(name: str, ok: bool, details: str) -> bool:
+    print(f"{'✅' if ok else '❌'} {name}: {details}")
+    return ok
+
+
+STANDARD = GenerationRequest(prompt="cat")
+PRO_4K = GenerationRequest(prompt="cat", use_pro=True, resolution="4K")
+
+
+async def run() -> bool:
+    checks = []
+
+    # 1. Латентности по полосам: Kie дёшев и быстр на Standard, медленный только на 4K
+    kie = FakeProvider("kie", cost=1.0)
+    google = FakeProvider("google", cost=1.5)
+    kie.seed("standard", 0.12)
+    kie.seed("pro_4k", 0.90)
+    google.seed("standard", 0.12)
+    router = ProviderRouter([kie, google], hedging=False)
+    order = [p.name for p in router.rank(STANDARD)]
+    checks.append(report("Standard не уходит к дорогому из-за 4K", order[0] == "kie",
+                         f"порядок {order}, p95 kie: standard {kie.p95('standard')}, 4K {kie.p95('pro_4k')}"))
+    order_4k = [p.name for p in router.rank(PRO_4K)]
+    checks.append(report("4K ранжируется по своей p95", order_4k[0] == "google",
+                         f"порядок {order_4k}"))
+
+    # 2. Хедж по дедлайну полосы: Kie на Standard вдруг тормозит, Google отвечает быстро
+    kie = FakeProvider("kie", cost=1.0, delay=0.5)
+    google = FakeProvider("google", cost=1.5, delay=0.05)
+    kie.seed("standard", 0.10)
+    kie.seed("pro_4k", 0.90)
+    router = ProviderRouter([kie, google], hedging=True)
+    started = time.monotonic()
+    result = await router.generate(STANDARD)
+    elapsed = time.monotonic() - started
+    checks.append(report("хедж по p95 Standard", result == "google:standard" and router.hedges_won == 1 and elapsed < 0.4,
+                         f"результат {result}, хеджей {router.hedges_started}/{router.hedges_won}, {elapsed:.2f}с"))
+
+    # 3. Открытый breaker — провайдер не выбирается
+    kie = FakeProvider("kie", cost=1.0)
+    google = FakeProvider("google", cost=1.5)
+    for _ in range(kie.breaker.min_calls):
+        kie.breaker.record_failure()
+    router = ProviderRouter([kie, google], hedging=True)
+    result = await router.generate(STANDARD)
+    checks.append(report("открытый breaker пропускается", result == "google:standard" and kie.calls == 0,
+                         f"результат {result}, вызовов kie {kie.calls}"))
+
+    # 3б. Восстановление: open_seconds вышло — одна проба, успех закрывает breaker
+    kie.breaker.open_seconds = 0.05
+    await asyncio.sleep(0.06)
+    result = await router.generate(STANDARD)
+    checks.append(report("после open_seconds — проба и возврат", result == "kie:standard"
+                         and kie.breaker.state == "closed",
+                         f"результат {result}, breaker kie {kie.breaker.state}"))
+    # Неудачная проба снова открывает breaker, запрос уходит во второй
+    kie.error = RuntimeError("still down")
+    for _ in range(kie.breaker.min_calls):
+        kie.breaker.record_failure()
+    await asyncio.sleep(0.06)
+    result = await router.generate(STANDARD)
+    checks.append(report("неудачная проба → снова open", result == "google:standard"
+                         and kie.breaker.state == "open",
+                         f"результат {result}, breaker kie {kie.breaker.state}"))
+
+    # 4. Быстрый отказ основного — фолбэк без ожидания дедлайна
+    kie = FakeProvider("kie", cost=1.0, result=False)
+    google = FakeProvider("google", cost=1.5)
+    router = ProviderRouter([kie, google], hedging=True)
+    started = time.monotonic()
+    result = await router.generate(STANDARD)
+    elapsed = time.monotonic() - started
+    checks.append(report("фолбэк при отказе", result == "google:standard" and elapsed < 0.04,
+                         f"результат {result}, {elapsed:.3f}с"))
+
+    # 5. Все заняты — ProviderBusyError наверх
+    router = ProviderRouter([
+        FakeProvider("kie", cost=1.0, error=ProviderBusyError("kie busy")),
+        FakeProvider("google", cost=1.5, error=ProviderBusyError("google busy")),
+    ], hedging=True)
+    try:
+        await router.generate(STANDARD)
+        busy = False
+    except ProviderBusyError:
+        busy = True
+    checks.append(report("все заняты → ProviderBusyError", busy, "проброшено" if busy else "не проброшено"))
+
+    return all(checks)
+
+
+def main():
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Локальная заглушка Kie.ai (createTask / recordInfo / файлы результата + колбэки).
+
+Запуск:
+    python tools/kie_stub.py --port 9000 --latency 3
+    python tools/kie_stub.py --latency 20 --latency-dist lognormal --fail-rate 0.05 \
+        --http-error-rate 0.02 --result-mb 20 --callback-loss 0.1
+
+Бот направляем на заглушку через config.KIE_URL = "http://127.0.0.1:9000/api/v1/jobs".
+Если в createTask передан callBackUrl, заглушка пришлёт на него уведомление,
+как это делает настоящий Kie (--no-callbacks / --callback-loss — проверить страховочный поллинг).
+
+Длительность задачи: fixed — ровно --latency; uniform — ±--jitter вокруг неё;
+lognormal — медиана --latency с хвостом (sigma = --jitter), как у реального Kie.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+from aiohttp import web, ClientSession
+
+
+def make_png(width: int = 64, height: int = 64) -> bytes:
+    """Генерирует валидный PNG без Pillow (шум, чтобы плохо сжимался)"""
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def png_side_for(size_mb: float) -> int:
+    """Сторона шумного PNG, который весит примерно size_mb (3 байта на пиксель, почти не жмётся)"""
+    return max(8, int(math.sqrt(size_mb * 1024 * 1024 / 3)))
+
+
+class KieStub:
+    def __init__(self, latency: float = 3.0, png_side: int = 256, latency_dist: str = "fixed",
+                 jitter: float = 0.5, fail_rate: float = 0.0, http_error_rate: float = 0.0,
+                 callbacks: bool = True, callback_loss: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.http_error_rate = http_error_rate
+        self.callbacks = callbacks
+        self.callback_loss = callback_loss
+        self.rng = random.Random(seed)
+        self.png = make_png(png_side, png_side)
+        self.tasks: dict[str, dict] = {}
+        self.stats = {
+            "createTask": 0, "recordInfo": 0, "download": 0, "callbacks": 0,
+            "http_errors": 0, "failed": 0, "callbacks_lost": 0,
+        }
+        self.base_url = ""
+
+    def _duration(self) -> float:
+        if self.latency_dist == "uniform":
+            return max(0.0, self.rng.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter)))
+        if self.latency_dist == "lognormal":
+            return self.rng.lognormvariate(math.log(max(self.latency, 0.001)), self.jitter)
+        return self.latency
+
+    # --- ЭНДПОИНТЫ ---
+    async def create_task(self, request: web.Request) -> web.Response:
+        self.stats["createTask"] += 1
+        if self.rng.random() < self.http_error_rate:
+            # Временная ошибка API — клиент должен ретраить
+            self.stats["http_errors"] += 1
+            return web.json_response({"code": 503, "msg": "stub overloaded"}, status=503)
+        body = await request.json()
+        task_id = uuid.uuid4().hex
+        self.tasks[task_id] = {
+            "model": body.get("model"),
+            "created": time.monotonic(),
+            "duration": self._duration(),
+            "callback": body.get("callBackUrl") if self.callbacks else None,
+            "state": "waiting",
+        }
+        asyncio.create_task(self._finish_later(task_id))
+        return web.json_response({"code": 200, "msg": "success", "data": {"taskId": task_id}})
+
+    async def record_info(self, request: web.Request) -> web.Response:
+        self.stats["recordInfo"] += 1
+        task = self.tasks.get(request.query.get("taskId"))
+        if not task:
+            return web.json_response({"code": 404, "msg": "not found", "data": None})
+        return web.json_response({"code": 200, "msg": "success", "data": self._record(request.query["taskId"], task)})
+
+    async def download(self, request: web.Request) -> web.StreamResponse:
+        self.stats["download"] += 1
+        # Отдаём чанками — как CDN, без одного огромного write
+        resp = web.StreamResponse(headers={"Content-Type": "image/png", "Content-Length": str(len(self.png))})
+        await resp.prepare(request)
+        view = memoryview(self.png)
+        for i in range(0, len(view), 256 * 1024):
+            await resp.write(view[i:i + 256 * 1024])
+        await resp.write_eof()
+        return resp
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    # --- ВНУТРЕННЕЕ ---
+    def _record(self, task_id: str, task: dict) -> dict:
+        data = {"taskId": task_id, "model": task["model"], "state": task["state"]}
+        if task["state"] == "success":
+            data["resultJson"] = json.dumps({"resultUrls": [f"{self.base_url}/files/{task_id}.png"]})
+        if task["state"] == "fail":
+            data["failMsg"] = task.get("fail_msg", "stub failure")
+        return data
+
+    async def _finish_later(self, task_id: str):
+        task = self.tasks[task_id]
+        await asyncio.sleep(task["duration"])
+        if self.rng.random() < self.fail_rate:
+            self.stats["failed"] += 1
+            task["state"] = "fail"
+        else:
+            task["state"] = "success"
+        if task["callback"]:
+            if self.rng.random() < self.callback_loss:
+                # Колбэк "потерялся" — результат найдёт только страховочный поллинг
+                self.stats["callbacks_lost"] += 1
+                return
+            await self._fire_callback(task_id, task)
+
+    async def _fire_callback(self, task_id: str, task: dict):
+        payload = {"code": 200, "msg": "success", "data": self._record(task_id, task)}
+        try:
+            async with ClientSession() as session:
+                async with session.post(task["callback"], json=payload) as resp:
+                    self.stats["callbacks"] += 1
+                    if resp.status != 200:
+                        print(f"⚠️ Колбэк {task_id}: HTTP {resp.status}")
+        except Exception as e:
+            print(f"⚠️ Колбэк {task_id} не доставлен: {e}")
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/v1/jobs/createTask", self.create_task)
+        app.router.add_get("/api/v1/jobs/recordInfo", self.record_info)
+        app.router.add_get("/files/{name}", self.download)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+
+async def start_stub(stub: KieStub, host: str = "127.0.0.1", port: int = 9000) -> web.AppRunner:
+    runner = web.AppRunner(stub.build_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    stub.base_url = f"http://{host}:{port}"
+    return runner
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    """Общие флаги заглушки (их же принимает tools/load_test.py)"""
+    parser.add_argument("--latency", type=float, default=3.0, help="длительность задачи (медиана), сек")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс: доля для uniform, sigma для lognormal")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля задач со state=fail")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="доля createTask с HTTP 503")
+    parser.add_argument("--png-side", type=int, default=256, help="сторона PNG результата, px")
+    parser.add_argument("--result-mb", type=float, default=None, help="размер результата, MB (вместо --png-side)")
+    parser.add_argument("--no-callbacks", action="store_true", help="не слать колбэки (только поллинг)")
+    parser.add_argument("--callback-loss", type=float, default=0.0, help="доля потерянных колбэков")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def stub_from_args(args) -> KieStub:
+    side = png_side_for(args.result_mb) if args.result_mb else args.png_side
+    return KieStub(
+        latency=args.latency, png_side=side, latency_dist=args.latency_dist, jitter=args.jitter,
+        fail_rate=args.fail_rate, http_error_rate=args.http_error_rate,
+        callbacks=not args.no_callbacks, callback_loss=args.callback_loss, seed=args.seed,
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Заглушка Kie.ai")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stub = stub_from_args(args)
+    await start_stub(stub, args.host, args.port)
+    print(f"🍌 Kie stub: {stub.base_url}/api/v1/jobs | результат {len(stub.png) / 1024 / 1024:.1f} MB")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,330 @@
+"""
+Нагрузочный прогон генераций против локальной заглушки Kie (без реальных кредитов).
+
+Запуск:
+    python tools/load_test.py --mode engine -n 200 -c 50 --latency 5 --latency-dist lognormal
+    python tools/load_test.py --mode pipeline -n 100 -c 20 --result-mb 20 --json baseline.json
+    python tools/load_test.py --kie-url http://10.0.0.5:9000/api/v1/jobs   # внешняя заглушка
+
+engine   — ai_engine.generate_image: лимитер, createTask, поллер/колбэк, скачивание в blob store.
+pipeline — handlers.generation.process_generation целиком: баланс, БД, превью, отправка
+           (Telegram подменён фейковым ботом, который только считает байты).
+
+Всё пишется во временную папку (bot.db, media/), рабочая база не трогается.
+Отчёт: пропускная способность, p50/p95/p99, пик потоков и пиковый RSS процесса.
+Результат с --json — базовая линия для сравнения изменений движка.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+
+from kie_stub import add_stub_arguments, stub_from_args, start_stub  # noqa: E402
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+class ThreadSampler:
+    """Раз в interval смотрит число потоков (to_thread, aiofiles, DNS) и запоминает пик"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, threading.active_count())
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+# ==============================================================================
+# ФЕЙКОВЫЙ TELEGRAM (для режима pipeline)
+# ==============================================================================
+_ids = itertools.count(1)
+
+
+def _input_size(file) -> int:
+    if getattr(file, "data", None) is not None:
+        return len(file.data)
+    if getattr(file, "path", None):
+        return os.path.getsize(file.path)
+    return 0
+
+
+class FakeMessage:
+    def __init__(self, bot: "FakeBot", chat_id: int, username: str = None, photo: bool = False):
+        self.bot = bot
+        self.message_id = next(_ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=chat_id, username=username)
+        file_id = f"stub-file-{self.message_id}"
+        self.photo = [SimpleNamespace(file_id=file_id)] if photo else None
+        self.document = None if photo else SimpleNamespace(file_id=file_id)
+
+    async def answer(self, text: str = None, **kwargs):
+        return await self.bot.send_message(self.chat.id, text, **kwargs)
+
+    async def answer_photo(self, photo, **kwargs):
+        return await self.bot.send_photo(self.chat.id, photo, **kwargs)
+
+    async def answer_document(self, document, **kwargs):
+        return await self.bot.send_document(self.chat.id, document, **kwargs)
+
+    async def edit_text(self, text: str, **kwargs):
+        return self
+
+    async def edit_reply_markup(self, **kwargs):
+        return self
+
+    async def delete(self):
+        return True
+
+
+class FakeBot:
+    """Принимает всё, что шлёт process_generation; считает доставленные результаты"""
+
+    def __init__(self):
+        self.delivered: dict[int, int] = {}  # chat_id → байт отправлено
+        self.uploaded_bytes = 0
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        return FakeMessage(self, chat_id)
+
+    async def send_photo(self, chat_id=None, photo=None, **kwargs):
+        size = _input_size(photo)
+        self.uploaded_bytes += size
+        self.delivered[chat_id] = size
+        return FakeMessage(self, chat_id, photo=True)
+
+    async def send_document(self, chat_id=None, document=None, **kwargs):
+        size = _input_size(document)
+        self.uploaded_bytes += size
+        self.delivered[chat_id] = size
+        return FakeMessage(self, chat_id)
+
+    async def send_chat_action(self, **kwargs):
+        return True
+
+    async def delete_message(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, *args, **kwargs):
+        return True
+
+
+# ==============================================================================
+# ПРОГОН
+# ==============================================================================
+def prepare_env(args, workdir: Path):
+    """Env до импорта app.*: Google выключен, blob store и колбэки — локальные"""
+    os.environ["GOOGLE_API_KEY"] = ""
+    os.environ["BLOB_STORE_DIR"] = str(workdir / "media" / "blobs")
+    if args.callback_port:
+        os.environ["WEB_HOST"] = "127.0.0.1"
+        os.environ["WEB_PORT"] = str(args.callback_port)
+        os.environ["PUBLIC_BASE_URL"] = f"http://127.0.0.1:{args.callback_port}"
+        os.environ["KIE_CALLBACK_SECRET"] = "load-test"
+    # bot.db по относительному пути — пусть создаётся во временной папке
+    os.chdir(workdir)
+
+
+async def run(args):
+    stub = stub_runner = None
+    if args.kie_url:
+        kie_url = args.kie_url.rstrip("/")
+    else:
+        stub = stub_from_args(args)
+        stub_runner = await start_stub(stub, "127.0.0.1", args.stub_port)
+        kie_url = f"{stub.base_url}/api/v1/jobs"
+        print(f"🍌 Kie stub: {kie_url} | результат {len(stub.png) / 1024 / 1024:.1f} MB")
+
+    from app import config
+    config.KIE_URL = kie_url
+    config.KIE_API_KEY = config.KIE_API_KEY or "load-test"
+    config.ADMIN_CHANNEL_ID = 0
+
+    from app.services.http_client import close_http_session
+    from app.services.kie_poller import kie_poller
+    from app.services.web_server import start_web_server
+    from app.services.timings import stage_timings
+    from app.services.history_writer import history_writer
+    web_runner = await start_web_server()
+    history_writer.start()
+
+    runner_fn = await make_runner(args)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, failures = [], 0
+
+    async def one(i: int):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await runner_fn(i)
+            except Exception as e:
+                print(f"❌ job {i}: {e}")
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures += 1
+
+    sampler = ThreadSampler()
+    sampler.start()
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.jobs)))
+    elapsed = time.perf_counter() - started
+    await sampler.stop()
+
+    report = {
+        "mode": args.mode,
+        "jobs": args.jobs,
+        "concurrency": args.concurrency,
+        "ok": len(latencies),
+        "failed": failures,
+        "elapsed_sec": round(elapsed, 3),
+        "throughput_per_sec": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_sec": round(percentile(latencies, 0.50), 3),
+        "p95_sec": round(percentile(latencies, 0.95), 3),
+        "p99_sec": round(percentile(latencies, 0.99), 3),
+        "max_sec": round(max(latencies, default=0.0), 3),
+        "peak_threads": sampler.peak,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "rss_before_mb": round(rss_before, 1),
+        "poll_requests": kie_poller.requests_sent,
+        "stages": {
+            name: {k: round(v, 3) for k, v in st.items() if k != "buckets"}
+            for name, st in stage_timings.summary().items()
+        },
+        "stub": dict(stub.stats) if stub else None,
+        "stub_config": {
+            "latency": args.latency, "dist": args.latency_dist, "jitter": args.jitter,
+            "fail_rate": args.fail_rate, "http_error_rate": args.http_error_rate,
+            "result_bytes": len(stub.png), "callbacks": not args.no_callbacks and bool(args.callback_port),
+            "callback_loss": args.callback_loss,
+        } if stub else None,
+    }
+
+    print(
+        f"\n📊 {args.mode}: {report['ok']}/{args.jobs} ок, {failures} ошибок за {elapsed:.1f}с "
+        f"(c={args.concurrency})\n"
+        f"   пропускная способность: {report['throughput_per_sec']:.2f} ген/с\n"
+        f"   латентность: p50 {report['p50_sec']:.2f}с | p95 {report['p95_sec']:.2f}с | "
+        f"p99 {report['p99_sec']:.2f}с | max {report['max_sec']:.2f}с\n"
+        f"   потоки (пик): {sampler.peak} | RSS (пик): {report['peak_rss_mb']:.0f} MB "
+        f"(до прогона {rss_before:.0f} MB)\n"
+        f"   запросов поллера: {kie_poller.requests_sent}"
+        + (f" | заглушка: {stub.stats}" if stub else "")
+    )
+    for name, st in report["stages"].items():
+        print(f"   {name:<16} p50 {st['p50']:>7.3f}с | p95 {st['p95']:>7.3f}с | avg {st['avg']:>7.3f}с")
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"💾 Отчёт: {args.json}")
+
+    await history_writer.stop()
+    if web_runner:
+        await web_runner.cleanup()
+    await kie_poller.stop()
+    await close_http_session()
+    if stub_runner:
+        await stub_runner.cleanup()
+
+
+async def make_runner(args):
+    """Возвращает async fn(i) -> bool для выбранного режима"""
+    if args.mode == "engine":
+        from app.services.ai_engine import generate_image
+
+        async def engine_job(i: int) -> bool:
+            result = await generate_image(
+                None, f"load test #{i}", [], False, args.ratio, args.pro, None, args.resolution
+            )
+            return bool(result)
+        return engine_job
+
+    from app.database import async_session, init_db
+    from app.handlers.generation import process_generation
+    from app.services.user_service import create_user, admin_change_balance
+
+    await init_db()
+    base_user = 10_000_000
+    async with async_session() as session:
+        for i in range(args.jobs):
+            await create_user(session, base_user + i, f"load{i}", f"Load {i}")
+            await admin_change_balance(session, base_user + i, 10)
+
+    bot = FakeBot()
+
+    async def pipeline_job(i: int) -> bool:
+        user_id = base_user + i
+        message = FakeMessage(bot, user_id, username=f"load{i}")
+        await process_generation(
+            message, user_id, f"load test #{i}", None, args.ratio,
+            cost=1, use_pro_model=args.pro, resolution=args.resolution, timeout=args.timeout
+        )
+        return user_id in bot.delivered
+    return pipeline_job
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест генераций на заглушке Kie")
+    parser.add_argument("--mode", choices=["engine", "pipeline"], default="engine")
+    parser.add_argument("-n", "--jobs", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("--pro", action="store_true", help="PRO-модель вместо Standard")
+    parser.add_argument("--resolution", default="1K")
+    parser.add_argument("--ratio", default="1:1")
+    parser.add_argument("--timeout", type=float, default=600, help="лимит на одну генерацию (pipeline)")
+    parser.add_argument("--kie-url", default=None, help="внешняя заглушка вместо встроенной")
+    parser.add_argument("--stub-port", type=int, default=9000)
+    parser.add_argument("--callback-port", type=int, default=9001, help="0 — без сервера колбэков")
+    parser.add_argument("--json", default=None, help="сохранить отчёт (базовая линия)")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    if args.json:
+        args.json = str(Path(args.json).resolve())
+
+    with tempfile.TemporaryDirectory(prefix="nanana-load-") as tmp:
+        prepare_env(args, Path(tmp))
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()